@@ -0,0 +1,105 @@
+import numpy as np
+
+from wf.abundance import (
+    UNASSIGNED,
+    UNCLASSIFIED,
+    AbundanceMatrix,
+    add_matrices,
+    add_sample,
+)
+from wf.types import TaxonRank
+
+_LINEAGES = [
+    "Bacteria;Firmicutes;Bacilli;Lactobacillales;Lactobacillaceae;Lactobacillus;",
+    "Bacteria;Firmicutes;Clostridia;Eubacteriales;Lachnospiraceae;Blautia;",
+    "Bacteria;Bacteroidota;Bacteroidia;Bacteroidales;Bacteroidaceae;Bacteroides;",
+    "Bacteria;Proteobacteria;NA;NA;NA;NA;",
+]
+
+
+def _kaiju_table(path, seed):
+    rng = np.random.default_rng(seed)
+    reads = rng.integers(1, 1000, len(_LINEAGES) + 2)
+    rows = [*zip(reads, [*_LINEAGES, "cannot be assigned to a (non-viral) genus"])]
+    rows.append((reads[-1], UNCLASSIFIED))
+    with open(path, "w") as f:
+        f.write("file\tpercent\treads\ttaxon_id\ttaxon_name\n")
+        for i, (n, name) in enumerate(rows):
+            f.write(f"{path.name}\t0.0\t{n}\t{i}\t{name}\n")
+    return path
+
+
+def test_columns_round_trip(tmp_path):
+    root = tmp_path.joinpath("index")
+    for sample, seed in (("a", 1), ("b", 2)):
+        add_sample(root, sample, _kaiju_table(tmp_path.joinpath(f"{sample}.tsv"), seed))
+
+    matrix = AbundanceMatrix(root, TaxonRank.genus)
+    assert list(matrix.samples()) == ["a", "b"]
+    column = matrix.column("b")
+    total = matrix.columns[matrix.samples()["b"]][1]
+    assert sum(column.values()) == total
+    assert column[UNCLASSIFIED] > 0 and column[UNASSIGNED] > 0
+    relative = matrix.column("b", relative=True)
+    assert np.isclose(sum(relative.values()), 1, atol=1e-5)
+
+    # Phylum counts are the sums of the genera they contain
+    phylum = AbundanceMatrix(root, TaxonRank.phylum).column("b")
+    assert phylum["Bacteria;Firmicutes"] == sum(
+        n for name, n in column.items() if name.startswith("Bacteria;Firmicutes;")
+    )
+
+
+def test_resubmitted_sample_uses_latest_column(tmp_path):
+    root = tmp_path.joinpath("index")
+    add_sample(root, "a", _kaiju_table(tmp_path.joinpath("a1.tsv"), 1))
+    add_sample(root, "a", _kaiju_table(tmp_path.joinpath("a2.tsv"), 2))
+
+    matrix = AbundanceMatrix(root, TaxonRank.genus)
+    assert len(matrix.columns) == 2
+    assert matrix.samples() == {"a": 1}
+
+
+def test_interrupted_append_is_dropped(tmp_path):
+    root = tmp_path.joinpath("index")
+    add_sample(root, "a", _kaiju_table(tmp_path.joinpath("a.tsv"), 1))
+    expected = AbundanceMatrix(root, TaxonRank.genus).column("a")
+
+    # An append that wrote its arrays and column but not the column end
+    rank_dir = root.joinpath(TaxonRank.genus.value)
+    with open(rank_dir.joinpath("counts.u4"), "ab") as f:
+        np.arange(3, dtype=np.uint32).tofile(f)
+    with open(rank_dir.joinpath("samples.tsv"), "a") as f:
+        f.write("1\tb\t10\n")
+
+    matrix = AbundanceMatrix(root, TaxonRank.genus)
+    assert list(matrix.samples()) == ["a"]
+    matrix.append("c", {"Bacteria;Firmicutes;Bacilli": 5}, 5)
+
+    matrix = AbundanceMatrix(root, TaxonRank.genus)
+    assert list(matrix.samples()) == ["a", "c"]
+    assert matrix.column("a") == expected
+    assert matrix.column("c") == {"Bacteria;Firmicutes;Bacilli": 5}
+
+
+def test_merged_sample_matrices_match_direct_appends(tmp_path):
+    direct = tmp_path.joinpath("direct")
+    merged = tmp_path.joinpath("merged")
+    for sample, seed in (("a", 1), ("b", 2)):
+        table = _kaiju_table(tmp_path.joinpath(f"{sample}_kaiju.tsv"), seed)
+        add_sample(direct, sample, table)
+        add_sample(tmp_path.joinpath(sample), sample, table)
+    matrices = {}
+    for sample in ("a", "b"):
+        add_matrices(merged, tmp_path.joinpath(sample), matrices)
+
+    for rank in TaxonRank:
+        if not direct.joinpath(rank.value).exists():
+            continue
+        expected, actual = AbundanceMatrix(direct, rank), AbundanceMatrix(merged, rank)
+        assert actual.columns == expected.columns
+        for sample in ("a", "b"):
+            assert actual.column(sample) == expected.column(sample)
+            assert actual.column(sample, relative=True) == expected.column(
+                sample, relative=True
+            )
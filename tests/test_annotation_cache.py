@@ -0,0 +1,91 @@
+import json
+
+from wf.functional_module.cache import (
+    AnnotationCache,
+    merge_cache_stats,
+    merge_caches,
+    protein_hash,
+    split_cached,
+)
+
+
+def test_merge_skips_empty_placeholders(tmp_path):
+    cache = AnnotationCache(tmp_path / "a.sqlite", namespace="macrel")
+    cache.store({"k1": "amp"})
+    cache.close()
+    placeholder = tmp_path / "gated.sqlite"
+    placeholder.touch()
+
+    merge_caches(tmp_path / "merged.sqlite", [tmp_path / "a.sqlite", placeholder])
+
+    merged = AnnotationCache(tmp_path / "merged.sqlite", namespace="macrel")
+    assert merged.lookup(["k1"]) == {"k1": "amp"}
+
+
+def test_merge_empty_cache(tmp_path):
+    AnnotationCache(tmp_path / "gated.sqlite", namespace="").close()
+
+    merge_caches(tmp_path / "merged.sqlite", [tmp_path / "gated.sqlite"])
+
+    merged = AnnotationCache(tmp_path / "merged.sqlite", namespace="macrel")
+    assert merged.lookup(["k1"]) == {}
+
+
+def test_namespaces_are_separate(tmp_path):
+    macrel = AnnotationCache(tmp_path / "cache.sqlite", namespace="macrel")
+    macrel.store({"k1": "amp", "k2": ""})
+    fargene = AnnotationCache(tmp_path / "cache.sqlite", namespace="fargene:class_a")
+
+    assert fargene.lookup(["k1", "k2"]) == {}
+    assert macrel.lookup(["k1", "k2", "k3"]) == {"k1": "amp", "k2": ""}
+    assert macrel.metrics()["hits"] == 2 and macrel.metrics()["misses"] == 1
+
+
+def test_merge_round_trip(tmp_path):
+    for name, results in (("a", {"k1": "old", "k2": "x"}), ("b", {"k1": "new"})):
+        cache = AnnotationCache(tmp_path / f"{name}.sqlite", namespace="macrel")
+        cache.store(results)
+        cache.close()
+    other = AnnotationCache(tmp_path / "b.sqlite", namespace="fargene:class_a")
+    other.store({"k1": "bla"})
+    other.close()
+
+    merge_caches(
+        tmp_path / "merged.sqlite", [tmp_path / "a.sqlite", tmp_path / "b.sqlite"]
+    )
+
+    merged = AnnotationCache(tmp_path / "merged.sqlite", namespace="macrel")
+    # The later cache wins
+    assert merged.lookup(["k1", "k2"]) == {"k1": "new", "k2": "x"}
+    merged.namespace = "fargene:class_a"
+    assert merged.lookup(["k1"]) == {"k1": "bla"}
+
+
+def test_split_cached(tmp_path):
+    cache = AnnotationCache(tmp_path / "cache.sqlite", namespace="macrel")
+    cache.store({protein_hash(b"MKV"): "amp"})
+    records = [
+        (b"c1_1 # 1 # 9", b"MKV*"),
+        (b"c2_1 # 1 # 12", b"mkvL"),
+        (b"c3_1 # 1 # 12", b"MKVL"),
+    ]
+
+    assignments, sequences, cached, aliases = split_cached(
+        records, cache, tmp_path / "misses.faa"
+    )
+
+    assert [record for record, _ in assignments] == ["c1_1", "c2_1", "c3_1"]
+    # Hashes ignore case and the stop codon
+    assert assignments[1][1] == assignments[2][1]
+    assert cached == {protein_hash(b"MKV"): "amp"}
+    assert aliases == {"q0": protein_hash(b"MKVL")}
+    assert (tmp_path / "misses.faa").read_bytes().startswith(b">q0\n")
+
+
+def test_merge_cache_stats(tmp_path):
+    for i, (hits, misses) in enumerate(((3, 1), (0, 4))):
+        with open(tmp_path / f"{i}.json", "w") as f:
+            json.dump({"namespace": "macrel", "hits": hits, "misses": misses}, f)
+
+    stats = merge_cache_stats(sorted(tmp_path.glob("*.json")))
+    assert stats == {"namespace": "macrel", "hits": 3, "misses": 5, "hit_rate": 0.375}
@@ -0,0 +1,87 @@
+import gzip
+import struct
+
+import numpy as np
+
+from wf.binpack import (
+    BGZF_BLOCK_SIZE,
+    BGZF_MAX_BLOCK,
+    BinArchive,
+    bgzf_block,
+    write_bin_archive,
+)
+from wf.validation import BGZF_EOF
+
+
+def _bgzf_blocks(data):
+    """Sizes of the BGZF blocks of a file, checking every header"""
+
+    sizes, offset = [], 0
+    while offset < len(data):
+        assert data[offset : offset + 4] == b"\x1f\x8b\x08\x04"
+        assert data[offset + 12 : offset + 14] == b"BC"
+        size = struct.unpack_from("<H", data, offset + 16)[0] + 1
+        assert size <= BGZF_MAX_BLOCK
+        sizes.append(size)
+        offset += size
+    assert offset == len(data)
+    return sizes
+
+
+def _write_bin(path, n_contigs, seed):
+    rng = np.random.default_rng(seed)
+    acgt = np.frombuffer(b"ACGT", dtype=np.uint8)
+    with open(path, "wb") as f:
+        for i in range(n_contigs):
+            sequence = acgt[rng.integers(0, 4, rng.integers(1000, 50_000))].tobytes()
+            f.write(b">k141_%d\n%s\n" % (i, sequence))
+    return path
+
+
+def test_incompressible_blocks_fit():
+    rng = np.random.default_rng(1)
+    data = rng.bytes(BGZF_BLOCK_SIZE)
+
+    assert len(_bgzf_blocks(bgzf_block(data, level=0))) == 1
+    assert gzip.decompress(bgzf_block(data, level=0)) == data
+
+    # Larger inputs are split over several blocks
+    data = rng.bytes(2 * BGZF_BLOCK_SIZE)
+    assert len(_bgzf_blocks(bgzf_block(data))) == 2
+    assert gzip.decompress(bgzf_block(data)) == data
+
+
+def test_archive_round_trip(tmp_path):
+    bin_files = [
+        _write_bin(tmp_path.joinpath("s.1.fa"), 20, seed=1),
+        _write_bin(tmp_path.joinpath("s.2.fa"), 0, seed=2),
+        _write_bin(tmp_path.joinpath("s.3.fa"), 3, seed=3),
+    ]
+    archive = tmp_path.joinpath("s_bins.fa.gz")
+    index = tmp_path.joinpath("s_bins.index.tsv")
+
+    rows = write_bin_archive(bin_files, archive, index, workers=2)
+
+    data = archive.read_bytes()
+    assert data.endswith(BGZF_EOF)
+    _bgzf_blocks(data)
+    # The archive is a regular gzip stream of the concatenated bins
+    assert gzip.decompress(data) == b"".join(f.read_bytes() for f in bin_files)
+
+    packed = BinArchive(archive)
+    assert packed.bins() == ["s.1.fa", "s.2.fa", "s.3.fa"]
+    for bin_file, row in zip(bin_files, rows):
+        assert packed.read_bin(bin_file.name) == bin_file.read_bytes()
+        assert packed.stats(bin_file.name) == row
+        # Every bin starts on a block of its own
+        _bgzf_blocks(data[row["offset"] : row["offset"] + row["length"]])
+    assert packed.stats("s.2.fa")["contigs"] == 0
+    assert packed.stats("s.1.fa")["contigs"] == 20
+    assert packed.stats("s.3.fa")["bases"] == sum(
+        len(line.strip())
+        for line in bin_files[2].read_bytes().splitlines()
+        if not line.startswith(b">")
+    )
+
+    packed.extract("s.3.fa", tmp_path.joinpath("extracted.fa"))
+    assert tmp_path.joinpath("extracted.fa").read_bytes() == bin_files[2].read_bytes()
@@ -0,0 +1,69 @@
+import numpy as np
+
+from wf.functional_module.chunking import (
+    balanced_partition,
+    concatenate_tables,
+    write_contig_chunks,
+)
+from wf.seqio import read_fasta
+
+
+def _write_contigs(path, n, seed):
+    rng = np.random.default_rng(seed)
+    acgt = np.frombuffer(b"ACGT", dtype=np.uint8)
+    contigs = {}
+    with open(path, "wb") as f:
+        for i in range(n):
+            sequence = acgt[rng.integers(0, 4, rng.integers(200, 20_000))].tobytes()
+            contigs[b"k141_%d" % i] = sequence
+            f.write(b">k141_%d flag=1\n%s\n" % (i, sequence))
+    return contigs
+
+
+def test_balanced_partition():
+    lengths = np.random.default_rng(1).integers(200, 20_000, 500)
+
+    assignment = balanced_partition(lengths, 7)
+    loads = np.bincount(assignment, weights=lengths, minlength=7)
+
+    assert set(assignment.tolist()) == set(range(7))
+    assert loads.max() - loads.min() <= lengths.max()
+
+
+def test_chunks_hold_every_contig_once(tmp_path):
+    contigs = _write_contigs(tmp_path.joinpath("contigs.fa"), 300, seed=2)
+    total = sum(len(sequence) for sequence in contigs.values())
+
+    chunks = write_contig_chunks(
+        tmp_path.joinpath("contigs.fa"), tmp_path.joinpath("chunks"), total // 5, "s."
+    )
+
+    assert [chunk.name for chunk in chunks][:2] == ["s.chunk_0.fa", "s.chunk_1.fa"]
+    assert len(chunks) in (5, 6)
+    records = {}
+    for chunk in chunks:
+        for header, sequence in read_fasta(chunk):
+            assert header.split()[0] not in records
+            records[header.split()[0]] = sequence
+    assert records == contigs
+
+
+def test_no_chunks_without_contigs(tmp_path):
+    tmp_path.joinpath("contigs.fa").write_bytes(b"")
+
+    assert write_contig_chunks(tmp_path.joinpath("contigs.fa"), tmp_path, 1000) == []
+
+
+def test_concatenate_tables(tmp_path):
+    tables = []
+    for i in range(3):
+        tables.append(tmp_path.joinpath(f"{i}.tsv"))
+        tables[-1].write_text(f"# tool\nid\tvalue\nrow{i}\t{i}\n")
+
+    concatenate_tables(tables, tmp_path.joinpath("all.tsv"), header_lines=2)
+    assert tmp_path.joinpath("all.tsv").read_text() == (
+        "# tool\nid\tvalue\nrow0\t0\nrow1\t1\nrow2\t2\n"
+    )
+
+    concatenate_tables([], tmp_path.joinpath("none.tsv"), header="id\tvalue\n")
+    assert tmp_path.joinpath("none.tsv").read_text() == "id\tvalue\n"
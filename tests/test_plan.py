@@ -0,0 +1,117 @@
+import gzip
+
+import numpy as np
+from latch.types import LatchFile
+
+from wf.binpack import BGZF_BLOCK_SIZE, bgzf_block
+from wf.local import Stage, metamage_stages
+from wf.plan import (
+    DEFAULT_MODELS,
+    StageModel,
+    _fit,
+    calibrate,
+    estimate_reads,
+    plan,
+)
+from wf.types import HostData, Sample
+
+
+def _fastq(n_reads, seed, length=150):
+    rng = np.random.default_rng(seed)
+    acgt = np.frombuffer(b"ACGT", dtype=np.uint8)
+    sequences = acgt[rng.integers(0, 4, (n_reads, length))]
+    return b"".join(
+        b"@r%d\n%s\n+\n%s\n" % (i, sequence.tobytes(), b"I" * length)
+        for i, sequence in enumerate(sequences)
+    )
+
+
+def test_every_stage_has_a_model(tmp_path):
+    reads = tmp_path.joinpath("r.fq")
+    stages = metamage_stages(
+        sample=Sample(read1=LatchFile(str(reads)), read2=LatchFile(str(reads))),
+        host_data=HostData(host_name="host", host_genome=LatchFile(str(reads))),
+        kaiju_ref_db=LatchFile(str(reads)),
+        kaiju_ref_nodes=LatchFile(str(reads)),
+        kaiju_ref_names=LatchFile(str(reads)),
+        sample_name="s",
+    )
+
+    assert {stage.name for stage in stages} <= set(DEFAULT_MODELS)
+
+
+def test_estimate_reads(tmp_path):
+    data = _fastq(40_000, seed=1)
+    plain = tmp_path.joinpath("r.fq")
+    plain.write_bytes(data)
+    gz = tmp_path.joinpath("r.fq.gz")
+    gz.write_bytes(gzip.compress(data))
+    bgzf = tmp_path.joinpath("r.bgz")
+    bgzf.write_bytes(
+        b"".join(
+            bgzf_block(data[i : i + BGZF_BLOCK_SIZE])
+            for i in range(0, len(data), BGZF_BLOCK_SIZE)
+        )
+    )
+
+    for path in (plain, gz, bgzf):
+        records, bases = estimate_reads(str(path))
+        assert abs(records - 40_000) < 40_000 * 0.05
+        assert abs(bases - 6_000_000) < 6_000_000 * 0.05
+
+    # Files smaller than the sample are counted exactly
+    plain.write_bytes(data[: len(_fastq(1000, seed=1))])
+    assert estimate_reads(str(plain)) == (1000, 150_000)
+
+
+def test_fit():
+    records = [
+        {"features": {"read_gbp": x}, "seconds": 30 + 100 * x} for x in (1, 2, 5)
+    ]
+    assert np.allclose(_fit(records, "read_gbp", "seconds", 0, 1), (30, 100))
+
+    # A single feature value rescales the prior
+    assert np.allclose(_fit(records[:1], "read_gbp", "seconds", 10, 10), (65, 65))
+    assert _fit([], "read_gbp", "seconds", 10, 10) == (10, 10)
+
+
+def test_calibrate_only_recorded_stages():
+    records = [
+        {"stage": "fastp", "features": {"read_gbp": x}, "seconds": 2 * x}
+        for x in (1, 3)
+    ]
+
+    models = calibrate(records)
+    assert np.isclose(models["fastp"].seconds_per_unit, 2)
+    assert models["fastp"].memory_gib == DEFAULT_MODELS["fastp"].memory_gib
+    assert models["megahit"] == DEFAULT_MODELS["megahit"]
+
+
+def test_plan_critical_path_and_ooms():
+    stages = [
+        Stage("a", None, (2, 4)),
+        Stage("b", None, (2, 4), ("a",)),
+        Stage("c", None, (2, 4), ("a",), mapped="chunks"),
+        Stage("d", None, (2, 4), ("b", "c")),
+    ]
+    models = {
+        "a": StageModel("x", 10, 0, "x", 1, 0),
+        "b": StageModel("x", 100, 0, "x", 1, 0),
+        "c": StageModel("x", 10, 0, "x", 1, 1),
+        "d": StageModel("x", 10, 0, "x", 1, 0),
+    }
+
+    estimates = {
+        e.stage: e
+        for e in plan(
+            stages,
+            {"x": 8, "annotation_chunks": 3},
+            models,
+            node_prices={(2, 4): 3600.0},
+        )
+    }
+
+    assert estimates["d"].start == 110 and estimates["d"].finish == 120
+    assert [s for s, e in estimates.items() if e.critical] == ["a", "b", "d"]
+    assert estimates["c"].instances == 3 and estimates["c"].cost == 30
+    assert [s for s, e in estimates.items() if e.oom] == ["c"]
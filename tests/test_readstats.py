@@ -0,0 +1,116 @@
+import numpy as np
+
+from wf.kmers import ENCODE, code_kmer_hashes, kmer_hashes
+from wf.readstats import (
+    MateStats,
+    load_mate_stats,
+    load_read_stats,
+    merge_sidecars,
+    write_sidecar,
+)
+
+_ACGT = np.frombuffer(b"ACGT", dtype=np.uint8)
+
+
+class _Dir:
+    def __init__(self, path):
+        self.local_path = str(path)
+
+
+def _fastq(n_reads, seed, length=150):
+    rng = np.random.default_rng(seed)
+    sequences = _ACGT[rng.integers(0, 4, (n_reads, length))]
+    return b"".join(
+        b"@r%d\n%s\n+\n%s\n" % (i, sequence.tobytes(), b"I" * length)
+        for i, sequence in enumerate(sequences)
+    )
+
+
+def _stats(data, sample_kmers=True, block_size=1 << 16):
+    stats = MateStats(sample_kmers=sample_kmers, kmer_read_stride=1)
+    for start in range(0, len(data), block_size):
+        stats.update(data[start : start + block_size])
+    stats.finish()
+    return stats
+
+
+def test_kmer_hashes_are_canonical():
+    forward = b"ACGTTGCAAGGCTTACGATCGATCGG"
+    reverse = forward[::-1].translate(bytes.maketrans(b"ACGT", b"TGCA"))
+
+    assert np.array_equal(
+        np.sort(kmer_hashes([forward])), np.sort(kmer_hashes([reverse]))
+    )
+
+
+def test_kmers_do_not_span_separators():
+    sequence = b"ACGTTGCAAGGCTTACGATCG"
+    codes = ENCODE[np.frombuffer(sequence + b"N" + sequence, dtype=np.uint8)]
+
+    assert code_kmer_hashes(codes).size == 2
+    assert kmer_hashes([sequence, sequence]).size == 2
+
+
+def test_block_boundaries_do_not_change_stats():
+    data = _fastq(2000, seed=1)
+    small, large = _stats(data, block_size=997), _stats(data, block_size=1 << 20)
+
+    assert small.reads == large.reads == 2000
+    assert small.bases == large.bases == 300_000
+    assert np.array_equal(small.gc_percent, large.gc_percent)
+    assert np.array_equal(small.kmer_spectrum(), large.kmer_spectrum())
+
+
+def test_merged_sidecars_match_the_whole(tmp_path):
+    part1, part2 = _fastq(5000, seed=2), _fastq(5000, seed=3)
+    # Repeated reads give k-mers counted more than once
+    part1 += _fastq(2500, seed=2)
+    whole = _stats(part1 + part2)
+
+    for name, data in (("chunk_0", part1), ("chunk_1", part2)):
+        tmp_path.joinpath(name).mkdir()
+        write_sidecar(
+            tmp_path.joinpath(name), "s", _stats(data), _stats(data, sample_kmers=False)
+        )
+    tmp_path.joinpath("merged").mkdir()
+    merge_sidecars(
+        [tmp_path.joinpath("chunk_0"), tmp_path.joinpath("chunk_1")],
+        tmp_path.joinpath("merged"),
+        "s",
+    )
+
+    mate1, mate2 = load_mate_stats(tmp_path.joinpath("merged"), "s")
+    assert (mate1.reads, mate1.bases, mate1.gc_bases) == (
+        whole.reads,
+        whole.bases,
+        whole.gc_bases,
+    )
+    assert np.array_equal(mate1.lengths, whole.lengths)
+    for merged, expected in zip(mate1.kmer_counts(), whole.kmer_counts()):
+        assert np.array_equal(merged, expected)
+    assert mate2.reads == whole.reads
+
+    summary = load_read_stats(_Dir(tmp_path.joinpath("merged")), "s")
+    assert summary["read_pairs"] == whole.reads
+    assert summary["kmer_sample"]["total"] == int(whole.kmer_counts()[1].sum())
+
+
+def test_sampled_reads_do_not_depend_on_read_order():
+    data = _fastq(4000, seed=4)
+    records = data.split(b"\n@")
+    records = [records[0][1:]] + records[1:]
+    shuffled = b"".join(
+        b"@" + record.rstrip(b"\n") + b"\n" for record in reversed(records)
+    )
+
+    def sampled(fastq, block_size):
+        stats = MateStats(sample_kmers=True)
+        for start in range(0, len(fastq), block_size):
+            stats.update(fastq[start : start + block_size])
+        stats.finish()
+        return stats.kmer_counts()
+
+    forward, reverse = sampled(data, 1 << 20), sampled(shuffled, 5003)
+    assert 0 < forward[0].size < _stats(data).kmer_counts()[0].size
+    for a, b in zip(forward, reverse):
+        assert np.array_equal(a, b)
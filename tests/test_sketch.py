@@ -0,0 +1,89 @@
+import gzip
+import json
+
+import numpy as np
+
+from wf.kmers import KMER_SIZE
+from wf.readstats import (
+    KMER_READ_STRIDE,
+    KMER_SCALE,
+    MateStats,
+    load_read_distributions,
+    write_sidecar,
+)
+from wf.sketch import SketchIndex, ani_estimate, jaccard, merge_sketches, sketch_reads
+
+_ACGT = np.frombuffer(b"ACGT", dtype=np.uint8)
+
+
+class _Dir:
+    def __init__(self, path):
+        self.local_path = str(path)
+
+
+def _fastq(n_reads, seed, length=150):
+    rng = np.random.default_rng(seed)
+    sequences = _ACGT[rng.integers(0, 4, (n_reads, length))]
+    return b"".join(
+        b"@r%d\n%s\n+\n%s\n" % (i, sequence.tobytes(), b"I" * length)
+        for i, sequence in enumerate(sequences)
+    )
+
+
+def test_jaccard():
+    a = np.arange(0, 100, dtype=np.uint64)
+    b = np.arange(50, 150, dtype=np.uint64)
+
+    assert jaccard(a, b) == 50 / 150
+    assert jaccard(a, a) == 1.0
+    assert jaccard(a[:0], b[:0]) == 0.0
+    assert ani_estimate(1.0) == 1.0
+    assert ani_estimate(0.0) == 0.0
+
+
+def test_reads_sketch_matches_sidecar(tmp_path):
+    data = _fastq(20_000, seed=1)
+    read_file = tmp_path.joinpath("s_unaligned.fastq.1.gz")
+    read_file.write_bytes(gzip.compress(data))
+
+    mate1, mate2 = MateStats(sample_kmers=True), MateStats(sample_kmers=False)
+    for mate in (mate1, mate2):
+        mate.update(data)
+        mate.finish()
+    write_sidecar(tmp_path, "s", mate1, mate2)
+    sidecar = load_read_distributions(_Dir(tmp_path), "s")["kmer_hashes"]
+
+    sketch = sketch_reads(read_file)
+    assert sketch.size > 0
+    assert np.array_equal(sketch, sidecar)
+
+
+def test_merge_sketches(tmp_path):
+    for sample, seed in (("a", 1), ("b", 2)):
+        sketch_dir = tmp_path.joinpath(sample, "sketch")
+        sketch_dir.mkdir(parents=True)
+        sketch = np.sort(
+            np.random.default_rng(seed).choice(1 << 40, 100, replace=False)
+        ).astype(np.uint64)
+        np.save(sketch_dir.joinpath(f"{sample}.sketch.npy"), sketch)
+        with open(sketch_dir.joinpath(f"{sample}_sketch.json"), "w") as f:
+            json.dump(
+                {
+                    "sample": sample,
+                    "k": KMER_SIZE,
+                    "scale": KMER_SCALE,
+                    "read_stride": KMER_READ_STRIDE,
+                    "hashes": 100,
+                },
+                f,
+            )
+
+    output = tmp_path.joinpath("sketch_index")
+    merge_sketches(output, [tmp_path.joinpath("a", "sketch")])
+    merge_sketches(output, [tmp_path.joinpath("b", "sketch")])
+
+    index = SketchIndex(output)
+    assert sorted(index.compatible()) == ["a", "b"]
+    assert np.array_equal(
+        index.load("b"), np.load(tmp_path.joinpath("b", "sketch", "b.sketch.npy"))
+    )
@@ -0,0 +1,70 @@
+import gzip
+
+import numpy as np
+
+from wf.stats import assembly_summary, fasta_length_gc, nx_statistic
+
+
+def _contigs(n, seed):
+    rng = np.random.default_rng(seed)
+    alphabet = np.frombuffer(b"ACGTacgtN", dtype=np.uint8)
+    return [
+        alphabet[rng.integers(0, alphabet.size, rng.integers(1, 3000))].tobytes()
+        for _ in range(n)
+    ]
+
+
+def _write_fasta(path, contigs, width=60):
+    with gzip.open(path, "wb") as f:
+        for i, contig in enumerate(contigs):
+            f.write(b">k141_%d flag=1 multi=2.0000\n" % i)
+            for start in range(0, len(contig), width):
+                f.write(contig[start : start + width] + b"\n")
+
+
+def test_fasta_length_gc_matches_python(tmp_path):
+    contigs = _contigs(200, seed=1)
+    path = tmp_path.joinpath("contigs.fa.gz")
+    _write_fasta(path, contigs)
+
+    for block_size in (97, 4096, 1 << 24):
+        lengths, gc, acgt = fasta_length_gc(path, block_size=block_size)
+        assert lengths.tolist() == [len(c) for c in contigs]
+        assert gc.tolist() == [sum(c.upper().count(b) for b in b"GC") for c in contigs]
+        assert acgt.tolist() == [len(c) - c.count(b"N") for c in contigs]
+
+
+def test_fasta_without_trailing_newline(tmp_path):
+    path = tmp_path.joinpath("contigs.fa")
+    path.write_bytes(b">a\nACGT\nGG\n>b\nNNAC")
+
+    lengths, gc, acgt = fasta_length_gc(path)
+    assert lengths.tolist() == [6, 4]
+    assert gc.tolist() == [4, 1]
+    assert acgt.tolist() == [6, 2]
+
+
+def test_nx_statistic():
+    lengths = np.array([2, 3, 4, 5, 6, 7, 8, 9, 10])
+
+    # QUAST: the N50 contig is where the sorted lengths reach half the total
+    assert nx_statistic(lengths, 0.5) == (8, 3)
+    assert nx_statistic(lengths, 0.9) == (4, 7)
+    assert nx_statistic(lengths[:0], 0.5) == (0, 0)
+
+
+def test_assembly_summary():
+    summary = assembly_summary(
+        np.array([500, 1500, 6000]),
+        np.array([250, 750, 3000]),
+        np.array([500, 1500, 5000]),
+    )
+
+    assert summary["contigs"] == 3
+    assert summary["total_length"] == 8000
+    assert summary["N50"] == 6000 and summary["L50"] == 1
+    assert summary["GC (%)"] == 57.14
+    assert summary["N's per 100 kbp"] == 12500.0
+    assert summary["contigs (>= 1000 bp)"] == 2
+    assert summary["total_length (>= 5000 bp)"] == 6000
+    assert assembly_summary(*[np.zeros(0, dtype=np.int64)] * 3)["contigs"] == 0
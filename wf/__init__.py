@@ -1,16 +1,24 @@
-from typing import List, Union
+from typing import List, Optional, Union
 
-from latch import workflow
+from latch import create_conditional_section, workflow
 from latch.resources.launch_plan import LaunchPlan
 from latch.types import LatchDir, LatchFile
 
-from .binning import binning_wf
+from .abundance import abundance_matrices
+from .analysis import analysis_wf, reuse_duplicate_results
 from .docs import metamage_DOCS
-from .functional import functional_wf
-from .host_removal import host_removal_wf
-from .kaiju import kaiju_wf
-from .metassembly import assembly_wf
-from .types import HostData, ProdigalOutput, Sample, TaxonRank, fARGeneModel
+from .fused import choose_fused_mode
+from .host_removal import host_removal_scatter_wf, host_removal_wf
+from .preview import kaiju_preview_wf
+from .sketch import sketch_sample
+from .types import (
+    HostData,
+    MetabatSweep,
+    ProdigalOutput,
+    Sample,
+    TaxonRank,
+    fARGeneModel,
+)
 
 
 @workflow(metamage_DOCS)
@@ -21,15 +29,36 @@ def metamage(
     kaiju_ref_nodes: LatchFile,
     kaiju_ref_names: LatchFile,
     sample_name: str = "metamage_sample",
+    host_removal_chunk_size: int = 0,
+    preview_read_pairs: int = 100_000,
+    sketch_index: Optional[LatchDir] = None,
+    duplicate_jaccard: float = 0.95,
+    skip_duplicates: bool = True,
     taxon_rank: TaxonRank = TaxonRank.species,
+    min_read_pairs: int = 10_000,
     min_count: int = 2,
     k_min: int = 21,
     k_max: int = 141,
     k_step: int = 12,
     min_contig_len: int = 200,
+    run_metaquast: bool = False,
+    metaquast_min_contig: int = 500,
+    min_contigs: int = 10,
+    min_assembly_bases: int = 100_000,
     prodigal_output_format: ProdigalOutput = ProdigalOutput.gbk,
     fargene_hmm_model: fARGeneModel = fARGeneModel.class_a,
-) -> List[Union[LatchFile, LatchDir]]:
+    prodigal_min_len: int = 200,
+    macrel_min_len: int = 200,
+    fargene_min_len: int = 500,
+    gecco_min_len: int = 1000,
+    macrel_cache: Optional[LatchFile] = None,
+    fargene_cache: Optional[LatchFile] = None,
+    annotation_chunk_bases: int = 100_000_000,
+    metabat_sweep: Optional[MetabatSweep] = None,
+    fuse_below_bytes: int = 2_000_000_000,
+    disk_budget: bool = False,
+    pack_bins: bool = False,
+) -> List[Optional[Union[LatchFile, LatchDir]]]:
     """Metagenomic pre-processing, assembly, annotation and binning
 
     metamage
@@ -44,18 +73,55 @@ def metamage(
 
     ## Read pre-processing and host read removal
 
+    - Multi-lane samples are combined by concatenating gzip members, without
+      recompression, after checking that mate read counts match in every lane
     - [fastp](https://github.com/OpenGene/fastp) for read trimming
       and other general pre-processing [^9]
     - [BowTie2](https://github.com/BenLangmead/bowtie2) for mapping
       to the host genome and extracting unaligned reads [^10]
+    - Every tool's exit status is checked, and trimmed and host-removed reads
+      (gzip integrity, mate read counts), contigs (FASTA records) and
+      alignments (BAM EOF marker) are validated before their task returns, so
+      a crashed tool stops the workflow instead of feeding truncated files
+      downstream
+    - Optionally, reads are split into chunks that are trimmed and mapped
+      in parallel, then gathered back into a single pair of files. Chunks are
+      packed onto nodes according to index size and memory, and the alignments
+      on a node share one memory-mapped, pre-warmed copy of the host index
+    - While bowtie2 writes the reads left after host removal, they are
+      compressed and summarised in the same pass: read pairs, bases, length
+      and per-read GC distributions and a sampled k-mer spectrum are written
+      next to the reads (`{sample_name}_unaligned.read_stats.json` and
+      `.npz`), so later stages don't rescan them. The k-mers are only hashed
+      for one read in eight, off the compression thread, and scattered host
+      removal merges the statistics of its chunks
+    - A FracMinHash sketch of the host-removed reads, built from the k-mers
+      already sampled for the read statistics, is compared to a cohort sketch
+      index. A sample that is near-identical to a previous one (e.g. the same
+      run resubmitted under another name) reuses its results instead of being
+      re-analysed (`skip_duplicates`), and cohort Jaccard/ANI matrices are
+      written for every sample. Each sample publishes its own sketch; the
+      sketches of a cohort are merged into the index with
+      `python -m wf.sketch --output sketch_index <sample>/sketch ...`
 
     ## Assembly
 
     - [MEGAHIT](https://github.com/voutcn/megahit) for assembly [^1]
-    - [MetaQuast](https://github.com/ablab/quast) for assembly evaluation
+    - Built-in assembly statistics (N50, L50, total length, GC and length
+      histogram) computed in a single streaming pass over the contigs
+    - Outputs of fastp, host read removal, MEGAHIT (including each
+      intermediate k-mer assembly) and the read alignment to the contigs are
+      uploaded from a background thread pool as soon as each file is finished,
+      while the tools are still running. A manifest of content hashes is
+      published with them, and files identical to an already published
+      version are not uploaded again on re-runs
+    - [MetaQuast](https://github.com/ablab/quast) for full assembly evaluation
+      (optional)
 
     ## Functional annotation
 
+    - Exact and reverse-complement duplicate contigs are removed and each
+      tool only receives contigs above its own minimum length
     - [Macrel](https://github.com/BigDataBiology/macrel) for predicting Antimicrobial Peptide
       (AMP)-like sequences from contigs [^6]
     - [fARGene](https://github.com/fannyhb/fargene) for identifying Antimicrobial Resistance Genes
@@ -64,6 +130,30 @@ def metamage(
       (BCGs) from contigs [^8]
     - [Prodigal](https://github.com/hyattpd/Prodigal) for protein-coding
       gene prediction from contigs. [^5]
+    - Macrel results are cached per peptide sequence hash and fARGene
+      results per contig sequence hash in SQLite databases that can be
+      reused across samples and runs, so only previously unseen peptides
+      and contigs are annotated. The sequences fARGene retrieved from cached
+      contigs are written back from the cache to `fargene_results/hits`.
+      Each sample publishes its updated caches; `python -m wf.functional_module.cache
+      --output fargene.sqlite */fargene.sqlite` merges those of a cohort
+    - Macrel, fARGene and Gecco run in parallel over chunks of whole contigs
+      balanced by total length, and their results are merged per sample,
+      fARGene's own retrieved sequences and summary included
+    - Assembly is skipped when too few read pairs are left after host
+      removal, and binning and annotation when the assembly has too few
+      contigs or bases. The checks stream the reads and reuse the assembly
+      statistics, and skipped stages publish a record of why they were skipped
+    - Small samples run MetaQuast, binning and annotation in a single task
+      (and the Kaiju reports in another), sharing one copy of the reads and
+      assembly. Only final outputs are published in this fused mode
+    - In disk-budget mode, host removal, MEGAHIT, the alignment to the
+      contigs and MetaBAT2 delete their downloaded inputs as soon as they are
+      consumed, and MEGAHIT and samtools sort write their temporary files to
+      a scratch area removed after each tool. Host removal streams the
+      trimmed reads to bowtie2, freeing them as they are read, and drops the
+      host index once bowtie2 has loaded it. The peak disk usage of these
+      tasks' inputs, outputs and scratch area is reported in every mode
 
     ## Binning
 
@@ -71,6 +161,15 @@ def metamage(
       building depth files for binning.
     - [MetaBAT2](https://bitbucket.org/berkeleylab/metabat/src/master/) for
       binning [^2]
+    - Optionally, a grid of MetaBAT2 settings (minContig, maxEdges, seed) is
+      binned concurrently against the same depth file. Bin sets are scored by
+      the bases in large, GC-coherent bins, and the best set is published with
+      a comparison table and per-bin statistics
+    - Optionally, the bins are packed into a single bgzipped FASTA in which
+      every bin starts on its own BGZF block, with an index of each bin's byte
+      range, length, N50 and GC. `wf.binpack.BinArchive` reads one bin by
+      decompressing only its byte range, from a local copy or an HTTP(S) URL
+      supporting range requests, without fetching the whole archive
 
     ## Taxonomic classification of reads
 
@@ -78,20 +177,42 @@ def metamage(
       taxonomic classification [^3]
     - [KronaTools](https://github.com/marbl/Krona/wiki/KronaTools) for
       visualizing taxonomic classification results
+    - When running locally or on-prem, the Kaiju database and host genome
+      can be kept between runs in an LRU cache on a persistent directory
+    - A provisional Kaiju table and Krona plot are built from a reservoir
+      subsample of the raw reads while the full run continues, with 95%
+      confidence intervals for every abundance
+    - Every sample's Kaiju table is turned into taxa x samples abundance
+      matrices, one per rank from superkingdom down to the table's rank,
+      stored as compressed sparse columns of counts and relative abundances.
+      Each sample publishes its own; `python -m wf.abundance --index DIR
+      <sample>/abundance_matrices ...` appends them to a cohort index without
+      rewriting its existing samples, and also takes `*_kaiju.tsv` tables of
+      earlier runs
 
     # Output tree
 
     - |metamage
       - |{sample_name}
         - |{sample_name}_bt_idx - Host genome BowTie index
-        - |{sample_name}_bt_unaligned - Reads that didn't align to the host genome
+        - |{sample_name}_bt_unaligned - Reads that didn't align to the host genome, and their read statistics
         - |fastp_results - Results from trimming with fastp
+        - |{sample_name}_read_chunks - Read chunks (scattered host removal only)
+        - |kaiju_preview_reads - Read subsample for the taxonomic preview
+        - |kaiju_preview - Provisional Kaiju table (with confidence intervals) and Krona plot
+        - |sketch - Read FracMinHash sketch, duplicate check and cohort Jaccard/ANI matrices
+        - |stage_checks - Read and assembly checks deciding which stages run
         - |kaiju
+        - |abundance_matrices - The sample's taxa x samples abundance matrices per rank
         - |MEGAHIT
-        - |MetaQuast - Assembly evaluation report
+        - |assembly_stats - Built-in assembly statistics
+        - |MetaQuast - Assembly evaluation report (optional)
         - |{sample_name}_assembly_idx - BowTie Index from assembly data
         - |{sample_name}_assembly_sorted.bam - Reads aligned to assembly contigs
-        - |METABAT
+        - |METABAT - Bins (or a packed bin archive and its index), per-bin statistics and the MetaBAT2 sweep comparison
+        - |filtered_contigs - Deduplicated, length-filtered contigs per tool
+        - |annotation_chunks - Per-chunk Macrel, fARGene and Gecco results
+        - |annotation_cache - Updated Macrel and fARGene annotation caches
         - |fargene_results
         - |gecco_results
         - |macrel_results
@@ -157,54 +278,127 @@ def metamage(
     https://doi.org/10.1093/gigascience/giab008
     """
 
-    # Host read removal and trimming
-    unaligned = host_removal_wf(
+    # Provisional taxonomic profile from a read subsample, ready long before
+    # the full classification
+    kaiju_preview = kaiju_preview_wf(
         sample=sample,
-        host_data=host_data,
-        sample_name=sample_name,
-    )
-
-    # Kaiju taxonomic classification
-    kaiju2table, krona_plot = kaiju_wf(
-        read_dir=unaligned,
         kaiju_ref_db=kaiju_ref_db,
         kaiju_ref_nodes=kaiju_ref_nodes,
         kaiju_ref_names=kaiju_ref_names,
         sample_name=sample_name,
         taxon_rank=taxon_rank,
+        read_pairs_n=preview_read_pairs,
+    )
+
+    # Host read removal and trimming, scattered across nodes for large samples
+    unaligned = (
+        create_conditional_section("host_removal")
+        .if_(host_removal_chunk_size > 0)
+        .then(
+            host_removal_scatter_wf(
+                sample=sample,
+                host_data=host_data,
+                sample_name=sample_name,
+                chunk_size=host_removal_chunk_size,
+            )
+        )
+        .else_()
+        .then(
+            host_removal_wf(
+                sample=sample,
+                host_data=host_data,
+                sample_name=sample_name,
+                disk_budget=disk_budget,
+            )
+        )
     )
 
-    assembly_dir, metassembly_results = assembly_wf(
+    # Sketch the reads and skip the analysis of resubmitted samples
+    sketch_results, duplicate_of, is_duplicate = sketch_sample(
         read_dir=unaligned,
         sample_name=sample_name,
-        min_count=min_count,
-        k_min=k_min,
-        k_max=k_max,
-        k_step=k_step,
-        min_contig_len=min_contig_len,
+        sketch_index=sketch_index,
+        duplicate_jaccard=duplicate_jaccard,
+        skip_duplicates=skip_duplicates,
     )
 
-    # Binning
-    binning_results = binning_wf(
-        read_dir=unaligned, assembly_dir=assembly_dir, sample_name=sample_name
+    # Small samples run the post-assembly stages in one task
+    fused = choose_fused_mode(sample=sample, fuse_below_bytes=fuse_below_bytes)
+
+    (
+        kaiju2table,
+        krona_plot,
+        assembly_report,
+        metassembly_results,
+        binning_results,
+        filter_report,
+        prodigal_results,
+        macrel_results,
+        fargene_results,
+        gecco_results,
+        updated_macrel_cache,
+        updated_fargene_cache,
+    ) = (
+        create_conditional_section("duplicate_sample")
+        .if_(is_duplicate.is_true())
+        .then(reuse_duplicate_results(duplicate_of=duplicate_of))
+        .else_()
+        .then(
+            analysis_wf(
+                read_dir=unaligned,
+                kaiju_ref_db=kaiju_ref_db,
+                kaiju_ref_nodes=kaiju_ref_nodes,
+                kaiju_ref_names=kaiju_ref_names,
+                sample_name=sample_name,
+                taxon_rank=taxon_rank,
+                min_read_pairs=min_read_pairs,
+                min_count=min_count,
+                k_min=k_min,
+                k_max=k_max,
+                k_step=k_step,
+                min_contig_len=min_contig_len,
+                run_metaquast=run_metaquast,
+                metaquast_min_contig=metaquast_min_contig,
+                min_contigs=min_contigs,
+                min_assembly_bases=min_assembly_bases,
+                prodigal_output_format=prodigal_output_format,
+                fargene_hmm_model=fargene_hmm_model,
+                prodigal_min_len=prodigal_min_len,
+                macrel_min_len=macrel_min_len,
+                fargene_min_len=fargene_min_len,
+                gecco_min_len=gecco_min_len,
+                macrel_cache=macrel_cache,
+                fargene_cache=fargene_cache,
+                annotation_chunk_bases=annotation_chunk_bases,
+                metabat_sweep=metabat_sweep,
+                fused=fused,
+                disk_budget=disk_budget,
+                pack_bins=pack_bins,
+            )
+        )
     )
 
-    prodigal_results, macrel_results, fargene_results, gecco_results = functional_wf(
-        assembly_dir=assembly_dir,
+    sample_abundance = abundance_matrices(
+        kaiju_table=kaiju2table,
         sample_name=sample_name,
-        prodigal_output_format=prodigal_output_format,
-        fargene_hmm_model=fargene_hmm_model,
     )
 
     return [
+        kaiju_preview,
+        sketch_results,
         kaiju2table,
         krona_plot,
+        assembly_report,
         metassembly_results,
         binning_results,
+        filter_report,
         prodigal_results,
         macrel_results,
         fargene_results,
         gecco_results,
+        updated_macrel_cache,
+        updated_fargene_cache,
+        sample_abundance,
     ]
 
 
@@ -228,13 +422,30 @@ LaunchPlan(
         "kaiju_ref_nodes": LatchFile("s3://latch-public/test-data/4318/nodes.dmp"),
         "kaiju_ref_names": LatchFile("s3://latch-public/test-data/4318/names.dmp"),
         "sample_name": "SRR579292",
+        "host_removal_chunk_size": 0,
+        "preview_read_pairs": 100_000,
+        "duplicate_jaccard": 0.95,
+        "skip_duplicates": True,
         "taxon_rank": TaxonRank.species,
+        "min_read_pairs": 10_000,
         "min_count": 2,
         "k_min": 21,
         "k_max": 141,
         "k_step": 12,
         "min_contig_len": 200,
+        "run_metaquast": False,
+        "metaquast_min_contig": 500,
+        "min_contigs": 10,
+        "min_assembly_bases": 100_000,
         "prodigal_output_format": ProdigalOutput.gff,
         "fargene_hmm_model": fARGeneModel.class_b_1_2,
+        "prodigal_min_len": 200,
+        "macrel_min_len": 200,
+        "fargene_min_len": 500,
+        "gecco_min_len": 1000,
+        "annotation_chunk_bases": 100_000_000,
+        "fuse_below_bytes": 2_000_000_000,
+        "disk_budget": False,
+        "pack_bins": False,
     },
 )
@@ -0,0 +1,323 @@
+"""
+Cohort taxa x samples abundance matrices built from Kaiju tables
+
+Every sample's kaiju2table output (with full lineages, `-p`) is streamed
+once and its read counts are added to one sparse matrix per taxonomic
+rank, from superkingdom down to the rank of the table. Taxa are mapped to
+integer ids through a dictionary shared by the whole cohort, and each
+matrix is stored column by column (compressed sparse columns) in raw
+binary files, with relative abundances next to the counts:
+
+    {index}/{rank}/taxa.tsv         taxon id, lineage
+    {index}/{rank}/samples.tsv      column, sample, total reads
+    {index}/{rank}/indptr.i8        start of every column in the arrays below
+    {index}/{rank}/indices.u4       taxon ids
+    {index}/{rank}/counts.u4        read counts
+    {index}/{rank}/relative.f4      counts / total reads of the sample
+
+Adding a sample only appends to these files, the existing matrix is never
+rewritten. A resubmitted sample gets a new column, and readers use the
+latest column of every sample.
+
+The samples of a cohort run in parallel, so each publishes matrices of
+its own under latch:///metamage/{sample}/abundance_matrices/. They are
+appended to a cohort index, along with the tables of earlier runs, with:
+
+    python -m wf.abundance --index DIR sample_a/abundance_matrices b_kaiju.tsv
+
+Coarser ranks are derived from the lineages of the table, so reads Kaiju
+only classified above the table's rank are "unassigned" at every rank.
+"""
+
+import argparse
+import json
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+from latch import message, small_task
+from latch.types import LatchDir, LatchFile
+
+from .types import TaxonRank
+
+# Depth of each rank in a Kaiju lineage
+RANKS = list(TaxonRank)
+
+UNCLASSIFIED = "unclassified"
+UNASSIGNED = "unassigned"
+
+_ARRAYS = {
+    "indices": ("indices.u4", np.uint32),
+    "counts": ("counts.u4", np.uint32),
+    "relative": ("relative.f4", np.float32),
+}
+
+
+def read_kaiju_table(path: Path) -> Iterator[Tuple[List[str], int]]:
+    """Stream the (lineage, reads) rows of a kaiju2table -p output
+
+    The lineage of unclassified reads is ["unclassified"], and that of
+    reads Kaiju couldn't assign at the table's rank is empty.
+    """
+
+    with open(path) as f:
+        next(f, None)
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 5:
+                continue
+            reads, name = int(fields[2]), fields[4]
+            if name == UNCLASSIFIED:
+                yield [UNCLASSIFIED], reads
+            elif ";" in name:
+                yield name.rstrip(";").split(";"), reads
+            else:
+                yield [], reads
+
+
+def rank_counts(
+    rows: Iterator[Tuple[List[str], int]],
+) -> Tuple[Dict[TaxonRank, Dict[str, int]], int]:
+    """Aggregate table rows to every rank their lineages reach"""
+
+    counts: Dict[TaxonRank, Dict[str, int]] = {}
+    total = 0
+    depth = 0
+    for lineage, reads in rows:
+        total += reads
+        if lineage != [UNCLASSIFIED]:
+            depth = max(depth, len(lineage))
+        for i, rank in enumerate(RANKS):
+            if lineage == [UNCLASSIFIED]:
+                key = UNCLASSIFIED
+            elif i < len(lineage) and lineage[i] != "NA":
+                key = ";".join(lineage[: i + 1])
+            else:
+                key = UNASSIGNED
+            rank_rows = counts.setdefault(rank, {})
+            rank_rows[key] = rank_rows.get(key, 0) + reads
+
+    # Ranks finer than the table's have no meaningful counts
+    return {rank: counts.get(rank, {}) for rank in RANKS[: depth or len(RANKS)]}, total
+
+
+class AbundanceMatrix:
+    """Append-only sparse taxa x samples matrix of one rank"""
+
+    def __init__(self, root: Path, rank: TaxonRank):
+        self.root = root.joinpath(rank.value)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.rank = rank
+
+        self.taxa: List[str] = []
+        self.taxon_ids: Dict[str, int] = {}
+        taxa_file = self.root.joinpath("taxa.tsv")
+        if taxa_file.exists():
+            with open(taxa_file) as f:
+                for line in f:
+                    _, name = line.rstrip("\n").split("\t", 1)
+                    self.taxon_ids[name] = len(self.taxa)
+                    self.taxa.append(name)
+
+        self.columns: List[Tuple[str, int]] = []
+        samples_file = self.root.joinpath("samples.tsv")
+        if samples_file.exists():
+            with open(samples_file) as f:
+                for line in f:
+                    _, sample, total = line.rstrip("\n").split("\t")
+                    self.columns.append((sample, int(total)))
+
+        indptr_file = self.root.joinpath("indptr.i8")
+        self.indptr = (
+            np.fromfile(indptr_file, dtype=np.int64)
+            if indptr_file.exists()
+            else np.zeros(1, dtype=np.int64)
+        )
+        # Columns whose append was interrupted are dropped
+        if len(self.columns) > self.indptr.size - 1:
+            self.columns = self.columns[: self.indptr.size - 1]
+            with open(samples_file, "w") as f:
+                for column, (sample, total) in enumerate(self.columns):
+                    f.write(f"{column}\t{sample}\t{total}\n")
+
+    def _array(self, name: str) -> np.ndarray:
+        file_name, dtype = _ARRAYS[name]
+        path = self.root.joinpath(file_name)
+        if not self.indptr[-1]:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode="r", shape=(int(self.indptr[-1]),))
+
+    def append(self, sample: str, counts: Dict[str, int], total: int):
+        """Add one sample as a new column, appending to the stored arrays"""
+
+        new_taxa = [name for name in counts if name not in self.taxon_ids]
+        with open(self.root.joinpath("taxa.tsv"), "a") as f:
+            for name in new_taxa:
+                self.taxon_ids[name] = len(self.taxa)
+                self.taxa.append(name)
+                f.write(f"{self.taxon_ids[name]}\t{name}\n")
+
+        ids = np.fromiter((self.taxon_ids[name] for name in counts), dtype=np.uint32)
+        values = np.fromiter(counts.values(), dtype=np.int64)
+        order = np.argsort(ids)
+        if values.size and values.max() > np.iinfo(np.uint32).max:
+            raise ValueError(f"{sample} has more reads in a taxon than fit in uint32")
+        arrays = {
+            "indices": ids[order],
+            "counts": values[order].astype(np.uint32),
+            "relative": (values[order] / max(total, 1)).astype(np.float32),
+        }
+
+        end = int(self.indptr[-1])
+        for name, (file_name, dtype) in _ARRAYS.items():
+            path = self.root.joinpath(file_name)
+            with open(path, "ab") as f:
+                # Drop the tail of an interrupted append before extending
+                f.truncate(end * np.dtype(dtype).itemsize)
+                arrays[name].astype(dtype).tofile(f)
+
+        with open(self.root.joinpath("samples.tsv"), "a") as f:
+            f.write(f"{len(self.columns)}\t{sample}\t{total}\n")
+        self.columns.append((sample, total))
+
+        self.indptr = np.append(self.indptr, end + ids.size)
+        with open(self.root.joinpath("indptr.i8"), "ab") as f:
+            if self.indptr.size == 2:
+                self.indptr[:1].tofile(f)
+            self.indptr[-1:].tofile(f)
+
+        with open(self.root.joinpath("matrix.json"), "w") as f:
+            json.dump(
+                {
+                    "rank": self.rank.value,
+                    "taxa": len(self.taxa),
+                    "columns": len(self.columns),
+                    "samples": len(self.samples()),
+                    "nonzero": int(self.indptr[-1]),
+                },
+                f,
+                indent=2,
+            )
+
+    def samples(self) -> Dict[str, int]:
+        """Latest column of every sample"""
+
+        return {sample: column for column, (sample, _) in enumerate(self.columns)}
+
+    def column(self, sample: str, relative: bool = False) -> Dict[str, float]:
+        """Counts (or relative abundances) of one sample by lineage"""
+
+        column = self.samples()[sample]
+        start, end = self.indptr[column], self.indptr[column + 1]
+        values = self._array("relative" if relative else "counts")[start:end]
+        ids = self._array("indices")[start:end]
+        return {self.taxa[i]: value.item() for i, value in zip(ids, values)}
+
+    def to_scipy(self, relative: bool = False):
+        """The matrix as a scipy.sparse CSC matrix, one column per sample
+
+        Returns the matrix, the taxa (rows) and the samples (columns).
+        """
+
+        from scipy.sparse import csc_matrix
+
+        samples = self.samples()
+        columns = list(samples.values())
+        values = self._array("relative" if relative else "counts")
+        matrix = csc_matrix(
+            (values, self._array("indices"), self.indptr),
+            shape=(len(self.taxa), len(self.columns)),
+        )
+        return matrix[:, columns], list(self.taxa), list(samples)
+
+
+def add_sample(
+    root: Path,
+    sample: str,
+    kaiju_table: Path,
+    matrices: Optional[Dict[TaxonRank, AbundanceMatrix]] = None,
+) -> Dict[str, int]:
+    """Stream a Kaiju table into the matrix of every rank it covers
+
+    `matrices` keeps the matrices open between samples. Returns the number
+    of taxa of the sample at each rank.
+    """
+
+    matrices = {} if matrices is None else matrices
+    counts, total = rank_counts(read_kaiju_table(kaiju_table))
+    for rank, rank_rows in counts.items():
+        if rank not in matrices:
+            matrices[rank] = AbundanceMatrix(root, rank)
+        matrices[rank].append(sample, rank_rows, total)
+    return {rank.value: len(rank_rows) for rank, rank_rows in counts.items()}
+
+
+def add_matrices(
+    root: Path,
+    source: Path,
+    matrices: Optional[Dict[TaxonRank, AbundanceMatrix]] = None,
+) -> Dict[str, Dict[str, int]]:
+    """Append the latest column of every sample of another index
+
+    Returns the number of taxa of each sample at each rank.
+    """
+
+    matrices = {} if matrices is None else matrices
+    taxa: Dict[str, Dict[str, int]] = {}
+    for rank in RANKS:
+        if not source.joinpath(rank.value, "indptr.i8").exists():
+            continue
+        source_matrix = AbundanceMatrix(source, rank)
+        if rank not in matrices:
+            matrices[rank] = AbundanceMatrix(root, rank)
+        for sample, column in source_matrix.samples().items():
+            counts = source_matrix.column(sample)
+            matrices[rank].append(sample, counts, source_matrix.columns[column][1])
+            taxa.setdefault(sample, {})[rank.value] = len(counts)
+    return taxa
+
+
+@small_task
+def abundance_matrices(kaiju_table: LatchFile, sample_name: str) -> LatchDir:
+    """Abundance matrices of the sample's Kaiju table, to merge into the cohort's"""
+
+    output_dir_name = "abundance_matrices"
+    root = Path(output_dir_name).resolve()
+
+    taxa = add_sample(root, sample_name, Path(kaiju_table.local_path))
+    message(
+        "info",
+        {
+            "title": "Built the sample's abundance matrices",
+            "body": ", ".join(f"{rank}: {n} taxa" for rank, n in taxa.items()),
+        },
+    )
+
+    return LatchDir(str(root), f"latch:///metamage/{sample_name}/{output_dir_name}")
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--index", required=True, type=Path)
+    parser.add_argument(
+        "inputs",
+        nargs="+",
+        type=Path,
+        help="abundance_matrices directories of samples, or {sample}_kaiju.tsv "
+        "files, to append",
+    )
+    args = parser.parse_args(argv)
+
+    matrices = {}
+    for path in args.inputs:
+        if path.is_dir():
+            samples = add_matrices(args.index, path, matrices)
+        else:
+            sample = path.name.replace("_kaiju.tsv", "")
+            samples = {sample: add_sample(args.index, sample, path, matrices)}
+        for sample, taxa in samples.items():
+            print(f"{sample}\t" + "\t".join(f"{r}={n}" for r, n in taxa.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,444 @@
+"""
+Analysis of host-removed reads, and reuse of the results of duplicate samples
+
+Assembly, binning and annotation are gated by checks on the data they
+receive (see gating.py), so a sample with too few reads or contigs only
+runs the stages that can still produce something. Small samples run the
+post-assembly stages in fused mode (see fused.py).
+"""
+
+from typing import Optional, Tuple
+
+from latch import create_conditional_section, small_task, workflow
+from latch.types import LatchDir, LatchFile
+
+from .binning import binning_wf
+from .functional import functional_wf
+from .fused import fused_contig_analysis
+from .gating import (
+    check_assembly,
+    check_reads,
+    skip_assembly_analysis,
+    skip_contig_analysis,
+)
+from .kaiju import kaiju_wf
+from .metassembly import assembly_wf, metaquast, skip_metaquast
+from .types import MetabatSweep, ProdigalOutput, TaxonRank, fARGeneModel
+
+ContigResults = Tuple[
+    Optional[LatchDir],
+    LatchDir,
+    LatchFile,
+    LatchDir,
+    LatchDir,
+    LatchDir,
+    LatchDir,
+    LatchFile,
+    LatchFile,
+]
+
+AnalysisResults = Tuple[
+    LatchFile,
+    LatchFile,
+    LatchDir,
+    Optional[LatchDir],
+    LatchDir,
+    LatchFile,
+    LatchDir,
+    LatchDir,
+    LatchDir,
+    LatchDir,
+    LatchFile,
+    LatchFile,
+]
+
+
+def result_paths(sample_name: str) -> Tuple[str, ...]:
+    """Remote paths of the outputs of `analysis_wf`, in order"""
+
+    root = f"latch:///metamage/{sample_name}"
+    return (
+        f"{root}/kaiju/{sample_name}_kaiju.tsv",
+        f"{root}/kaiju/{sample_name}_krona.html",
+        f"{root}/assembly_stats",
+        f"{root}/MetaQuast",
+        f"{root}/METABAT",
+        f"{root}/filtered_contigs/{sample_name}_filter_report.tsv",
+        f"{root}/prodigal_results",
+        f"{root}/macrel_results",
+        f"{root}/fargene_results",
+        f"{root}/gecco_results",
+        f"{root}/annotation_cache/macrel.sqlite",
+        f"{root}/annotation_cache/fargene.sqlite",
+    )
+
+
+def _remote_exists(path: str) -> bool:
+    from latch.ldata.path import LPath
+
+    try:
+        return LPath(path).exists()
+    except Exception:
+        return False
+
+
+def results_available(sample_name: str) -> bool:
+    """Whether every output of a previous analysis can still be reused
+
+    MetaQuast is optional, its directory is not required.
+    """
+
+    paths = result_paths(sample_name)
+    return all(_remote_exists(path) for i, path in enumerate(paths) if i != 3)
+
+
+@small_task
+def reuse_duplicate_results(duplicate_of: str) -> AnalysisResults:
+    """Point the outputs of a duplicate sample at the results of the original"""
+
+    outputs = []
+    for output_type, path in zip(AnalysisResults.__args__, result_paths(duplicate_of)):
+        if output_type == Optional[LatchDir]:
+            # The original may have run without MetaQuast
+            outputs.append(LatchDir(path) if _remote_exists(path) else None)
+        else:
+            outputs.append(output_type(path))
+    return tuple(outputs)
+
+
+@workflow
+def contig_analysis_wf(
+    read_dir: LatchDir,
+    assembly_dir: LatchDir,
+    sample_name: str,
+    run_metaquast: bool,
+    metaquast_min_contig: int,
+    prodigal_output_format: ProdigalOutput,
+    fargene_hmm_model: fARGeneModel,
+    prodigal_min_len: int,
+    macrel_min_len: int,
+    fargene_min_len: int,
+    gecco_min_len: int,
+    macrel_cache: Optional[LatchFile],
+    fargene_cache: Optional[LatchFile],
+    annotation_chunk_bases: int,
+    metabat_sweep: Optional[MetabatSweep],
+    disk_budget: bool,
+    pack_bins: bool,
+) -> ContigResults:
+
+    # Assembly evaluation, without starting a task when it is off
+    metassembly_results = (
+        create_conditional_section("run_metaquast")
+        .if_(run_metaquast.is_false())
+        .then(skip_metaquast())
+        .else_()
+        .then(
+            metaquast(
+                assembly_dir=assembly_dir,
+                sample_name=sample_name,
+                run_metaquast=run_metaquast,
+                metaquast_min_contig=metaquast_min_contig,
+            )
+        )
+    )
+
+    # Binning
+    binning_results = binning_wf(
+        read_dir=read_dir,
+        assembly_dir=assembly_dir,
+        sample_name=sample_name,
+        metabat_sweep=metabat_sweep,
+        disk_budget=disk_budget,
+        pack_bins=pack_bins,
+    )
+
+    (
+        prodigal_results,
+        macrel_results,
+        fargene_results,
+        gecco_results,
+        filter_report,
+        updated_macrel_cache,
+        updated_fargene_cache,
+    ) = functional_wf(
+        assembly_dir=assembly_dir,
+        sample_name=sample_name,
+        prodigal_output_format=prodigal_output_format,
+        fargene_hmm_model=fargene_hmm_model,
+        prodigal_min_len=prodigal_min_len,
+        macrel_min_len=macrel_min_len,
+        fargene_min_len=fargene_min_len,
+        gecco_min_len=gecco_min_len,
+        macrel_cache=macrel_cache,
+        fargene_cache=fargene_cache,
+        annotation_chunk_bases=annotation_chunk_bases,
+    )
+
+    return (
+        metassembly_results,
+        binning_results,
+        filter_report,
+        prodigal_results,
+        macrel_results,
+        fargene_results,
+        gecco_results,
+        updated_macrel_cache,
+        updated_fargene_cache,
+    )
+
+
+@workflow
+def assembly_analysis_wf(
+    read_dir: LatchDir,
+    sample_name: str,
+    min_count: int,
+    k_min: int,
+    k_max: int,
+    k_step: int,
+    min_contig_len: int,
+    run_metaquast: bool,
+    metaquast_min_contig: int,
+    min_contigs: int,
+    min_assembly_bases: int,
+    prodigal_output_format: ProdigalOutput,
+    fargene_hmm_model: fARGeneModel,
+    prodigal_min_len: int,
+    macrel_min_len: int,
+    fargene_min_len: int,
+    gecco_min_len: int,
+    macrel_cache: Optional[LatchFile],
+    fargene_cache: Optional[LatchFile],
+    annotation_chunk_bases: int,
+    metabat_sweep: Optional[MetabatSweep],
+    disk_budget: bool,
+    pack_bins: bool,
+    fused: bool,
+) -> Tuple[
+    LatchDir,
+    Optional[LatchDir],
+    LatchDir,
+    LatchFile,
+    LatchDir,
+    LatchDir,
+    LatchDir,
+    LatchDir,
+    LatchFile,
+    LatchFile,
+]:
+
+    assembly_dir, assembly_report = assembly_wf(
+        read_dir=read_dir,
+        sample_name=sample_name,
+        min_count=min_count,
+        k_min=k_min,
+        k_max=k_max,
+        k_step=k_step,
+        min_contig_len=min_contig_len,
+        disk_budget=disk_budget,
+    )
+
+    # Evaluation, binning and annotation only run on a large enough assembly,
+    # in a single task for small samples
+    assembly_check, enough_contigs = check_assembly(
+        assembly_report=assembly_report,
+        sample_name=sample_name,
+        min_contigs=min_contigs,
+        min_assembly_bases=min_assembly_bases,
+    )
+    (
+        metassembly_results,
+        binning_results,
+        filter_report,
+        prodigal_results,
+        macrel_results,
+        fargene_results,
+        gecco_results,
+        updated_macrel_cache,
+        updated_fargene_cache,
+    ) = (
+        create_conditional_section("enough_contigs")
+        .if_(enough_contigs.is_false())
+        .then(
+            skip_contig_analysis(
+                assembly_check=assembly_check,
+                sample_name=sample_name,
+                macrel_cache=macrel_cache,
+                fargene_cache=fargene_cache,
+            )
+        )
+        .elif_(fused.is_true())
+        .then(
+            fused_contig_analysis(
+                read_dir=read_dir,
+                assembly_dir=assembly_dir,
+                sample_name=sample_name,
+                run_metaquast=run_metaquast,
+                metaquast_min_contig=metaquast_min_contig,
+                prodigal_output_format=prodigal_output_format,
+                fargene_hmm_model=fargene_hmm_model,
+                prodigal_min_len=prodigal_min_len,
+                macrel_min_len=macrel_min_len,
+                fargene_min_len=fargene_min_len,
+                gecco_min_len=gecco_min_len,
+                macrel_cache=macrel_cache,
+                fargene_cache=fargene_cache,
+                annotation_chunk_bases=annotation_chunk_bases,
+                metabat_sweep=metabat_sweep,
+                disk_budget=disk_budget,
+                pack_bins=pack_bins,
+            )
+        )
+        .else_()
+        .then(
+            contig_analysis_wf(
+                read_dir=read_dir,
+                assembly_dir=assembly_dir,
+                sample_name=sample_name,
+                run_metaquast=run_metaquast,
+                metaquast_min_contig=metaquast_min_contig,
+                prodigal_output_format=prodigal_output_format,
+                fargene_hmm_model=fargene_hmm_model,
+                prodigal_min_len=prodigal_min_len,
+                macrel_min_len=macrel_min_len,
+                fargene_min_len=fargene_min_len,
+                gecco_min_len=gecco_min_len,
+                macrel_cache=macrel_cache,
+                fargene_cache=fargene_cache,
+                annotation_chunk_bases=annotation_chunk_bases,
+                metabat_sweep=metabat_sweep,
+                disk_budget=disk_budget,
+                pack_bins=pack_bins,
+            )
+        )
+    )
+
+    return (
+        assembly_report,
+        metassembly_results,
+        binning_results,
+        filter_report,
+        prodigal_results,
+        macrel_results,
+        fargene_results,
+        gecco_results,
+        updated_macrel_cache,
+        updated_fargene_cache,
+    )
+
+
+@workflow
+def analysis_wf(
+    read_dir: LatchDir,
+    kaiju_ref_db: LatchFile,
+    kaiju_ref_nodes: LatchFile,
+    kaiju_ref_names: LatchFile,
+    sample_name: str,
+    taxon_rank: TaxonRank,
+    min_read_pairs: int,
+    min_count: int,
+    k_min: int,
+    k_max: int,
+    k_step: int,
+    min_contig_len: int,
+    run_metaquast: bool,
+    metaquast_min_contig: int,
+    min_contigs: int,
+    min_assembly_bases: int,
+    prodigal_output_format: ProdigalOutput,
+    fargene_hmm_model: fARGeneModel,
+    prodigal_min_len: int,
+    macrel_min_len: int,
+    fargene_min_len: int,
+    gecco_min_len: int,
+    macrel_cache: Optional[LatchFile],
+    fargene_cache: Optional[LatchFile],
+    annotation_chunk_bases: int,
+    metabat_sweep: Optional[MetabatSweep],
+    disk_budget: bool,
+    pack_bins: bool,
+    fused: bool,
+) -> AnalysisResults:
+
+    # Kaiju taxonomic classification
+    kaiju2table, krona_plot = kaiju_wf(
+        read_dir=read_dir,
+        kaiju_ref_db=kaiju_ref_db,
+        kaiju_ref_nodes=kaiju_ref_nodes,
+        kaiju_ref_names=kaiju_ref_names,
+        sample_name=sample_name,
+        taxon_rank=taxon_rank,
+        fused=fused,
+    )
+
+    # With too few reads left only the taxonomic classification is run
+    read_check, enough_reads = check_reads(
+        read_dir=read_dir, sample_name=sample_name, min_read_pairs=min_read_pairs
+    )
+    (
+        assembly_report,
+        metassembly_results,
+        binning_results,
+        filter_report,
+        prodigal_results,
+        macrel_results,
+        fargene_results,
+        gecco_results,
+        updated_macrel_cache,
+        updated_fargene_cache,
+    ) = (
+        create_conditional_section("enough_reads")
+        .if_(enough_reads.is_true())
+        .then(
+            assembly_analysis_wf(
+                read_dir=read_dir,
+                sample_name=sample_name,
+                min_count=min_count,
+                k_min=k_min,
+                k_max=k_max,
+                k_step=k_step,
+                min_contig_len=min_contig_len,
+                run_metaquast=run_metaquast,
+                metaquast_min_contig=metaquast_min_contig,
+                min_contigs=min_contigs,
+                min_assembly_bases=min_assembly_bases,
+                prodigal_output_format=prodigal_output_format,
+                fargene_hmm_model=fargene_hmm_model,
+                prodigal_min_len=prodigal_min_len,
+                macrel_min_len=macrel_min_len,
+                fargene_min_len=fargene_min_len,
+                gecco_min_len=gecco_min_len,
+                macrel_cache=macrel_cache,
+                fargene_cache=fargene_cache,
+                annotation_chunk_bases=annotation_chunk_bases,
+                metabat_sweep=metabat_sweep,
+                disk_budget=disk_budget,
+                pack_bins=pack_bins,
+                fused=fused,
+            )
+        )
+        .else_()
+        .then(
+            skip_assembly_analysis(
+                read_check=read_check,
+                sample_name=sample_name,
+                macrel_cache=macrel_cache,
+                fargene_cache=fargene_cache,
+            )
+        )
+    )
+
+    return (
+        kaiju2table,
+        krona_plot,
+        assembly_report,
+        metassembly_results,
+        binning_results,
+        filter_report,
+        prodigal_results,
+        macrel_results,
+        fargene_results,
+        gecco_results,
+        updated_macrel_cache,
+        updated_fargene_cache,
+    )
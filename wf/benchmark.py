@@ -0,0 +1,633 @@
+"""
+Thread-scaling benchmark of the wrapped tools
+
+Every command builder of the workflow is run on a fixed dataset across a
+sweep of thread counts, and the speedup t(1)/t(n) and parallel efficiency
+speedup/n of each tool are recorded. The recommended thread count of a
+tool on a node is the smallest count reaching KNEE_FRACTION of the best
+speedup measured with at most the node's CPUs: past that knee, threads
+are better left to other jobs on the node.
+
+The curves and recommendations, per node size, are merged into the thread
+profile read by the tasks at runtime (see threads.py):
+
+    python -m wf.benchmark --tools-dir /root --threads 1 2 4 8 16 31
+
+The dataset is synthetic by default: a host genome, a community of
+genomes of different GC and abundance, read pairs simulated from both with
+sequencing errors, and random proteins and peptides for the annotation
+tools. It is generated from a fixed seed so that runs are comparable.
+--fixture points at a directory of real files with the same names instead
+(reads_1.fastq.gz, reads_2.fastq.gz, host.fa, contigs.fa, proteins.faa,
+peptides.faa). Kaiju only runs when a database is given.
+"""
+
+import argparse
+import datetime
+import gzip
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import time
+from dataclasses import dataclass
+from functools import cached_property
+from pathlib import Path
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+import numpy as np
+
+from .binning import (
+    build_assembly_align_cmd,
+    build_bam_sort_cmd,
+    build_metabat_cmd,
+    build_sam_to_bam_cmd,
+)
+from .bowtie import LARGE_TASK_CPUS, build_bowtie_index_cmd
+from .functional_module.amp import build_macrel_peptides_cmd
+from .functional_module.arg import build_fargene_cmd
+from .functional_module.bgc import build_gecco_cmd
+from .host_removal import build_fastp_cmd, build_host_mapping_cmd
+from .kaiju import build_kaiju_cmd
+from .metassembly import build_megahit_cmd
+from .seqio import write_fasta
+from .threads import PROFILE_PATH, PROFILE_VERSION, node_cpus
+from .types import fARGeneModel
+
+KNEE_FRACTION = 0.9
+
+# CPUs of the small_task and large_task nodes
+NODE_SIZES = (2, LARGE_TASK_CPUS)
+
+_ACGT = np.frombuffer(b"ACGT", dtype=np.uint8)
+_AMINO_ACIDS = np.frombuffer(b"ACDEFGHIKLMNPQRSTVWY", dtype=np.uint8)
+_COMPLEMENT = np.arange(256, dtype=np.uint8)
+_COMPLEMENT[np.frombuffer(b"ACGT", dtype=np.uint8)] = np.frombuffer(
+    b"TGCA", dtype=np.uint8
+)
+
+
+def _random_sequence(
+    rng: np.random.Generator, length: int, gc: float = 0.5
+) -> np.ndarray:
+    at, cg = (1 - gc) / 2, gc / 2
+    return rng.choice(_ACGT, size=length, p=[at, cg, cg, at])
+
+
+def _write_fasta(path: Path, records: Dict[str, np.ndarray]):
+    with open(path, "wb") as f:
+        for name, sequence in records.items():
+            write_fasta(f, name.encode(), sequence.tobytes())
+
+
+def _write_read_pairs(
+    rng: np.random.Generator,
+    genomes: List[np.ndarray],
+    weights: np.ndarray,
+    read_pairs: int,
+    read1: Path,
+    read2: Path,
+    read_length: int = 150,
+    insert_size: int = 300,
+    error_rate: float = 0.005,
+):
+    """Simulate read pairs from genomes in proportion to their weights"""
+
+    source = rng.choice(len(genomes), size=read_pairs, p=weights / weights.sum())
+    offsets = np.arange(read_length)
+    quality = b"I" * read_length
+    with gzip.open(read1, "wb", compresslevel=1) as out1, gzip.open(
+        read2, "wb", compresslevel=1
+    ) as out2:
+        for g, genome in enumerate(genomes):
+            starts = rng.integers(
+                0, genome.size - insert_size, size=(source == g).sum()
+            )
+            mates1 = genome[starts[:, None] + offsets]
+            mates2 = _COMPLEMENT[
+                genome[starts[:, None] + insert_size - read_length + offsets]
+            ][:, ::-1]
+            for mates in (mates1, mates2):
+                errors = rng.random(mates.shape) < error_rate
+                mates[errors] = rng.choice(_ACGT, size=errors.sum())
+            for i, (mate1, mate2) in enumerate(zip(mates1, mates2)):
+                name = f"@g{g}_{i}".encode()
+                out1.write(
+                    name + b"/1\n" + mate1.tobytes() + b"\n+\n" + quality + b"\n"
+                )
+                out2.write(
+                    name + b"/2\n" + mate2.tobytes() + b"\n+\n" + quality + b"\n"
+                )
+
+
+def write_synthetic_dataset(root: Path, read_pairs: int, seed: int = 0):
+    """Host genome, community contigs, reads, proteins and peptides"""
+
+    rng = np.random.default_rng(seed)
+    root.mkdir(parents=True, exist_ok=True)
+
+    host = _random_sequence(rng, 5_000_000, gc=0.41)
+    _write_fasta(root.joinpath("host.fa"), {"host": host})
+
+    community = [
+        _random_sequence(rng, 250_000, gc=gc) for gc in np.linspace(0.3, 0.7, 12)
+    ]
+    contigs = {}
+    for g, genome in enumerate(community):
+        cuts = np.cumsum(rng.integers(5_000, 60_000, size=genome.size // 5_000))
+        cuts = np.concatenate([[0], cuts[cuts < genome.size], [genome.size]])
+        for c, (start, end) in enumerate(zip(cuts[:-1], cuts[1:])):
+            contigs[f"g{g}_contig{c}"] = genome[start:end]
+    _write_fasta(root.joinpath("contigs.fa"), contigs)
+
+    # A fifth of the reads are host reads, the community is log-normal
+    abundances = rng.lognormal(0, 1, size=len(community))
+    weights = np.concatenate([[0.2], 0.8 * abundances / abundances.sum()])
+    _write_read_pairs(
+        rng,
+        [host, *community],
+        weights,
+        read_pairs,
+        root.joinpath("reads_1.fastq.gz"),
+        root.joinpath("reads_2.fastq.gz"),
+    )
+
+    _write_fasta(
+        root.joinpath("proteins.faa"),
+        {
+            f"protein{i}": rng.choice(_AMINO_ACIDS, size=rng.integers(100, 500))
+            for i in range(5_000)
+        },
+    )
+    _write_fasta(
+        root.joinpath("peptides.faa"),
+        {
+            f"peptide{i}": rng.choice(_AMINO_ACIDS, size=rng.integers(10, 100))
+            for i in range(50_000)
+        },
+    )
+
+
+class Dataset:
+    """The benchmark inputs, and the intermediates some tools start from
+
+    Intermediates (indexes, alignments, depths) are built once, with every
+    CPU, before the tools reading them are timed.
+    """
+
+    def __init__(
+        self,
+        root: Path,
+        fixture: Optional[Path],
+        read_pairs: int,
+        seed: int,
+        kaiju_db: Optional[Path],
+        kaiju_nodes: Optional[Path],
+        tools_dir: Optional[Path],
+    ):
+        self.root = root.joinpath("dataset")
+        self.root.mkdir(parents=True, exist_ok=True)
+        _link_tools(self.root, tools_dir)
+        self.fixture = fixture
+        self.read_pairs = read_pairs
+        self.seed = seed
+        self.kaiju_db = kaiju_db
+        self.kaiju_nodes = kaiju_nodes
+        self.cpus = node_cpus()
+
+    def file(self, name: str) -> Path:
+        if self.fixture is not None and self.fixture.joinpath(name).exists():
+            return self.fixture.joinpath(name).resolve()
+        path = self.root.joinpath(name)
+        if not path.exists():
+            write_synthetic_dataset(self.root, self.read_pairs, self.seed)
+        return path
+
+    def description(self) -> str:
+        if self.fixture is not None:
+            return f"fixture {self.fixture.resolve()}"
+        return f"synthetic, {self.read_pairs} read pairs, seed {self.seed}"
+
+    def _run(self, cmd: List[str], stdin: Optional[Path] = None, stdout=None):
+        with open(stdin or os.devnull, "rb") as f_in:
+            subprocess.run(cmd, cwd=self.root, stdin=f_in, stdout=stdout, check=True)
+
+    @cached_property
+    def host_index(self) -> str:
+        prefix = str(self.root.joinpath("host_idx"))
+        self._run(build_bowtie_index_cmd(str(self.file("host.fa")), prefix, self.cpus))
+        return prefix
+
+    @cached_property
+    def contig_index(self) -> str:
+        prefix = str(self.root.joinpath("contigs_idx"))
+        self._run(
+            build_bowtie_index_cmd(str(self.file("contigs.fa")), prefix, self.cpus)
+        )
+        return prefix
+
+    @cached_property
+    def sam(self) -> Path:
+        sam = self.root.joinpath("contigs.sam")
+        with open(sam, "wb") as out:
+            self._run(
+                build_assembly_align_cmd(
+                    self.contig_index,
+                    str(self.file("reads_1.fastq.gz")),
+                    str(self.file("reads_2.fastq.gz")),
+                    self.cpus,
+                ),
+                stdout=out,
+            )
+        return sam
+
+    @cached_property
+    def bam(self) -> Path:
+        bam = self.root.joinpath("contigs.bam")
+        with open(bam, "wb") as out:
+            self._run(build_sam_to_bam_cmd(self.cpus), stdin=self.sam, stdout=out)
+        return bam
+
+    @cached_property
+    def depth(self) -> Path:
+        sorted_bam = self.root.joinpath("contigs_sorted.bam")
+        self._run(build_bam_sort_cmd(str(sorted_bam), threads=self.cpus), self.bam)
+        depth = self.root.joinpath("contigs_depths.txt")
+        self._run(
+            [
+                "jgi_summarize_bam_contig_depths",
+                "--outputDepth",
+                str(depth),
+                str(sorted_bam),
+            ]
+        )
+        return depth
+
+
+class Run(NamedTuple):
+    cmd: List[str]
+    stdin: Optional[Path] = None
+    stdout: Optional[Path] = None
+
+
+@dataclass
+class Benchmark:
+    """One tool: its command on the dataset at a thread count, in a run dir"""
+
+    tool: str
+    executable: str
+    run: Callable[[Dataset, Path, int], Run]
+    requires_kaiju: bool = False
+
+
+BENCHMARKS = [
+    Benchmark(
+        "fastp",
+        "/root/fastp",
+        lambda d, run_dir, threads: Run(
+            build_fastp_cmd(
+                str(d.file("reads_1.fastq.gz")),
+                str(d.file("reads_2.fastq.gz")),
+                str(run_dir.joinpath("bench")),
+                threads,
+            )
+        ),
+    ),
+    Benchmark(
+        "bowtie2-build",
+        "bowtie2/bowtie2-build",
+        lambda d, run_dir, threads: Run(
+            build_bowtie_index_cmd(
+                str(d.file("host.fa")), str(run_dir.joinpath("idx")), threads
+            )
+        ),
+    ),
+    Benchmark(
+        "bowtie2",
+        "bowtie2/bowtie2",
+        lambda d, run_dir, threads: Run(
+            build_host_mapping_cmd(
+                d.host_index,
+                str(d.file("reads_1.fastq.gz")),
+                str(d.file("reads_2.fastq.gz")),
+                str(run_dir.joinpath("unaligned.fastq.gz")),
+                threads,
+            )
+        ),
+    ),
+    Benchmark(
+        "samtools-view",
+        "samtools",
+        lambda d, run_dir, threads: Run(
+            build_sam_to_bam_cmd(threads), d.sam, run_dir.joinpath("out.bam")
+        ),
+    ),
+    Benchmark(
+        "samtools-sort",
+        "samtools",
+        lambda d, run_dir, threads: Run(
+            build_bam_sort_cmd(
+                str(run_dir.joinpath("sorted.bam")),
+                str(run_dir.joinpath("tmp")),
+                threads,
+            ),
+            d.bam,
+        ),
+    ),
+    Benchmark(
+        "kaiju",
+        "kaiju",
+        lambda d, run_dir, threads: Run(
+            build_kaiju_cmd(
+                str(d.kaiju_nodes),
+                str(d.kaiju_db),
+                str(d.file("reads_1.fastq.gz")),
+                str(d.file("reads_2.fastq.gz")),
+                str(run_dir.joinpath("kaiju.out")),
+                threads,
+            )
+        ),
+        requires_kaiju=True,
+    ),
+    Benchmark(
+        "megahit",
+        "/root/megahit",
+        lambda d, run_dir, threads: Run(
+            build_megahit_cmd(
+                str(d.file("reads_1.fastq.gz")),
+                str(d.file("reads_2.fastq.gz")),
+                str(run_dir.joinpath("MEGAHIT")),
+                "bench",
+                min_count=2,
+                k_min=21,
+                k_max=141,
+                k_step=12,
+                min_contig_len=200,
+                threads=threads,
+            )
+        ),
+    ),
+    Benchmark(
+        "metabat2",
+        "metabat2",
+        lambda d, run_dir, threads: Run(
+            build_metabat_cmd(
+                str(d.file("contigs.fa")),
+                str(d.depth),
+                str(run_dir.joinpath("bins", "bench")),
+                (2500, 200, 1),
+                threads,
+            )
+        ),
+    ),
+    Benchmark(
+        "macrel",
+        "macrel",
+        lambda d, run_dir, threads: Run(
+            build_macrel_peptides_cmd(
+                str(d.file("peptides.faa")),
+                str(run_dir.joinpath("peptides")),
+                "bench",
+                str(run_dir.joinpath("log.txt")),
+                threads,
+            )
+        ),
+    ),
+    Benchmark(
+        "fargene",
+        "fargene",
+        lambda d, run_dir, threads: Run(
+            build_fargene_cmd(
+                str(d.file("proteins.faa")),
+                fARGeneModel.class_a,
+                str(run_dir.joinpath("fargene")),
+                threads,
+            )
+        ),
+    ),
+    Benchmark(
+        "gecco",
+        "gecco",
+        lambda d, run_dir, threads: Run(
+            build_gecco_cmd(
+                str(d.file("contigs.fa")), str(run_dir.joinpath("gecco")), threads
+            )
+        ),
+    ),
+]
+
+
+def _link_tools(run_dir: Path, tools_dir: Optional[Path]):
+    """Make the bowtie2 installation reachable as the builders expect"""
+
+    link = run_dir.joinpath("bowtie2")
+    if tools_dir is not None and not link.exists():
+        link.symlink_to(tools_dir.joinpath("bowtie2"))
+
+
+def _available(executable: str, tools_dir: Optional[Path]) -> bool:
+    if executable.startswith("/"):
+        return Path(executable).exists()
+    if "/" in executable:
+        return Path(tools_dir or ".", executable).exists()
+    return shutil.which(executable) is not None
+
+
+def time_run(run: Run, run_dir: Path) -> float:
+    """Wall time of one command, started from its run directory"""
+
+    with open(run.stdin or os.devnull, "rb") as f_in, open(
+        run.stdout or os.devnull, "wb"
+    ) as f_out:
+        start = time.perf_counter()
+        subprocess.run(
+            run.cmd,
+            cwd=run_dir,
+            stdin=f_in,
+            stdout=f_out,
+            stderr=subprocess.DEVNULL,
+            check=True,
+        )
+        return time.perf_counter() - start
+
+
+def scaling_curve(seconds: Dict[int, float]) -> List[Dict[str, float]]:
+    """Speedup and parallel efficiency relative to the fewest threads"""
+
+    base_threads = min(seconds)
+    base = seconds[base_threads]
+    return [
+        {
+            "threads": threads,
+            "seconds": round(seconds[threads], 3),
+            "speedup": round(base / seconds[threads], 3),
+            "efficiency": round(base / seconds[threads] * base_threads / threads, 3),
+        }
+        for threads in sorted(seconds)
+    ]
+
+
+def recommend(
+    curve: List[Dict[str, float]], cpus: int, knee_fraction: float = KNEE_FRACTION
+) -> int:
+    """Fewest threads within `knee_fraction` of the best speedup on `cpus`"""
+
+    fitting = [row for row in curve if row["threads"] <= cpus] or curve[:1]
+    best = max(row["speedup"] for row in fitting)
+    return min(
+        row["threads"] for row in fitting if row["speedup"] >= knee_fraction * best
+    )
+
+
+def benchmark_tool(
+    benchmark: Benchmark,
+    dataset: Dataset,
+    workdir: Path,
+    thread_counts: List[int],
+    repeats: int,
+    tools_dir: Optional[Path],
+) -> Dict:
+    """Time a tool across the thread counts and recommend per node size"""
+
+    seconds = {}
+    for threads in thread_counts:
+        timings = []
+        for repeat in range(repeats):
+            run_dir = workdir.joinpath(benchmark.tool, f"t{threads}_r{repeat}")
+            shutil.rmtree(run_dir, ignore_errors=True)
+            run_dir.mkdir(parents=True)
+            _link_tools(run_dir, tools_dir)
+            try:
+                timings.append(
+                    time_run(benchmark.run(dataset, run_dir, threads), run_dir)
+                )
+            finally:
+                shutil.rmtree(run_dir, ignore_errors=True)
+        seconds[threads] = statistics.median(timings)
+
+    curve = scaling_curve(seconds)
+    node_sizes = sorted({*NODE_SIZES, dataset.cpus})
+    return {
+        "measured": {
+            "cpus": dataset.cpus,
+            "date": datetime.date.today().isoformat(),
+            "dataset": dataset.description(),
+            "repeats": repeats,
+        },
+        "curve": curve,
+        "recommended": {
+            str(size): recommend(curve, size)
+            for size in node_sizes
+            if size <= dataset.cpus
+        },
+    }
+
+
+def merge_profile(path: Path, results: Dict[str, Dict]):
+    """Replace the benchmarked tools in a profile, keeping the others"""
+
+    profile = {"version": PROFILE_VERSION, "tools": {}}
+    if path.exists():
+        with open(path) as f:
+            existing = json.load(f)
+        if existing.get("version") == PROFILE_VERSION:
+            profile = existing
+    profile["tools"].update(results)
+    profile["tools"] = dict(sorted(profile["tools"].items()))
+    with open(path, "w") as f:
+        json.dump(profile, f, indent=2)
+        f.write("\n")
+
+
+def _print_result(tool: str, result: Dict):
+    print(f"{tool}")
+    print(f"  {'threads':>8}{'seconds':>10}{'speedup':>10}{'efficiency':>12}")
+    for row in result["curve"]:
+        print(
+            f"  {row['threads']:>8}{row['seconds']:>10.1f}"
+            f"{row['speedup']:>10.2f}{row['efficiency']:>12.2f}"
+        )
+    print(
+        "  recommended: "
+        + ", ".join(
+            f"{threads} threads on {cpus} CPUs"
+            for cpus, threads in result["recommended"].items()
+        )
+    )
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument(
+        "--tools",
+        nargs="+",
+        choices=[b.tool for b in BENCHMARKS],
+        default=[b.tool for b in BENCHMARKS],
+    )
+    parser.add_argument(
+        "--threads", nargs="+", type=int, help="Thread counts, by default 1, 2, 4..."
+    )
+    parser.add_argument("--repeats", type=int, default=1, help="Median of runs")
+    parser.add_argument("--workdir", type=Path, default=Path("metamage_benchmark"))
+    parser.add_argument("--fixture", type=Path, help="Directory of real inputs")
+    parser.add_argument("--read-pairs", type=int, default=200_000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--kaiju-db", type=Path)
+    parser.add_argument("--kaiju-nodes", type=Path)
+    parser.add_argument(
+        "--tools-dir",
+        type=Path,
+        default=Path("/root") if Path("/root/bowtie2").exists() else None,
+        help="Directory containing the bowtie2 installation",
+    )
+    parser.add_argument("--profile", type=Path, default=PROFILE_PATH)
+    args = parser.parse_args(argv)
+
+    workdir = args.workdir.resolve()
+    tools_dir = args.tools_dir and args.tools_dir.resolve()
+    dataset = Dataset(
+        workdir,
+        args.fixture,
+        args.read_pairs,
+        args.seed,
+        args.kaiju_db and args.kaiju_db.resolve(),
+        args.kaiju_nodes and args.kaiju_nodes.resolve(),
+        tools_dir,
+    )
+    thread_counts = sorted(
+        set(args.threads or [])
+        or {1, dataset.cpus, *(2**i for i in range(8) if 2**i < dataset.cpus)}
+    )
+
+    results = {}
+    for benchmark in BENCHMARKS:
+        if benchmark.tool not in args.tools:
+            continue
+        if benchmark.requires_kaiju and not (args.kaiju_db and args.kaiju_nodes):
+            print(f"{benchmark.tool}: skipped, no --kaiju-db and --kaiju-nodes")
+            continue
+        if not _available(benchmark.executable, tools_dir):
+            print(f"{benchmark.tool}: skipped, {benchmark.executable} not found")
+            continue
+        try:
+            results[benchmark.tool] = benchmark_tool(
+                benchmark,
+                dataset,
+                workdir,
+                thread_counts,
+                args.repeats,
+                tools_dir,
+            )
+        except subprocess.CalledProcessError as e:
+            print(f"{benchmark.tool}: failed ({e})")
+            continue
+        _print_result(benchmark.tool, results[benchmark.tool])
+
+    if results:
+        merge_profile(args.profile, results)
+        print(f"Recommendations of {len(results)} tools written to {args.profile}")
+
+
+if __name__ == "__main__":
+    main()
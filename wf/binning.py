@@ -1,9 +1,96 @@
+import shutil
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
 
+import numpy as np
 from latch import large_task, message, small_task, workflow
 from latch.types import LatchDir, LatchFile
 
+from .binpack import write_bin_archive
+from .bowtie import build_bowtie_index_cmd
+from .disk import DiskBudget
+from .publish import ProgressivePublisher
+from .stats import bin_summary, fasta_length_gc
+from .threads import tool_threads
+from .types import MetabatSweep
+from .validation import check_returncodes, validate_bam
+
+# Threads of a large_task node, shared by the swept MetaBAT2 configurations
+METABAT_THREADS = 31
+
+# MetaBAT2's own minContig and maxEdges defaults, seed 0 draws a random seed
+METABAT_DEFAULTS = MetabatSweep(min_contig=[2500], max_edges=[200], seed=[0])
+
+# Bins counting towards the score of a bin set
+MIN_SCORED_BIN_BASES = 200_000
+MAX_SCORED_GC_SPREAD = 4.0
+
+
+def build_assembly_align_cmd(
+    index_prefix: str, read1: str, read2: str, threads: int = 31
+) -> List[str]:
+    """bowtie2 writing the alignments as SAM to stdout"""
+
+    return [
+        "bowtie2/bowtie2",
+        "-x",
+        index_prefix,
+        "-1",
+        read1,
+        "-2",
+        read2,
+        "--threads",
+        str(threads),
+    ]
+
+
+def build_sam_to_bam_cmd(threads: int = 31) -> List[str]:
+    return ["samtools", "view", "-@", str(threads), "-bS"]
+
+
+def build_bam_sort_cmd(
+    output_file: str, tmp_prefix: Optional[str] = None, threads: int = 31
+) -> List[str]:
+    return [
+        "samtools",
+        "sort",
+        "-@",
+        str(threads),
+        *(["-T", tmp_prefix] if tmp_prefix else []),
+        "-o",
+        output_file,
+    ]
+
+
+def build_metabat_cmd(
+    assembly_fasta: str,
+    depth_file: str,
+    prefix: str,
+    configuration: Tuple[int, int, int],
+    threads: int,
+) -> List[str]:
+    min_contig, max_edges, seed = configuration
+    return [
+        "metabat2",
+        "--saveCls",
+        "-i",
+        assembly_fasta,
+        "-a",
+        depth_file,
+        "-o",
+        prefix,
+        "--minContig",
+        str(min_contig),
+        "--maxEdges",
+        str(max_edges),
+        "--seed",
+        str(seed),
+        "-t",
+        str(threads),
+    ]
+
 
 @large_task
 def bowtie_assembly_build(assembly_dir: LatchDir, sample_name: str) -> LatchDir:
@@ -15,15 +102,13 @@ def bowtie_assembly_build(assembly_dir: LatchDir, sample_name: str) -> LatchDir:
     output_dir = Path(output_dir_name).resolve()
     output_dir.mkdir(parents=True, exist_ok=True)
 
-    _bt_idx_cmd = [
-        "bowtie2/bowtie2-build",
+    _bt_idx_cmd = build_bowtie_index_cmd(
         str(assembly_fasta),
         f"{str(output_dir)}/{sample_name}",
-        "--threads",
-        "31",
-    ]
+        threads=tool_threads("bowtie2-build", 31),
+    )
 
-    subprocess.run(_bt_idx_cmd)
+    subprocess.run(_bt_idx_cmd, check=True)
 
     return LatchDir(
         str(output_dir), f"latch:///metamage/{sample_name}/{output_dir_name}"
@@ -35,6 +120,7 @@ def bowtie_assembly_align(
     assembly_idx: LatchDir,
     read_dir: LatchDir,
     sample_name: str,
+    disk_budget: bool,
 ) -> LatchFile:
 
     # Read files
@@ -43,54 +129,68 @@ def bowtie_assembly_align(
 
     output_file_name = f"{sample_name}_assembly_sorted.bam"
 
-    output_file = Path(output_file_name).resolve()
+    output_dir = Path("assembly_alignment").resolve()
+    output_dir.mkdir(parents=True, exist_ok=True)
+    output_file = output_dir.joinpath(output_file_name)
 
-    _bt_cmd = [
-        "bowtie2/bowtie2",
-        "-x",
+    _bt_cmd = build_assembly_align_cmd(
         f"{assembly_idx.local_path}/{sample_name}",
-        "-1",
         str(read1),
-        "-2",
         str(read2),
-        "--threads",
-        "31",
-    ]
+        threads=tool_threads("bowtie2", 31),
+    )
 
     bt_align_out = subprocess.Popen(
         _bt_cmd,
         stdout=subprocess.PIPE,
     )
 
-    _sam_convert_cmd = [
-        "samtools",
-        "view",
-        "-@",
-        "31",
-        "-bS",
-    ]
+    _sam_convert_cmd = build_sam_to_bam_cmd(threads=tool_threads("samtools-view", 31))
 
     sam_convert_out = subprocess.Popen(
         _sam_convert_cmd, stdin=bt_align_out.stdout, stdout=subprocess.PIPE
     )
+    # Only the children hold the pipes, so a failed stage stops the others
+    bt_align_out.stdout.close()
 
-    _sam_sort_cmd = [
-        "samtools",
-        "sort",
-        "-@",
-        "31",
-        "-o",
-        output_file_name,
-    ]
+    budget = DiskBudget(
+        "bowtie_assembly_align", disk_budget, [read_dir, assembly_idx, output_dir]
+    )
+    tmp_dir = budget.tmp_dir("samtools_sort")
 
-    subprocess.run(
-        _sam_sort_cmd,
-        stdin=sam_convert_out.stdout,
+    _sam_sort_cmd = build_bam_sort_cmd(
+        str(output_file),
+        tmp_prefix=f"{tmp_dir}/{sample_name}" if tmp_dir else None,
+        threads=tool_threads("samtools-sort", 31),
     )
 
-    return LatchFile(
-        str(output_file), f"latch:///metamage/{sample_name}/{output_file_name}"
+    # Only the sorted BAM is published, not samtools' temporary files
+    publisher = ProgressivePublisher(
+        output_dir,
+        f"latch:///metamage/{sample_name}",
+        include=lambda path: path == output_file,
+        manifest_name=f"{sample_name}_assembly_sorted.manifest.json",
     )
+    with budget, publisher:
+        sam_sort_out = subprocess.Popen(_sam_sort_cmd, stdin=sam_convert_out.stdout)
+        sam_convert_out.stdout.close()
+
+        # Once BowTie2 is done, samtools sort only merges its temporary files:
+        # the reads and assembly index can go while it does
+        bt_returncode = bt_align_out.wait()
+        if bt_returncode == 0:
+            budget.release(read_dir, assembly_idx)
+
+        check_returncodes(
+            [
+                (bt_returncode, _bt_cmd),
+                (sam_convert_out.wait(), _sam_convert_cmd),
+                (sam_sort_out.wait(), _sam_sort_cmd),
+            ]
+        )
+        validate_bam(output_file)
+
+    return publisher.latch_file(output_file)
 
 
 @small_task
@@ -106,51 +206,223 @@ def summarize_contig_depths(assembly_bam: LatchFile, sample_name: str) -> LatchF
         assembly_bam.local_path,
     ]
 
-    subprocess.run(_jgi_cmd)
+    subprocess.run(_jgi_cmd, check=True)
 
     return LatchFile(
         str(output_file), f"latch:///metamage/{sample_name}/{output_file_name}"
     )
 
 
+def contig_names(fasta: Path) -> List[bytes]:
+    """Record ids of a FASTA file, in file order"""
+
+    with open(fasta, "rb") as f:
+        return [line[1:].split()[0] for line in f if line.startswith(b">")]
+
+
+def _run_metabat(
+    assembly_fasta: Path,
+    depth_file: str,
+    prefix: Path,
+    configuration: Tuple[int, int, int],
+    threads: int,
+) -> List[Path]:
+    prefix.parent.mkdir(parents=True, exist_ok=True)
+
+    _metabat_cmd = build_metabat_cmd(
+        str(assembly_fasta), depth_file, str(prefix), configuration, threads
+    )
+    message(
+        "info",
+        {
+            "title": "Binning contigs with MetaBat2",
+            "body": f"Command: {' '.join(_metabat_cmd)}",
+        },
+    )
+    subprocess.run(_metabat_cmd, check=True)
+
+    return sorted(
+        prefix.parent.glob(f"{prefix.name}.[0-9]*.fa"),
+        key=lambda f: int(f.name.split(".")[-2]),
+    )
+
+
+def score_bin_set(
+    bin_files: List[Path],
+    contig_index: Dict[bytes, int],
+    lengths: np.ndarray,
+    gc_counts: np.ndarray,
+    acgt_counts: np.ndarray,
+) -> Tuple[Dict[str, Union[int, float]], List[Dict[str, Union[int, float]]]]:
+    """Summarise a bin set from the statistics of the parsed assembly
+
+    The score is the number of bases in bins of at least
+    MIN_SCORED_BIN_BASES whose GC spread is at most MAX_SCORED_GC_SPREAD,
+    favouring sets that bin a lot of sequence into coherent bins.
+    """
+
+    bins = []
+    for bin_file in bin_files:
+        idx = [contig_index[name] for name in contig_names(bin_file)]
+        bins.append(
+            {
+                "bin": bin_file.name,
+                **bin_summary(lengths[idx], gc_counts[idx], acgt_counts[idx]),
+            }
+        )
+
+    binned = sum(b["bases"] for b in bins)
+    total = int(lengths.sum())
+    summary = {
+        "bins": len(bins),
+        "binned_bases": binned,
+        "binned_fraction": round(binned / total, 4) if total else 0.0,
+        "median_bin_N50": int(np.median([b["N50"] for b in bins])) if bins else 0,
+        "mean_GC_spread": (
+            round(sum(b["GC spread (%)"] * b["bases"] for b in bins) / binned, 2)
+            if binned
+            else 0.0
+        ),
+        "score": sum(
+            b["bases"]
+            for b in bins
+            if b["bases"] >= MIN_SCORED_BIN_BASES
+            and b["GC spread (%)"] <= MAX_SCORED_GC_SPREAD
+        ),
+    }
+
+    return summary, bins
+
+
+def _write_rows(path: Path, rows: List[Dict]):
+    with open(path, "w") as f:
+        if rows:
+            f.write("\t".join(rows[0].keys()) + "\n")
+        for row in rows:
+            f.write("\t".join(str(value) for value in row.values()) + "\n")
+
+
 @large_task
 def metabat2(
     assembly_dir: LatchDir,
     depth_file: LatchFile,
     sample_name: str,
+    sweep: Optional[MetabatSweep],
+    disk_budget: bool,
+    pack_bins: bool,
 ) -> LatchDir:
+    """Bin the contigs, sweeping MetaBAT2 settings when a grid is given
+
+    Configurations run concurrently, sharing the node's threads, against
+    the same assembly and depth file. The assembly is parsed once and every
+    bin set is scored from it; the best set is published along with a
+    comparison of all configurations, as one FASTA per bin or packed into
+    an indexed archive (see binpack.py).
+    """
 
     assembly_name = f"{sample_name}.contigs.fa"
     assembly_fasta = Path(assembly_dir.local_path, assembly_name)
 
     output_dir_name = f"METABAT/{sample_name}"
     output_dir = Path(output_dir_name).parent.resolve()
+    output_dir.mkdir(parents=True, exist_ok=True)
 
-    _metabat_cmd = [
+    configurations = (sweep or METABAT_DEFAULTS).configurations()
+    workers = min(len(configurations), METABAT_THREADS // 2)
+    threads = min(tool_threads("metabat2", METABAT_THREADS), METABAT_THREADS // workers)
+    if len(configurations) == 1:
+        prefixes = [output_dir.joinpath(sample_name)]
+    else:
+        prefixes = [
+            Path("metabat_sweep", "_".join(map(str, c)), sample_name).resolve()
+            for c in configurations
+        ]
+
+    budget = DiskBudget(
         "metabat2",
-        "--saveCls",
-        "-i",
-        str(assembly_fasta),
-        "-a",
-        depth_file.local_path,
-        "-o",
-        output_dir_name,
-    ]
+        disk_budget,
+        [assembly_dir, depth_file, output_dir, Path("metabat_sweep")],
+    )
+    with budget:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            bin_sets = list(
+                executor.map(
+                    lambda args: _run_metabat(
+                        assembly_fasta, depth_file.local_path, *args, threads
+                    ),
+                    zip(prefixes, configurations),
+                )
+            )
+        budget.release(depth_file)
+
+        lengths, gc_counts, acgt_counts = fasta_length_gc(assembly_fasta)
+        contig_index = {name: i for i, name in enumerate(contig_names(assembly_fasta))}
+        scores = [
+            score_bin_set(bin_files, contig_index, lengths, gc_counts, acgt_counts)
+            for bin_files in bin_sets
+        ]
+        best = max(
+            range(len(scores)),
+            key=lambda i: (scores[i][0]["score"], scores[i][0]["binned_bases"]),
+        )
+
+        # Only the best bin set is published
+        if len(configurations) > 1:
+            for output in prefixes[best].parent.iterdir():
+                shutil.move(str(output), output_dir.joinpath(output.name))
+
+        # Neither the assembly nor the other bin sets are read again
+        budget.release(assembly_dir, Path("metabat_sweep"))
+
+    _write_rows(
+        output_dir.joinpath(f"{sample_name}_binning_sweep.tsv"),
+        [
+            {
+                "min_contig": min_contig,
+                "max_edges": max_edges,
+                "seed": seed,
+                **summary,
+                "selected": i == best,
+            }
+            for i, ((min_contig, max_edges, seed), (summary, _)) in enumerate(
+                zip(configurations, scores)
+            )
+        ],
+    )
+    _write_rows(output_dir.joinpath(f"{sample_name}_bin_stats.tsv"), scores[best][1])
+
+    if pack_bins:
+        bin_files = [output_dir.joinpath(f.name) for f in bin_sets[best]]
+        write_bin_archive(
+            bin_files,
+            output_dir.joinpath(f"{sample_name}_bins.fa.gz"),
+            output_dir.joinpath(f"{sample_name}_bins.index.tsv"),
+        )
+        for bin_file in bin_files:
+            bin_file.unlink()
+
+    min_contig, max_edges, seed = configurations[best]
     message(
         "info",
         {
-            "title": "Binning contigs with MetaBat2",
-            "body": f"Command: {' '.join(_metabat_cmd)}",
+            "title": "Selected MetaBat2 bin set",
+            "body": f"minContig {min_contig}, maxEdges {max_edges}, seed {seed}: "
+            f"{scores[best][0]['bins']} bins, "
+            f"{scores[best][0]['binned_bases']} binned bases",
         },
     )
-    subprocess.run(_metabat_cmd)
 
     return LatchDir(str(output_dir), f"latch:///metamage/{sample_name}/METABAT/")
 
 
 @workflow
 def binning_wf(
-    read_dir: LatchDir, assembly_dir: LatchDir, sample_name: str
+    read_dir: LatchDir,
+    assembly_dir: LatchDir,
+    sample_name: str,
+    metabat_sweep: Optional[MetabatSweep],
+    disk_budget: bool,
+    pack_bins: bool,
 ) -> LatchDir:
 
     # Binning preparation
@@ -158,7 +430,10 @@ def binning_wf(
         assembly_dir=assembly_dir, sample_name=sample_name
     )
     aligned_to_assembly = bowtie_assembly_align(
-        assembly_idx=built_assembly_idx, read_dir=read_dir, sample_name=sample_name
+        assembly_idx=built_assembly_idx,
+        read_dir=read_dir,
+        sample_name=sample_name,
+        disk_budget=disk_budget,
     )
     depth_file = summarize_contig_depths(
         assembly_bam=aligned_to_assembly, sample_name=sample_name
@@ -166,7 +441,12 @@ def binning_wf(
 
     # Binning
     binning_results = metabat2(
-        assembly_dir=assembly_dir, depth_file=depth_file, sample_name=sample_name
+        assembly_dir=assembly_dir,
+        depth_file=depth_file,
+        sample_name=sample_name,
+        sweep=metabat_sweep,
+        disk_budget=disk_budget,
+        pack_bins=pack_bins,
     )
 
     return binning_results
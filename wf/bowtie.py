@@ -0,0 +1,91 @@
+"""
+Helpers for running several bowtie2 alignments against one shared index
+
+With `--mm` bowtie2 memory-maps the index instead of reading a private
+copy into each process, so concurrent alignments on the same node share a
+single copy of the index in the page cache.
+"""
+
+import os
+from pathlib import Path
+from typing import List, Tuple
+
+GIB = 1024**3
+
+# Resources of a Latch large_task node
+LARGE_TASK_CPUS = 31
+LARGE_TASK_MEMORY_BYTES = 120 * GIB
+
+# Memory used by one alignment job besides the index: bowtie2 buffers plus
+# the fastp run that precedes it
+JOB_OVERHEAD_BYTES = 2 * GIB
+MIN_THREADS_PER_JOB = 4
+
+
+def build_bowtie_index_cmd(
+    fasta: str, index_prefix: str, threads: int = LARGE_TASK_CPUS
+) -> List[str]:
+    return [
+        "bowtie2/bowtie2-build",
+        fasta,
+        index_prefix,
+        "--threads",
+        str(threads),
+    ]
+
+
+def index_bytes(index_prefix: str) -> int:
+    """Total size of the files of a bowtie2 index"""
+
+    prefix = Path(index_prefix)
+    return sum(
+        f.stat().st_size
+        for f in prefix.parent.glob(f"{prefix.name}.*bt2*")
+        if f.is_file()
+    )
+
+
+def warm_index(index_prefix: str, block_size: int = 64 * 1024 * 1024):
+    """Pre-load the index files into the page cache
+
+    Reading the files once up front means the memory-mapped pages are
+    already resident when the alignment jobs start, instead of every job
+    faulting them in concurrently.
+    """
+
+    prefix = Path(index_prefix)
+    for index_file in sorted(prefix.parent.glob(f"{prefix.name}.*bt2*")):
+        with open(index_file, "rb") as f:
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+            while f.read(block_size):
+                pass
+
+
+def node_memory_bytes() -> int:
+    with open("/proc/meminfo") as f:
+        for line in f:
+            if line.startswith("MemAvailable:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def plan_alignment_jobs(
+    index_size: int,
+    memory_bytes: int,
+    cpus: int,
+    job_overhead: int = JOB_OVERHEAD_BYTES,
+    min_threads: int = MIN_THREADS_PER_JOB,
+) -> Tuple[int, int]:
+    """How many concurrent jobs fit on a node, and with how many threads
+
+    The shared index is counted once, each job adds its own overhead, and
+    every job gets at least `min_threads` threads. At least one job is
+    always scheduled.
+    """
+
+    by_memory = (memory_bytes - index_size) // job_overhead
+    by_cpus = cpus // min_threads
+    jobs = int(max(1, min(by_memory, by_cpus)))
+
+    return jobs, max(1, cpus // jobs)
@@ -0,0 +1,256 @@
+"""
+Disk budget of the tasks handling the largest files
+
+Host removal, assembly, the read alignment to the contigs and binning
+keep their localised inputs, outputs and tool temporary files on the
+task's disk at the same time. In disk-budget mode their tool temporary
+files go to a managed scratch area that is removed as soon as the tool is
+done, and localised inputs are deleted once they have been consumed.
+Inputs that a tool reads once from start to end can also be streamed to
+it through a named pipe, which frees each block of the input as soon as
+it has been read, so the input shrinks while the outputs grow.
+Whatever the mode, the peak disk usage of these tasks, counting only the
+blocks allocated to their inputs, outputs and scratch area, is sampled
+and reported, so the mode's effect on a sample can be measured.
+
+Inputs are never deleted by the local runner, where they are the outputs
+of other stages (METAMAGE_KEEP_INPUTS=1).
+"""
+
+import ctypes
+import os
+import shutil
+import threading
+from pathlib import Path
+from typing import List, Optional, Sequence, Union
+
+from latch import message
+from latch.types import LatchDir, LatchFile
+
+POLL_SECONDS = 5.0
+STREAM_BLOCK_SIZE = 1 << 20
+# Blocks read by the tool are freed in steps of this many bytes
+PUNCH_BYTES = 64 << 20
+
+_FALLOC_FL_KEEP_SIZE = 0x01
+_FALLOC_FL_PUNCH_HOLE = 0x02
+
+Path_ = Union[LatchFile, LatchDir, Path]
+
+
+def _local(value: Path_) -> Path:
+    return Path(getattr(value, "local_path", value))
+
+
+def _allocated(path: Path) -> int:
+    try:
+        return path.lstat().st_blocks * 512
+    except FileNotFoundError:
+        return 0
+
+
+def _tree_bytes(path: Path) -> int:
+    """Bytes allocated to a file or directory tree, not counting holes"""
+
+    if not path.is_dir():
+        return _allocated(path)
+    # Files may come and go while the tools run, os.walk skips what vanished
+    return sum(
+        _allocated(Path(root, name))
+        for root, _, files in os.walk(path)
+        for name in files
+    )
+
+
+def _punch_hole(fd: int, offset: int, length: int) -> bool:
+    """Free a range of a file's blocks, False when the filesystem can't"""
+
+    fallocate = getattr(ctypes.CDLL(None, use_errno=True), "fallocate", None)
+    if fallocate is None:
+        return False
+    fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_long, ctypes.c_long]
+    return (
+        fallocate(fd, _FALLOC_FL_PUNCH_HOLE | _FALLOC_FL_KEEP_SIZE, offset, length) == 0
+    )
+
+
+class DiskBudget:
+    """Scratch area, input release and peak disk tracking of one task
+
+    Used as a context manager around the task's tools, given the inputs and
+    outputs whose disk usage is tracked along with the scratch area:
+
+        budget = DiskBudget("megahit", disk_budget, [read_dir, output_dir])
+        tmp_dir = budget.tmp_dir("megahit")
+        with budget:
+            subprocess.run([..., *(["--tmp-dir", str(tmp_dir)] if tmp_dir else [])])
+            budget.release(read_dir)
+    """
+
+    def __init__(
+        self,
+        task_name: str,
+        enabled: bool,
+        paths: Sequence[Path_] = (),
+        poll_seconds: float = POLL_SECONDS,
+    ):
+        self.task_name = task_name
+        self.enabled = enabled
+        self.poll_seconds = poll_seconds
+        self.scratch = Path(
+            os.environ.get("METAMAGE_SCRATCH_DIR", "scratch"), task_name
+        ).resolve()
+        self.paths = [_local(path) for path in paths]
+        self.keep_inputs = os.environ.get("METAMAGE_KEEP_INPUTS", "0") == "1"
+
+        self.start_bytes = 0
+        self.peak_bytes = 0
+        self.released_bytes = 0
+        self._stop = threading.Event()
+        self._monitor: Optional[threading.Thread] = None
+        self._streams: List[threading.Thread] = []
+        self._closing = threading.Event()
+        self._stream_errors: List[BaseException] = []
+
+    def used_bytes(self) -> int:
+        """Bytes allocated to the tracked inputs and outputs and the scratch area"""
+
+        return sum(_tree_bytes(path) for path in [*self.paths, self.scratch])
+
+    def __enter__(self):
+        if self.enabled:
+            self.scratch.mkdir(parents=True, exist_ok=True)
+        self.start_bytes = self.peak_bytes = self.used_bytes()
+        self._monitor = threading.Thread(target=self._watch, daemon=True)
+        self._monitor.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._close_streams()
+        self._stop.set()
+        self._monitor.join()
+        self._sample()
+        if self.enabled:
+            shutil.rmtree(self.scratch, ignore_errors=True)
+            try:
+                self.scratch.parent.rmdir()
+            except OSError:
+                # Still used by another task's scratch area
+                pass
+        self.report()
+        if exc_type is None and self._stream_errors:
+            raise RuntimeError(
+                f"Streaming an input of {self.task_name} failed: "
+                f"{self._stream_errors[0]!r}"
+            ) from self._stream_errors[0]
+        return False
+
+    def _sample(self):
+        self.peak_bytes = max(self.peak_bytes, self.used_bytes())
+
+    def _watch(self):
+        while not self._stop.wait(self.poll_seconds):
+            self._sample()
+
+    def tmp_dir(self, name: str) -> Optional[Path]:
+        """A fresh scratch directory, None (the tool's default) when disabled"""
+
+        if not self.enabled:
+            return None
+        tmp_dir = self.scratch.joinpath(name)
+        tmp_dir.mkdir(parents=True, exist_ok=True)
+        return tmp_dir
+
+    def stream(self, path: Path) -> Path:
+        """The path a tool should read `path` from, once and in order
+
+        In disk-budget mode the file is fed through a named pipe in the
+        scratch area and the blocks the tool has read are freed as it goes;
+        the file is deleted once it has been read to the end. Otherwise the
+        file itself is returned. Used inside the context manager.
+        """
+
+        if not self.enabled or self.keep_inputs:
+            return path
+
+        # The tool may look at the extension to detect compression
+        pipe = self.scratch.joinpath("streams", f"{len(self._streams)}_{path.name}")
+        pipe.parent.mkdir(parents=True, exist_ok=True)
+        os.mkfifo(pipe)
+        thread = threading.Thread(target=self._feed, args=(path, pipe))
+        thread.start()
+        self._streams.append(thread)
+        return pipe
+
+    def _feed(self, path: Path, pipe: Path):
+        try:
+            with open(path, "r+b") as source, open(pipe, "wb") as out:
+                punched = 0
+                can_punch = True
+                while True:
+                    block = source.read(STREAM_BLOCK_SIZE)
+                    if not block:
+                        break
+                    out.write(block)
+                    offset = source.tell()
+                    if can_punch and offset - punched >= PUNCH_BYTES:
+                        can_punch = _punch_hole(
+                            source.fileno(), punched, offset - punched
+                        )
+                        punched = offset
+            # An input the tool never opened is kept
+            if not self._closing.is_set():
+                self.released_bytes += path.stat().st_size
+                path.unlink()
+        except BrokenPipeError:
+            # The tool stopped reading, its exit status reports why
+            pass
+        except BaseException as e:
+            self._stream_errors.append(e)
+
+    def _close_streams(self):
+        # Feeders still waiting for the tool to open their pipe (the tool
+        # failed, or never opened it) find a reader that is gone at once
+        self._closing.set()
+        for thread in self._streams:
+            if thread.is_alive():
+                for pipe in self.scratch.joinpath("streams").iterdir():
+                    try:
+                        os.close(os.open(pipe, os.O_RDONLY | os.O_NONBLOCK))
+                    except OSError:
+                        pass
+            thread.join()
+        self._streams = []
+
+    def release(self, *inputs: Path_):
+        """Delete localised inputs, or intermediates, that nothing reads again"""
+
+        if not self.enabled or self.keep_inputs:
+            return
+
+        # The peak may have been reached since the last sample
+        self._sample()
+        for value in inputs:
+            path = _local(value)
+            if not path.exists():
+                continue
+            self.released_bytes += _tree_bytes(path)
+            if path.is_dir():
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                path.unlink()
+
+    def report(self):
+        gib = 1024**3
+        body = (
+            f"Peak {self.peak_bytes / gib:.1f} GiB used, "
+            f"{(self.peak_bytes - self.start_bytes) / gib:.1f} GiB above the "
+            f"{self.start_bytes / gib:.1f} GiB in use when the task started"
+        )
+        if self.enabled:
+            body += (
+                f". Disk-budget mode: {self.released_bytes / gib:.1f} GiB of "
+                "consumed inputs released, tool temporary files in "
+                f"{self.scratch}"
+            )
+        message("info", {"title": f"Disk usage of {self.task_name}", "body": body})
@@ -21,7 +21,8 @@ metamage_DOCS.parameters = {
     ),
     "sample": LatchParameter(
         display_name="Sample data",
-        description="Paired-end FASTQ files",
+        description="Paired-end FASTQ files. Samples sequenced over several "
+        "lanes or runs can list the remaining lanes as additional lanes.",
         batch_table_column=True,
     ),
     "host_data": LatchParameter(
@@ -29,6 +30,31 @@ metamage_DOCS.parameters = {
         description="FASTA file of the host genome & Host name",
         section_title="Host data",
     ),
+    "host_removal_chunk_size": LatchParameter(
+        display_name="Host removal chunk size",
+        description="Read pairs per chunk when scattering trimming and host "
+        "read removal across nodes (0 runs it as a single task).",
+    ),
+    "preview_read_pairs": LatchParameter(
+        display_name="Taxonomic preview read pairs",
+        description="Read pairs subsampled from the raw reads for the "
+        "provisional Kaiju profile.",
+    ),
+    "sketch_index": LatchParameter(
+        display_name="Cohort sketch index",
+        description="FracMinHash sketches of previous samples, merged from "
+        "their sketch directories with `python -m wf.sketch`.",
+    ),
+    "duplicate_jaccard": LatchParameter(
+        display_name="Duplicate sample Jaccard threshold",
+        description="Samples at least this similar to a previous sample reuse "
+        "its results.",
+    ),
+    "skip_duplicates": LatchParameter(
+        display_name="Reuse the results of duplicate samples",
+        description="When off, every sample runs the full analysis, and "
+        "duplicates are only reported.",
+    ),
     "k_min": LatchParameter(
         display_name="Minimum kmer size",
         description="Must be odd and <=255",
@@ -48,6 +74,31 @@ metamage_DOCS.parameters = {
     "min_contig_len": LatchParameter(
         display_name="Minimum length of contigs to output",
     ),
+    "run_metaquast": LatchParameter(
+        display_name="Run MetaQuast",
+        description="Run the full MetaQuast evaluation in addition to "
+        "the built-in assembly statistics.",
+        section_title="Assembly evaluation parameters",
+    ),
+    "metaquast_min_contig": LatchParameter(
+        display_name="MetaQuast minimum contig length",
+        description="Contigs shorter than this are ignored by MetaQuast.",
+    ),
+    "min_read_pairs": LatchParameter(
+        display_name="Minimum read pairs for assembly",
+        description="With fewer read pairs left after host removal, assembly, "
+        "binning and annotation are skipped.",
+        section_title="Stage checks",
+    ),
+    "min_contigs": LatchParameter(
+        display_name="Minimum contigs for binning and annotation",
+        description="With fewer contigs, binning and annotation are skipped.",
+    ),
+    "min_assembly_bases": LatchParameter(
+        display_name="Minimum assembly length for binning and annotation",
+        description="With a shorter total assembly length, binning and "
+        "annotation are skipped.",
+    ),
     "kaiju_ref_db": LatchParameter(
         display_name="Kaiju reference database (FM-index)",
         description="Kaiju reference database '.fmi' file.",
@@ -74,4 +125,63 @@ metamage_DOCS.parameters = {
         display_name="fARGene's HMM model",
         description="The Hidden Markov Model that should be used to predict ARGs from the data",
     ),
+    "prodigal_min_len": LatchParameter(
+        display_name="Prodigal minimum contig length",
+        description="Shorter contigs are not passed to Prodigal.",
+    ),
+    "macrel_min_len": LatchParameter(
+        display_name="Macrel minimum contig length",
+        description="Shorter contigs are not passed to Macrel.",
+    ),
+    "fargene_min_len": LatchParameter(
+        display_name="fARGene minimum contig length",
+        description="Shorter contigs are not passed to fARGene.",
+    ),
+    "gecco_min_len": LatchParameter(
+        display_name="Gecco minimum contig length",
+        description="Shorter contigs are not passed to Gecco.",
+    ),
+    "macrel_cache": LatchParameter(
+        display_name="Macrel annotation cache",
+        description="SQLite cache from a previous run "
+        "(latch:///metamage/{sample_name}/annotation_cache/macrel.sqlite), "
+        "or the merged caches of a cohort.",
+    ),
+    "fargene_cache": LatchParameter(
+        display_name="fARGene annotation cache",
+        description="SQLite cache from a previous run "
+        "(latch:///metamage/{sample_name}/annotation_cache/fargene.sqlite), "
+        "or the merged caches of a cohort.",
+    ),
+    "annotation_chunk_bases": LatchParameter(
+        display_name="Annotation chunk size (bases)",
+        description="Approximate number of contig bases per parallel "
+        "Macrel, fARGene and Gecco job.",
+    ),
+    "metabat_sweep": LatchParameter(
+        display_name="MetaBAT2 parameter sweep",
+        description="minContig, maxEdges and seed values whose combinations "
+        "are binned concurrently; the best scoring bin set is published with "
+        "a comparison table (empty runs MetaBAT2 defaults).",
+        section_title="Binning parameters",
+    ),
+    "fuse_below_bytes": LatchParameter(
+        display_name="Fused mode input size threshold (bytes)",
+        description="Samples with fewer bytes of raw reads run the "
+        "post-assembly stages in a single task, publishing only final "
+        "outputs (0 always runs them as separate tasks).",
+        section_title="Execution",
+    ),
+    "disk_budget": LatchParameter(
+        display_name="Disk-budget mode",
+        description="Host removal, MEGAHIT, the alignment to the contigs and "
+        "MetaBAT2 delete their downloaded inputs once consumed and keep tool "
+        "temporary files in a scratch area removed after each tool. Peak disk "
+        "usage of these tasks is reported either way.",
+    ),
+    "pack_bins": LatchParameter(
+        display_name="Pack MetaBAT2 bins",
+        description="Publish the bins as one bgzipped FASTA with an index of "
+        "each bin's byte range and statistics, instead of one file per bin.",
+    ),
 }
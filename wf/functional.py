@@ -1,11 +1,12 @@
-from typing import Tuple
+from typing import Optional, Tuple
 
-from latch import workflow
-from latch.types import LatchDir
+from latch import map_task, workflow
+from latch.types import LatchDir, LatchFile
 
-from .functional_module.amp import macrel
-from .functional_module.arg import fargene
-from .functional_module.bgc import gecco
+from .functional_module.amp import chunk_macrel_contigs, macrel, merge_macrel
+from .functional_module.arg import chunk_fargene_contigs, fargene, merge_fargene
+from .functional_module.bgc import chunk_gecco_contigs, gecco, merge_gecco
+from .functional_module.contig_filter import filter_contigs
 from .functional_module.prodigal import prodigal
 from .types import ProdigalOutput, fARGeneModel
 
@@ -16,18 +17,80 @@ def functional_wf(
     sample_name: str,
     prodigal_output_format: ProdigalOutput,
     fargene_hmm_model: fARGeneModel,
-) -> Tuple[LatchDir, LatchDir, LatchDir, LatchDir]:
+    prodigal_min_len: int,
+    macrel_min_len: int,
+    fargene_min_len: int,
+    gecco_min_len: int,
+    macrel_cache: Optional[LatchFile],
+    fargene_cache: Optional[LatchFile],
+    annotation_chunk_bases: int,
+) -> Tuple[LatchDir, LatchDir, LatchDir, LatchDir, LatchFile, LatchFile, LatchFile]:
+
+    # Contig deduplication and per-tool length filtering
+    (
+        prodigal_contigs,
+        macrel_contigs,
+        fargene_contigs,
+        gecco_contigs,
+        filter_report,
+    ) = filter_contigs(
+        assembly_dir=assembly_dir,
+        sample_name=sample_name,
+        prodigal_min_len=prodigal_min_len,
+        macrel_min_len=macrel_min_len,
+        fargene_min_len=fargene_min_len,
+        gecco_min_len=gecco_min_len,
+    )
 
     # Functional annotation
     prodigal_results = prodigal(
-        assembly_dir=assembly_dir,
+        contigs=prodigal_contigs,
         sample_name=sample_name,
         output_format=prodigal_output_format,
     )
-    macrel_results = macrel(assembly_dir=assembly_dir, sample_name=sample_name)
-    fargene_results = fargene(
-        assembly_dir=assembly_dir, sample_name=sample_name, hmm_model=fargene_hmm_model
+
+    # Macrel, fARGene and Gecco run over balanced contig chunks in parallel
+    macrel_chunks = chunk_macrel_contigs(
+        contigs=macrel_contigs,
+        sample_name=sample_name,
+        annotation_cache=macrel_cache,
+        chunk_bases=annotation_chunk_bases,
+    )
+    macrel_results, updated_macrel_cache = merge_macrel(
+        chunk_dirs=map_task(macrel)(chunk=macrel_chunks),
+        sample_name=sample_name,
+        annotation_cache=macrel_cache,
     )
-    gecco_results = gecco(assembly_dir=assembly_dir, sample_name=sample_name)
 
-    return prodigal_results, macrel_results, fargene_results, gecco_results
+    fargene_chunks = chunk_fargene_contigs(
+        contigs=fargene_contigs,
+        sample_name=sample_name,
+        hmm_model=fargene_hmm_model,
+        annotation_cache=fargene_cache,
+        chunk_bases=annotation_chunk_bases,
+    )
+    fargene_results, updated_fargene_cache = merge_fargene(
+        chunk_dirs=map_task(fargene)(chunk=fargene_chunks),
+        sample_name=sample_name,
+        hmm_model=fargene_hmm_model,
+        annotation_cache=fargene_cache,
+    )
+
+    gecco_chunks = chunk_gecco_contigs(
+        contigs=gecco_contigs,
+        sample_name=sample_name,
+        chunk_bases=annotation_chunk_bases,
+    )
+    gecco_results = merge_gecco(
+        chunk_dirs=map_task(gecco)(chunk=gecco_chunks), sample_name=sample_name
+    )
+
+    return (
+        prodigal_results,
+        macrel_results,
+        fargene_results,
+        gecco_results,
+        filter_report,
+        updated_macrel_cache,
+        updated_fargene_cache,
+    )
@@ -1,23 +1,82 @@
+import gzip
+import json
+import shutil
 import subprocess
 from pathlib import Path
+from typing import List, Optional, Tuple
 
 from latch import message, small_task
-from latch.types import LatchDir
+from latch.types import LatchDir, LatchFile
+
+from ..seqio import open_maybe_gzip, read_fasta
+from ..threads import tool_threads
+from ..types import MacrelChunk
+from .cache import AnnotationCache, cache_remote_path, merge_cache_stats, split_cached
+from .chunking import chunk_contigs
+
+PREDICTION_HEADER = (
+    "Access\tSequence\tAMP_family\tis_hemolytic\tAMP_probability\tHemolytic_probability"
+)
+
+
+def build_macrel_peptides_cmd(
+    peptides_fasta: str, output_dir: str, tag: str, log_file: str, threads: int = 8
+) -> List[str]:
+    return [
+        "macrel",
+        "peptides",
+        "--fasta",
+        peptides_fasta,
+        "--output",
+        output_dir,
+        "--tag",
+        tag,
+        "--log-file",
+        log_file,
+        "--threads",
+        str(threads),
+    ]
 
 
 @small_task
-def macrel(assembly_dir: LatchDir, sample_name: str) -> LatchDir:
+def chunk_macrel_contigs(
+    contigs: LatchFile,
+    sample_name: str,
+    annotation_cache: Optional[LatchFile],
+    chunk_bases: int,
+) -> List[MacrelChunk]:
 
-    # Assembly data
-    assembly_name = f"{sample_name}.contigs.fa"
-    assembly_fasta = Path(assembly_dir.local_path, assembly_name)
+    return [
+        MacrelChunk(
+            contigs=chunk,
+            sample_name=sample_name,
+            index=i,
+            annotation_cache=annotation_cache,
+        )
+        for i, chunk in enumerate(
+            chunk_contigs(contigs, sample_name, "macrel", chunk_bases)
+        )
+    ]
 
-    output_dir_name = "macrel_results"
+
+@small_task
+def macrel(chunk: MacrelChunk) -> LatchDir:
+
+    # Contig chunk of the filtered assembly
+    assembly_fasta = Path(chunk.contigs.local_path)
+    sample_name = chunk.sample_name
+
+    output_dir_name = f"chunk_{chunk.index}"
     outdir = Path(output_dir_name).resolve()
 
-    _macrel_cmd = [
+    cache = AnnotationCache.from_latch(
+        chunk.annotation_cache, "macrel.sqlite", "macrel"
+    )
+
+    # Small ORFs are cheap to predict, so only their classification is cached
+    _smorfs_cmd = [
         "macrel",
-        "contigs",
+        "get-smorfs",
         "--fasta",
         str(assembly_fasta),
         "--output",
@@ -26,16 +85,135 @@ def macrel(assembly_dir: LatchDir, sample_name: str) -> LatchDir:
         sample_name,
         "--log-file",
         f"{str(outdir)}/{sample_name}_log.txt",
-        "--threads",
-        "8",
     ]
     message(
         "info",
         {
-            "title": "Detecting anti-microbial peptides in contigs with Macrel",
-            "body": f"Command: {' '.join(_macrel_cmd)}",
+            "title": "Predicting small ORFs in contigs with Macrel",
+            "body": f"Command: {' '.join(_smorfs_cmd)}",
         },
     )
-    subprocess.run(_macrel_cmd)
+    subprocess.run(_smorfs_cmd, check=True)
+
+    smorfs_fasta = next(outdir.glob(f"{sample_name}*.smorfs.faa*"))
+    misses_fasta = outdir.joinpath(f"{sample_name}.uncached.faa")
+    assignments, sequences, results, aliases = split_cached(
+        read_fasta(smorfs_fasta), cache, misses_fasta
+    )
+
+    if aliases:
+        peptides_dir = outdir.joinpath("peptides")
+        _macrel_cmd = build_macrel_peptides_cmd(
+            str(misses_fasta),
+            str(peptides_dir),
+            sample_name,
+            f"{str(outdir)}/{sample_name}_peptides_log.txt",
+            threads=tool_threads("macrel", 8),
+        )
+        message(
+            "info",
+            {
+                "title": "Detecting anti-microbial peptides with Macrel",
+                "body": f"{len(aliases)} peptides not found in the annotation cache\n"
+                f"Command: {' '.join(_macrel_cmd)}",
+            },
+        )
+        subprocess.run(_macrel_cmd, check=True)
+
+        # Peptides missing from the prediction table were classified as non-AMPs
+        predicted = {alias: "" for alias in aliases}
+        with open_maybe_gzip(
+            peptides_dir.joinpath(f"{sample_name}.prediction.gz")
+        ) as f:
+            for line in f:
+                line = line.decode().rstrip("\n")
+                if line.startswith("#") or line.startswith("Access"):
+                    continue
+                access, _, prediction = line.split("\t", 2)
+                predicted[access] = prediction
+
+        new_results = {aliases[alias]: value for alias, value in predicted.items()}
+        results.update(new_results)
 
-    return LatchDir(str(outdir), f"latch:///metamage/{sample_name}/{output_dir_name}")
+        # Only the new entries are kept, the merge adds them to the full cache
+        new_entries = AnnotationCache(
+            outdir.joinpath("new_entries.sqlite"), cache.namespace
+        )
+        new_entries.store(new_results)
+        new_entries.close()
+
+    with gzip.open(outdir.joinpath(f"{sample_name}.prediction.gz"), "wt") as f:
+        f.write(f"# Prediction from macrel (annotation cache: {cache.namespace})\n")
+        f.write(PREDICTION_HEADER + "\n")
+        for record_id, key in assignments:
+            if results[key]:
+                f.write(f"{record_id}\t{sequences[key].decode()}\t{results[key]}\n")
+
+    with open(outdir.joinpath(f"{sample_name}_cache_stats.json"), "w") as f:
+        json.dump(cache.metrics(), f, indent=2)
+    cache.close(vacuum=False)
+
+    return LatchDir(
+        str(outdir),
+        f"latch:///metamage/{sample_name}/annotation_chunks/macrel/{output_dir_name}",
+    )
+
+
+@small_task
+def merge_macrel(
+    chunk_dirs: List[LatchDir],
+    sample_name: str,
+    annotation_cache: Optional[LatchFile],
+) -> Tuple[LatchDir, LatchFile]:
+
+    output_dir_name = "macrel_results"
+    outdir = Path(output_dir_name).resolve()
+    outdir.mkdir(parents=True, exist_ok=True)
+
+    chunk_paths = [Path(chunk_dir.local_path) for chunk_dir in chunk_dirs]
+    cache = AnnotationCache.from_latch(annotation_cache, "macrel.sqlite", "macrel")
+
+    # Contigs are unique across chunks, so records can simply be concatenated
+    with gzip.open(outdir.joinpath(f"{sample_name}.prediction.gz"), "wt") as out:
+        out.write(f"# Prediction from macrel (annotation cache: {cache.namespace})\n")
+        out.write(PREDICTION_HEADER + "\n")
+        for chunk_path in chunk_paths:
+            with gzip.open(
+                chunk_path.joinpath(f"{sample_name}.prediction.gz"), "rt"
+            ) as f:
+                for line in f:
+                    if not (line.startswith("#") or line.startswith("Access")):
+                        out.write(line)
+
+    smorfs = [next(p.glob(f"{sample_name}*.smorfs.faa*"), None) for p in chunk_paths]
+    smorfs = [s for s in smorfs if s is not None]
+    if smorfs:
+        with open(outdir.joinpath(smorfs[0].name), "wb") as out:
+            for smorfs_file in smorfs:
+                with open(smorfs_file, "rb") as f:
+                    shutil.copyfileobj(f, out)
+
+    for chunk_path in chunk_paths:
+        new_entries = chunk_path.joinpath("new_entries.sqlite")
+        if new_entries.exists():
+            cache.merge(new_entries)
+
+    metrics = merge_cache_stats(
+        p.joinpath(f"{sample_name}_cache_stats.json") for p in chunk_paths
+    )
+    with open(outdir.joinpath(f"{sample_name}_cache_stats.json"), "w") as f:
+        json.dump({**metrics, "chunks": len(chunk_paths)}, f, indent=2)
+    message(
+        "info",
+        {
+            "title": "Macrel annotation cache",
+            "body": f"Hits: {metrics['hits']}, misses: {metrics['misses']}, "
+            f"hit rate: {metrics['hit_rate']:.2%}, chunks: {len(chunk_paths)}",
+        },
+    )
+    cache.close()
+
+    return (
+        LatchDir(str(outdir), f"latch:///metamage/{sample_name}/{output_dir_name}"),
+        LatchFile(str(cache.path), cache_remote_path(sample_name, "macrel.sqlite")),
+    )
@@ -1,42 +1,323 @@
+import json
+import re
 import subprocess
 from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
 
 from latch import message, small_task
-from latch.types import LatchDir
+from latch.types import LatchDir, LatchFile
 
-from ..types import fARGeneModel
+from ..seqio import read_fasta, write_fasta
+from ..threads import tool_threads
+from ..types import FargeneChunk, fARGeneModel
+from .cache import AnnotationCache, cache_remote_path, merge_cache_stats, split_cached
+from .chunking import chunk_contigs, concatenate_tables
 
+# fARGene keeps the input contig id in the headers of the sequences it
+# retrieves, as a prefix or after its ORF finder's "lcl|ORF1_"
+_ALIAS = re.compile(r"(?:^|[>|_\s])(q\d+)(?=\D|$)")
+# A summary line ending in a count, such as "...retrieved genes: 12"
+_SUMMARY_COUNT = re.compile(r"^(.*[:\s])(\d+)\s*$")
 
-@small_task
-def fargene(
-    assembly_dir: LatchDir, sample_name: str, hmm_model: fARGeneModel
-) -> LatchDir:
-
-    # Assembly data
-    assembly_name = f"{sample_name}.contigs.fa"
-    assembly_fasta = Path(assembly_dir.local_path, assembly_name)
+FARGENE_RUN_DIR = "fargene_run"
+FARGENE_HITS_DIR = "hits"
+FARGENE_SUMMARY = "results_summary.txt"
+HITS_HEADER = "contig_id\thmm_model\tsequences\n"
 
-    output_dir_name = "fargene_results"
-    outdir = Path(output_dir_name).resolve()
 
-    _fargene_cmd = [
+def build_fargene_cmd(
+    contigs_fasta: str, hmm_model: fARGeneModel, output_dir: str, threads: int = 8
+) -> List[str]:
+    return [
         "fargene",
         "-i",
-        str(assembly_fasta),
+        contigs_fasta,
         "--hmm-model",
         hmm_model.value,
         "-o",
-        output_dir_name,
+        output_dir,
         "-p",
-        "8",
+        str(threads),
+    ]
+
+
+def fargene_fastas(run_dir: Path) -> Iterator[Path]:
+    """fARGene's retrieved fragments and genes, without its temporary files"""
+
+    for fasta in sorted(run_dir.rglob("*.fasta")):
+        if "tmpdir" not in fasta.relative_to(run_dir).parts:
+            yield fasta
+
+
+def collect_fargene_hits(
+    run_dir: Path, aliases: Dict[str, str]
+) -> Dict[str, List[List[str]]]:
+    """Group fARGene's retrieved sequences by the alias of their contig
+
+    Every sequence is kept as its FASTA path relative to `run_dir`, the
+    header around the alias and the sequence, so it can be written again
+    for any contig with the same sequence.
+    """
+
+    hits: Dict[str, List[List[str]]] = {}
+    for fasta in fargene_fastas(run_dir):
+        relative_path = str(fasta.relative_to(run_dir))
+        for header, sequence in read_fasta(fasta):
+            header = header.decode()
+            match = _ALIAS.search(header)
+            if match is None or match.group(1) not in aliases:
+                continue
+            hits.setdefault(match.group(1), []).append(
+                [
+                    relative_path,
+                    header[: match.start(1)],
+                    header[match.end(1) :],
+                    sequence.decode(),
+                ]
+            )
+    return hits
+
+
+def write_fargene_hits(
+    outdir: Path,
+    assignments: List[Tuple[str, str]],
+    results: Dict[str, str],
+    hmm_model: fARGeneModel,
+    table: Path,
+):
+    """Write the retrieved sequences of every contig, cached or screened
+
+    The sequences are written under `outdir` in fARGene's own layout, with
+    the contig ids in their headers, and counted per contig in `table`.
+    """
+
+    handles = {}
+    try:
+        with open(table, "w") as out:
+            out.write(HITS_HEADER)
+            for contig_id, key in assignments:
+                if not results[key]:
+                    continue
+                records = json.loads(results[key])
+                for relative_path, prefix, suffix, sequence in records:
+                    if relative_path not in handles:
+                        outdir.joinpath(relative_path).parent.mkdir(
+                            parents=True, exist_ok=True
+                        )
+                        handles[relative_path] = open(
+                            outdir.joinpath(relative_path), "wb"
+                        )
+                    write_fasta(
+                        handles[relative_path],
+                        f"{prefix}{contig_id}{suffix}".encode(),
+                        sequence.encode(),
+                    )
+                out.write(f"{contig_id}\t{hmm_model.value}\t{len(records)}\n")
+    finally:
+        for handle in handles.values():
+            handle.close()
+
+
+def merge_fasta_trees(run_dirs: List[Path], outdir: Path):
+    """Concatenate the FASTA files with the same relative path"""
+
+    fastas: Dict[Path, List[Path]] = {}
+    for run_dir in run_dirs:
+        for fasta in fargene_fastas(run_dir):
+            fastas.setdefault(fasta.relative_to(run_dir), []).append(fasta)
+    for relative_path, chunk_fastas in fastas.items():
+        outdir.joinpath(relative_path).parent.mkdir(parents=True, exist_ok=True)
+        with open(outdir.joinpath(relative_path), "wb") as out:
+            for fasta in chunk_fastas:
+                out.write(fasta.read_bytes())
+
+
+def merge_fargene_summaries(summaries: List[Path]) -> str:
+    """Sum fARGene summaries line by line
+
+    Lines ending in a count are summed across the summaries by their text,
+    other lines are kept once, in the order they first appear.
+    """
+
+    lines: Dict[str, Optional[int]] = {}
+    for summary in summaries:
+        for line in summary.read_text().splitlines():
+            match = _SUMMARY_COUNT.match(line)
+            if match is None:
+                lines.setdefault(line, None)
+            else:
+                lines[match.group(1)] = lines.get(match.group(1), 0) + int(
+                    match.group(2)
+                )
+
+    return "".join(
+        f"{line}\n" if count is None else f"{line}{count}\n"
+        for line, count in lines.items()
+    )
+
+
+@small_task
+def chunk_fargene_contigs(
+    contigs: LatchFile,
+    sample_name: str,
+    hmm_model: fARGeneModel,
+    annotation_cache: Optional[LatchFile],
+    chunk_bases: int,
+) -> List[FargeneChunk]:
+
+    return [
+        FargeneChunk(
+            contigs=chunk,
+            sample_name=sample_name,
+            index=i,
+            hmm_model=hmm_model,
+            annotation_cache=annotation_cache,
+        )
+        for i, chunk in enumerate(
+            chunk_contigs(contigs, sample_name, "fargene", chunk_bases)
+        )
+    ]
+
+
+@small_task
+def fargene(chunk: FargeneChunk) -> LatchDir:
+
+    # Contig chunk of the filtered assembly
+    assembly_fasta = Path(chunk.contigs.local_path)
+    sample_name = chunk.sample_name
+    hmm_model = chunk.hmm_model
+
+    output_dir_name = f"chunk_{chunk.index}"
+    outdir = Path(output_dir_name).resolve()
+    outdir.mkdir(parents=True, exist_ok=True)
+
+    # fARGene predicts and retrieves genes from whole contigs, so its
+    # results are cached per contig sequence
+    cache = AnnotationCache.from_latch(
+        chunk.annotation_cache, "fargene.sqlite", f"fargene-contigs:{hmm_model.value}"
+    )
+
+    misses_fasta = outdir.joinpath(f"{sample_name}.uncached.fa")
+    assignments, _, results, aliases = split_cached(
+        read_fasta(assembly_fasta), cache, misses_fasta
+    )
+
+    if aliases:
+        run_dir = outdir.joinpath(FARGENE_RUN_DIR)
+        _fargene_cmd = build_fargene_cmd(
+            str(misses_fasta),
+            hmm_model,
+            str(run_dir),
+            threads=tool_threads("fargene", 8),
+        )
+        message(
+            "info",
+            {
+                "title": "Detecting antibiotic resistance genes in contigs with fARGene",
+                "body": f"{len(aliases)} contigs not found in the annotation cache\n"
+                f"Command: {' '.join(_fargene_cmd)}",
+            },
+        )
+        subprocess.run(_fargene_cmd, check=True)
+
+        hits = collect_fargene_hits(run_dir, aliases)
+        new_results = {
+            key: json.dumps(hits[alias]) if alias in hits else ""
+            for alias, key in aliases.items()
+        }
+        results.update(new_results)
+
+        # Only the new entries are kept, the merge adds them to the full cache
+        new_entries = AnnotationCache(
+            outdir.joinpath("new_entries.sqlite"), cache.namespace
+        )
+        new_entries.store(new_results)
+        new_entries.close()
+
+    write_fargene_hits(
+        outdir.joinpath(FARGENE_HITS_DIR),
+        assignments,
+        results,
+        hmm_model,
+        outdir.joinpath(f"{sample_name}_{hmm_model.value}_hits.tsv"),
+    )
+
+    with open(outdir.joinpath(f"{sample_name}_cache_stats.json"), "w") as f:
+        json.dump(cache.metrics(), f, indent=2)
+    cache.close(vacuum=False)
+
+    return LatchDir(
+        str(outdir),
+        f"latch:///metamage/{sample_name}/annotation_chunks/fargene/{output_dir_name}",
+    )
+
+
+@small_task
+def merge_fargene(
+    chunk_dirs: List[LatchDir],
+    sample_name: str,
+    hmm_model: fARGeneModel,
+    annotation_cache: Optional[LatchFile],
+) -> Tuple[LatchDir, LatchFile]:
+
+    output_dir_name = "fargene_results"
+    outdir = Path(output_dir_name).resolve()
+    outdir.mkdir(parents=True, exist_ok=True)
+
+    chunk_paths = [Path(chunk_dir.local_path) for chunk_dir in chunk_dirs]
+    cache = AnnotationCache.from_latch(
+        annotation_cache, "fargene.sqlite", f"fargene-contigs:{hmm_model.value}"
+    )
+
+    # Retrieved sequences of every contig, cached or screened in this run
+    merge_fasta_trees(
+        [p.joinpath(FARGENE_HITS_DIR) for p in chunk_paths],
+        outdir.joinpath(FARGENE_HITS_DIR),
+    )
+    hits_table = f"{sample_name}_{hmm_model.value}_hits.tsv"
+    concatenate_tables(
+        [p.joinpath(hits_table) for p in chunk_paths],
+        outdir.joinpath(hits_table),
+        header=HITS_HEADER,
+    )
+
+    # fARGene's own outputs, for the contigs it screened in this run, with
+    # their aliases
+    run_dirs = [p.joinpath(FARGENE_RUN_DIR) for p in chunk_paths]
+    run_outdir = outdir.joinpath(FARGENE_RUN_DIR)
+    merge_fasta_trees(run_dirs, run_outdir)
+    summaries = [
+        run_dir.joinpath(FARGENE_SUMMARY)
+        for run_dir in run_dirs
+        if run_dir.joinpath(FARGENE_SUMMARY).exists()
     ]
+    if summaries:
+        run_outdir.mkdir(parents=True, exist_ok=True)
+        run_outdir.joinpath(FARGENE_SUMMARY).write_text(
+            merge_fargene_summaries(summaries)
+        )
+
+    for chunk_path in chunk_paths:
+        new_entries = chunk_path.joinpath("new_entries.sqlite")
+        if new_entries.exists():
+            cache.merge(new_entries)
+
+    metrics = merge_cache_stats(
+        p.joinpath(f"{sample_name}_cache_stats.json") for p in chunk_paths
+    )
+    with open(outdir.joinpath(f"{sample_name}_cache_stats.json"), "w") as f:
+        json.dump({**metrics, "chunks": len(chunk_paths)}, f, indent=2)
     message(
         "info",
         {
-            "title": "Detecting antibiotic resistance genes in contigs with fARGene",
-            "body": f"Command: {' '.join(_fargene_cmd)}",
+            "title": "fARGene annotation cache",
+            "body": f"Hits: {metrics['hits']}, misses: {metrics['misses']}, "
+            f"hit rate: {metrics['hit_rate']:.2%}, chunks: {len(chunk_paths)}",
         },
     )
-    subprocess.run(_fargene_cmd)
+    cache.close()
 
-    return LatchDir(str(outdir), f"latch:///metamage/{sample_name}/{output_dir_name}")
+    return (
+        LatchDir(str(outdir), f"latch:///metamage/{sample_name}/{output_dir_name}"),
+        LatchFile(str(cache.path), cache_remote_path(sample_name, "fargene.sqlite")),
+    )
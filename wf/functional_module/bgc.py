@@ -1,31 +1,58 @@
+import shutil
 import subprocess
 from pathlib import Path
+from typing import List
 
 from latch import message, small_task
-from latch.types import LatchDir
+from latch.types import LatchDir, LatchFile
 
+from ..threads import tool_threads
+from ..types import GeccoChunk
+from .chunking import chunk_contigs, concatenate_tables
 
-@small_task
-def gecco(assembly_dir: LatchDir, sample_name: str) -> LatchDir:
-
-    # Assembly data
-    assembly_name = f"{sample_name}.contigs.fa"
-    assembly_fasta = Path(assembly_dir.local_path, assembly_name)
+GECCO_TABLES = ("clusters", "genes", "features")
 
-    output_dir_name = "gecco_results"
-    outdir = Path(output_dir_name).resolve()
 
-    _gecco_cmd = [
+def build_gecco_cmd(contigs_fasta: str, output_dir: str, threads: int = 4) -> List[str]:
+    return [
         "gecco",
         "run",
         "-g",
-        str(assembly_fasta),
+        contigs_fasta,
         "-o",
-        output_dir_name,
+        output_dir,
         "-j",
-        "4",
+        str(threads),
         "--force-tsv",
     ]
+
+
+@small_task
+def chunk_gecco_contigs(
+    contigs: LatchFile, sample_name: str, chunk_bases: int
+) -> List[GeccoChunk]:
+
+    return [
+        GeccoChunk(contigs=chunk, sample_name=sample_name, index=i)
+        for i, chunk in enumerate(
+            chunk_contigs(contigs, sample_name, "gecco", chunk_bases)
+        )
+    ]
+
+
+@small_task
+def gecco(chunk: GeccoChunk) -> LatchDir:
+
+    # Contig chunk of the filtered assembly
+    assembly_fasta = Path(chunk.contigs.local_path)
+    sample_name = chunk.sample_name
+
+    output_dir_name = f"chunk_{chunk.index}"
+    outdir = Path(output_dir_name).resolve()
+
+    _gecco_cmd = build_gecco_cmd(
+        str(assembly_fasta), output_dir_name, threads=tool_threads("gecco", 4)
+    )
     message(
         "info",
         {
@@ -33,6 +60,33 @@ def gecco(assembly_dir: LatchDir, sample_name: str) -> LatchDir:
             "body": f"Command: {' '.join(_gecco_cmd)}",
         },
     )
-    subprocess.run(_gecco_cmd)
+    subprocess.run(_gecco_cmd, check=True)
+
+    return LatchDir(
+        str(outdir),
+        f"latch:///metamage/{sample_name}/annotation_chunks/gecco/{output_dir_name}",
+    )
+
+
+@small_task
+def merge_gecco(chunk_dirs: List[LatchDir], sample_name: str) -> LatchDir:
+
+    output_dir_name = "gecco_results"
+    outdir = Path(output_dir_name).resolve()
+    outdir.mkdir(parents=True, exist_ok=True)
+
+    chunk_paths = [Path(chunk_dir.local_path) for chunk_dir in chunk_dirs]
+
+    # Clusters never straddle chunks since contigs are not split, and their
+    # ids are derived from the (unique) contig ids, so tables concatenate as is
+    for table in GECCO_TABLES:
+        concatenate_tables(
+            [f for p in chunk_paths for f in sorted(p.glob(f"*.{table}.tsv"))],
+            outdir.joinpath(f"{sample_name}.{table}.tsv"),
+        )
+
+    for chunk_path in chunk_paths:
+        for genbank in chunk_path.glob("*.gbk"):
+            shutil.copyfile(genbank, outdir.joinpath(genbank.name))
 
     return LatchDir(str(outdir), f"latch:///metamage/{sample_name}/{output_dir_name}")
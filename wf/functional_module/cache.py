@@ -0,0 +1,212 @@
+"""
+Persistent annotation cache keyed by protein sequence hashes
+
+The samples of a cohort run in parallel, so each publishes its updated
+cache under its own directory, latch:///metamage/{sample}/annotation_cache/.
+The caches of a cohort are merged into the one passed to the next runs:
+
+    python -m wf.functional_module.cache --output fargene.sqlite \
+        sample_a/fargene.sqlite sample_b/fargene.sqlite
+"""
+
+import argparse
+import hashlib
+import json
+import shutil
+import sqlite3
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from latch.types import LatchFile
+
+from ..seqio import write_fasta
+
+_BATCH_SIZE = 500
+
+
+def cache_remote_path(sample_name: str, local_name: str) -> str:
+    """Where a sample publishes its updated cache"""
+
+    return f"latch:///metamage/{sample_name}/annotation_cache/{local_name}"
+
+
+def protein_hash(sequence: bytes) -> str:
+    """Hash of a protein sequence, ignoring case and the stop codon"""
+
+    return hashlib.sha256(sequence.upper().rstrip(b"*")).hexdigest()
+
+
+class AnnotationCache:
+    """SQLite key-value store of per-sequence annotation results
+
+    Results are stored as text under a namespace (tool, model and any
+    other parameter that changes the result), so a single database can be
+    safely reused across samples and runs. An empty value records that the
+    tool was run on a sequence and found nothing.
+    """
+
+    def __init__(self, path: Path, namespace: str):
+        self.path = path
+        self.namespace = namespace
+        self.hits = 0
+        self.misses = 0
+        self._db = sqlite3.connect(str(path))
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS annotations ("
+            "namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+            "PRIMARY KEY (namespace, key)) WITHOUT ROWID"
+        )
+
+    @classmethod
+    def from_latch(
+        cls, cache_file: Optional[LatchFile], local_name: str, namespace: str
+    ) -> "AnnotationCache":
+        """Open a local copy of a cache synced between runs as a LatchFile"""
+
+        local_path = Path(local_name).resolve()
+        if cache_file is not None:
+            shutil.copyfile(cache_file.local_path, local_path)
+        return cls(local_path, namespace)
+
+    def lookup(self, keys: Iterable[str]) -> Dict[str, str]:
+        """Return the cached value of every key present in the cache"""
+
+        keys = list(keys)
+        found = {}
+        for start in range(0, len(keys), _BATCH_SIZE):
+            batch = keys[start : start + _BATCH_SIZE]
+            placeholders = ",".join("?" * len(batch))
+            rows = self._db.execute(
+                "SELECT key, value FROM annotations "
+                f"WHERE namespace = ? AND key IN ({placeholders})",
+                (self.namespace, *batch),
+            )
+            found.update(rows)
+
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+
+        return found
+
+    def store(self, results: Dict[str, str]):
+        with self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO annotations VALUES (?, ?, ?)",
+                ((self.namespace, key, value) for key, value in results.items()),
+            )
+
+    def merge(self, other: Path):
+        """Add the entries of another cache database to this one
+
+        Entries of `other` are newer and replace existing ones.
+        """
+
+        self._db.execute("ATTACH DATABASE ? AS other", (str(other),))
+        with self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO annotations SELECT * FROM other.annotations"
+            )
+        self._db.execute("DETACH DATABASE other")
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def metrics(self) -> Dict[str, float]:
+        return {
+            "namespace": self.namespace,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hit_rate, 4),
+        }
+
+    def close(self, vacuum: bool = True):
+        if vacuum:
+            self._db.execute("VACUUM")
+        self._db.close()
+
+
+def merge_cache_stats(stats_files: Iterable[Path]) -> Dict[str, float]:
+    """Sum the cache metrics written by the chunks of one annotation run"""
+
+    namespace, hits, misses = "", 0, 0
+    for stats_file in stats_files:
+        with open(stats_file) as f:
+            stats = json.load(f)
+        namespace = stats["namespace"]
+        hits += stats["hits"]
+        misses += stats["misses"]
+
+    total = hits + misses
+    return {
+        "namespace": namespace,
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": round(hits / total if total else 0.0, 4),
+    }
+
+
+def split_cached(
+    records: Iterable[Tuple[bytes, bytes]],
+    cache: AnnotationCache,
+    misses_fasta: Path,
+) -> Tuple[List[Tuple[str, str]], Dict[str, bytes], Dict[str, str], Dict[str, str]]:
+    """Look sequences up in the cache and write the misses to a FASTA file
+
+    Every distinct cache-miss sequence is written once under a short
+    alias, so tool output can be mapped back to the hash regardless of
+    how the tool rewrites headers.
+
+    Returns the (record id, hash) of every input record, the sequence of
+    every hash, the cached results and the alias -> hash mapping of the
+    sequences written to `misses_fasta`.
+    """
+
+    assignments = []
+    sequences: Dict[str, bytes] = {}
+    for header, sequence in records:
+        key = protein_hash(sequence)
+        assignments.append((header.split()[0].decode(), key))
+        sequences.setdefault(key, sequence)
+
+    cached = cache.lookup(sequences)
+
+    aliases = {}
+    with open(misses_fasta, "wb") as f:
+        for key, sequence in sequences.items():
+            if key in cached:
+                continue
+            alias = f"q{len(aliases)}"
+            aliases[alias] = key
+            write_fasta(f, alias.encode(), sequence)
+
+    return assignments, sequences, cached, aliases
+
+
+def merge_caches(output: Path, caches: List[Path]):
+    """Merge cache databases, of any namespaces, into `output`
+
+    Empty files, such as placeholders published by older runs of gated
+    samples, hold no entries and are skipped.
+    """
+
+    merged = AnnotationCache(output, namespace="")
+    for cache in caches:
+        if cache.stat().st_size == 0:
+            continue
+        merged.merge(cache)
+    merged.close()
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--output", required=True, type=Path)
+    parser.add_argument("caches", nargs="+", type=Path, help="Caches to merge")
+    args = parser.parse_args(argv)
+
+    merge_caches(args.output, args.caches)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Balanced, contig-aligned chunking of assemblies for parallel annotation
+"""
+
+import heapq
+from pathlib import Path
+from typing import List
+
+import numpy as np
+from latch.types import LatchFile
+
+from ..seqio import read_fasta, write_fasta
+from ..stats import fasta_length_gc
+
+
+def balanced_partition(lengths: np.ndarray, n_chunks: int) -> np.ndarray:
+    """Assign contigs to chunks so that chunks hold similar numbers of bases
+
+    Contigs are placed longest first into the currently lightest chunk
+    (the LPT heuristic), which keeps every chunk within one contig length
+    of the average.
+    """
+
+    assignment = np.zeros(lengths.size, dtype=np.int64)
+    heap = [(0, chunk) for chunk in range(n_chunks)]
+    for idx in np.argsort(lengths)[::-1]:
+        load, chunk = heapq.heappop(heap)
+        assignment[idx] = chunk
+        heapq.heappush(heap, (load + int(lengths[idx]), chunk))
+
+    return assignment
+
+
+def write_contig_chunks(
+    contigs_fasta: Path, output_dir: Path, chunk_bases: int, prefix: str = ""
+) -> List[Path]:
+    """Split a FASTA into balanced chunks of about `chunk_bases` bases
+
+    Contigs are never split, so anything predicted on a contig (such as a
+    gene cluster) is always contained in a single chunk. There are no chunks
+    for a FASTA without contigs.
+    """
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+    lengths, _, _ = fasta_length_gc(contigs_fasta)
+    if not lengths.size:
+        # No empty FASTA is handed to the tools, the merges take zero chunks
+        return []
+    total = int(lengths.sum())
+    n_chunks = min(lengths.size, max(1, -(-total // max(chunk_bases, 1))))
+    assignment = balanced_partition(lengths, n_chunks)
+
+    chunk_files = [
+        output_dir.joinpath(f"{prefix}chunk_{i}.fa") for i in range(n_chunks)
+    ]
+    handles = [open(chunk_file, "wb") for chunk_file in chunk_files]
+    try:
+        for (header, sequence), chunk in zip(read_fasta(contigs_fasta), assignment):
+            write_fasta(handles[chunk], header, sequence)
+    finally:
+        for handle in handles:
+            handle.close()
+
+    return chunk_files
+
+
+def chunk_contigs(
+    contigs: LatchFile, sample_name: str, tool: str, chunk_bases: int
+) -> List[LatchFile]:
+    """Chunk the contigs filtered for a tool and publish every chunk"""
+
+    output_dir = Path(f"{tool}_chunks").resolve()
+    chunk_files = write_contig_chunks(
+        Path(contigs.local_path), output_dir, chunk_bases, f"{sample_name}.{tool}."
+    )
+
+    return [
+        LatchFile(
+            str(chunk_file),
+            f"latch:///metamage/{sample_name}/annotation_chunks/{tool}/{chunk_file.name}",
+        )
+        for chunk_file in chunk_files
+    ]
+
+
+def concatenate_tables(
+    tables: List[Path], output: Path, header_lines: int = 1, header: str = ""
+):
+    """Concatenate tables with the same header, keeping only the first header
+
+    `header` is written when there are no tables.
+    """
+
+    with open(output, "w") as out:
+        if not tables:
+            out.write(header)
+        for i, table in enumerate(tables):
+            with open(table) as f:
+                for n, line in enumerate(f):
+                    if i > 0 and n < header_lines:
+                        continue
+                    out.write(line)
@@ -0,0 +1,116 @@
+"""
+Length filtering and deduplication of contigs before functional annotation
+"""
+
+from pathlib import Path
+from typing import Dict, Tuple
+
+from latch import message, small_task
+from latch.types import LatchDir, LatchFile
+
+from ..seqio import canonical_hash, read_fasta, write_fasta
+
+ANNOTATION_TOOLS = ("prodigal", "macrel", "fargene", "gecco")
+
+
+@small_task
+def filter_contigs(
+    assembly_dir: LatchDir,
+    sample_name: str,
+    prodigal_min_len: int,
+    macrel_min_len: int,
+    fargene_min_len: int,
+    gecco_min_len: int,
+) -> Tuple[LatchFile, LatchFile, LatchFile, LatchFile, LatchFile]:
+    """Drop duplicated and too-short contigs for each annotation tool"""
+
+    # Assembly data
+    assembly_name = f"{sample_name}.contigs.fa"
+    assembly_fasta = Path(assembly_dir.local_path, assembly_name)
+
+    output_dir_name = "filtered_contigs"
+    output_dir = Path(output_dir_name).resolve()
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    min_lengths = dict(
+        zip(
+            ANNOTATION_TOOLS,
+            (prodigal_min_len, macrel_min_len, fargene_min_len, gecco_min_len),
+        )
+    )
+    output_files = {
+        tool: output_dir.joinpath(f"{sample_name}.{tool}.contigs.fa")
+        for tool in ANNOTATION_TOOLS
+    }
+    handles = {tool: open(path, "wb") for tool, path in output_files.items()}
+    kept: Dict[str, list] = {tool: [0, 0] for tool in ANNOTATION_TOOLS}
+
+    seen = set()
+    total_contigs, total_bases = 0, 0
+    duplicate_contigs, duplicate_bases = 0, 0
+
+    message(
+        "info",
+        {
+            "title": "Filtering contigs before functional annotation",
+            "body": "Minimum lengths: "
+            + ", ".join(f"{tool}={length}" for tool, length in min_lengths.items()),
+        },
+    )
+    try:
+        for header, sequence in read_fasta(assembly_fasta):
+            length = len(sequence)
+            total_contigs += 1
+            total_bases += length
+
+            digest = canonical_hash(sequence)
+            if digest in seen:
+                duplicate_contigs += 1
+                duplicate_bases += length
+                continue
+            seen.add(digest)
+
+            for tool, min_length in min_lengths.items():
+                if length >= min_length:
+                    write_fasta(handles[tool], header, sequence)
+                    kept[tool][0] += 1
+                    kept[tool][1] += length
+    finally:
+        for handle in handles.values():
+            handle.close()
+
+    report_file = output_dir.joinpath(f"{sample_name}_filter_report.tsv")
+    with open(report_file, "w") as f:
+        f.write(
+            "tool\tmin_length\tcontigs_kept\tbases_kept\t"
+            "contigs_removed\tbases_spared\n"
+        )
+        for tool in ANNOTATION_TOOLS:
+            contigs, bases = kept[tool]
+            f.write(
+                f"{tool}\t{min_lengths[tool]}\t{contigs}\t{bases}\t"
+                f"{total_contigs - contigs}\t{total_bases - bases}\n"
+            )
+        f.write(f"duplicates\t-\t-\t-\t{duplicate_contigs}\t{duplicate_bases}\n")
+
+    message(
+        "info",
+        {
+            "title": "Contig filtering summary",
+            "body": f"{duplicate_contigs} duplicated contigs removed. Bases spared: "
+            + ", ".join(
+                f"{tool}={total_bases - kept[tool][1]}" for tool in ANNOTATION_TOOLS
+            ),
+        },
+    )
+
+    remote_dir = f"latch:///metamage/{sample_name}/{output_dir_name}"
+    filtered = [
+        LatchFile(str(output_files[tool]), f"{remote_dir}/{output_files[tool].name}")
+        for tool in ANNOTATION_TOOLS
+    ]
+
+    return (
+        *filtered,
+        LatchFile(str(report_file), f"{remote_dir}/{report_file.name}"),
+    )
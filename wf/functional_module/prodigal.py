@@ -6,19 +6,18 @@ import subprocess
 from pathlib import Path
 
 from latch import large_task, message
-from latch.types import LatchDir
+from latch.types import LatchDir, LatchFile
 
 from ..types import ProdigalOutput
 
 
 @large_task
 def prodigal(
-    assembly_dir: LatchDir, sample_name: str, output_format: ProdigalOutput
+    contigs: LatchFile, sample_name: str, output_format: ProdigalOutput
 ) -> LatchDir:
 
-    # Assembly data
-    assembly_name = f"{sample_name}.contigs.fa"
-    assembly_fasta = Path(assembly_dir.local_path, assembly_name)
+    # Filtered assembly data
+    assembly_fasta = Path(contigs.local_path)
 
     # A reference to our output.
     output_dir_name = "prodigal_results"
@@ -52,7 +51,7 @@ def prodigal(
             "body": f"Command: {' '.join(_prodigal_cmd)}",
         },
     )
-    subprocess.run(_prodigal_cmd)
+    subprocess.run(_prodigal_cmd, check=True)
 
     return LatchDir(
         str(output_dir), f"latch:///metamage/{sample_name}/{output_dir_name}"
@@ -0,0 +1,159 @@
+"""
+Fused execution of the post-assembly stages for small samples
+
+For small inputs most of the wall time of the distributed workflow is
+container start-up and localisation of the same reads and assembly by
+every task. In fused mode MetaQuast, binning and functional annotation
+run in a single task, scheduled by the local runner over the node's CPUs
+and memory. Only the final outputs are published, to the same locations
+as in distributed mode; intermediates (assembly index and alignments,
+contig chunks) stay on the node.
+"""
+
+import os
+from pathlib import Path
+from typing import Optional, Tuple
+
+from latch import large_task, message, small_task
+from latch.types import LatchDir, LatchFile
+
+from .types import MetabatSweep, ProdigalOutput, Sample, fARGeneModel
+
+# (CPUs, memory in GiB) of a large_task node
+_FUSED_RESOURCES = (31, 120)
+
+
+def _input_size(read_file: LatchFile) -> int:
+    remote_path = getattr(read_file, "remote_path", None)
+    if remote_path is not None and str(remote_path).startswith("latch://"):
+        try:
+            from latch.ldata.path import LPath
+
+            return LPath(str(remote_path)).size()
+        except Exception:
+            pass
+
+    return os.path.getsize(read_file.local_path)
+
+
+@small_task
+def choose_fused_mode(sample: Sample, fuse_below_bytes: int) -> bool:
+    """Fuse the post-assembly stages when the raw reads are small enough
+
+    Sizes are read from the Latch metadata when available, so the reads are
+    not downloaded. A threshold of 0 always runs the distributed workflow.
+    """
+
+    total = sum(_input_size(read_file) for lane in sample.lanes() for read_file in lane)
+    fused = 0 < total < fuse_below_bytes
+
+    message(
+        "info",
+        {
+            "title": f"{'Fused' if fused else 'Distributed'} post-assembly stages",
+            "body": f"Raw reads: {total} bytes, fusion threshold: "
+            f"{fuse_below_bytes} bytes",
+        },
+    )
+
+    return fused
+
+
+@large_task
+def fused_contig_analysis(
+    read_dir: LatchDir,
+    assembly_dir: LatchDir,
+    sample_name: str,
+    run_metaquast: bool,
+    metaquast_min_contig: int,
+    prodigal_output_format: ProdigalOutput,
+    fargene_hmm_model: fARGeneModel,
+    prodigal_min_len: int,
+    macrel_min_len: int,
+    fargene_min_len: int,
+    gecco_min_len: int,
+    macrel_cache: Optional[LatchFile],
+    fargene_cache: Optional[LatchFile],
+    annotation_chunk_bases: int,
+    metabat_sweep: Optional[MetabatSweep],
+    disk_budget: bool,
+    pack_bins: bool,
+) -> Tuple[
+    Optional[LatchDir],
+    LatchDir,
+    LatchFile,
+    LatchDir,
+    LatchDir,
+    LatchDir,
+    LatchDir,
+    LatchFile,
+    LatchFile,
+]:
+    """MetaQuast, binning and functional annotation in a single task"""
+
+    # Imported here, the local runner imports the workflow modules
+    from .local import contig_stages, run_local, write_timeline
+
+    stages = contig_stages(
+        sample_name=sample_name,
+        run_metaquast=run_metaquast,
+        metaquast_min_contig=metaquast_min_contig,
+        prodigal_output_format=prodigal_output_format,
+        fargene_hmm_model=fargene_hmm_model,
+        prodigal_min_len=prodigal_min_len,
+        macrel_min_len=macrel_min_len,
+        fargene_min_len=fargene_min_len,
+        gecco_min_len=gecco_min_len,
+        macrel_cache=macrel_cache,
+        fargene_cache=fargene_cache,
+        annotation_chunk_bases=annotation_chunk_bases,
+        metabat_sweep=metabat_sweep,
+        disk_budget=disk_budget,
+        pack_bins=pack_bins,
+    )
+
+    message(
+        "info",
+        {
+            "title": "Running the post-assembly stages in fused mode",
+            "body": f"Stages: {', '.join(stage.name for stage in stages)}",
+        },
+    )
+
+    # The reads and assembly are localised once, then shared by every stage
+    outdir = Path("fused").resolve()
+    outdir.mkdir(parents=True, exist_ok=True)
+    results, timeline = run_local(
+        stages,
+        outdir,
+        *_FUSED_RESOURCES,
+        tools_dir="/root" if Path("/root/bowtie2").exists() else None,
+        initial_results={
+            "map_to_host": read_dir,
+            "megahit": assembly_dir,
+            "check_assembly": (None, True),
+        },
+    )
+    write_timeline(timeline, outdir.joinpath("timeline"))
+
+    failed = [entry for entry in timeline if entry.status != "done"]
+    if failed:
+        raise RuntimeError(
+            "Fused stages failed: "
+            + ", ".join(f"{entry.stage} ({entry.error})" for entry in failed)
+        )
+
+    macrel_results, updated_macrel_cache = results["merge_macrel"]
+    fargene_results, updated_fargene_cache = results["merge_fargene"]
+
+    return (
+        results["metaquast"],
+        results["metabat2"],
+        results["filter_contigs"][4],
+        results["prodigal"],
+        macrel_results,
+        fargene_results,
+        results["merge_gecco"],
+        updated_macrel_cache,
+        updated_fargene_cache,
+    )
@@ -0,0 +1,241 @@
+"""
+Checks that decide whether downstream stages have enough data to run
+
+After host removal and after assembly, a cheap streaming check measures
+what the next stages will receive. When a threshold is not met the
+workflow takes a conditional branch that skips those stages: instead of
+provisioning nodes that would fail or produce nothing, placeholder outputs
+are published that record why each stage was skipped.
+"""
+
+import json
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from latch import message, small_task
+from latch.types import LatchDir, LatchFile
+
+from .functional_module.cache import AnnotationCache, cache_remote_path
+from .readstats import load_read_stats
+from .seqio import fastq_stats
+
+
+def _write_check(
+    sample_name: str,
+    name: str,
+    measured: Dict[str, int],
+    thresholds: Dict[str, int],
+    downstream: List[str],
+) -> Tuple[LatchFile, bool]:
+    """Compare measurements with their thresholds and publish the decision"""
+
+    failed = [key for key, minimum in thresholds.items() if measured[key] < minimum]
+    passed = not failed
+    reason = "; ".join(
+        f"{key} = {measured[key]} is below the minimum of {thresholds[key]}"
+        for key in failed
+    )
+
+    output_dir = Path("stage_checks").resolve()
+    output_dir.mkdir(parents=True, exist_ok=True)
+    check_file = output_dir.joinpath(f"{sample_name}_{name}_check.json")
+    with open(check_file, "w") as f:
+        json.dump(
+            {
+                "sample": sample_name,
+                "check": name,
+                "measured": measured,
+                "thresholds": thresholds,
+                "passed": passed,
+                "skipped_stages": [] if passed else downstream,
+                "reason": reason,
+            },
+            f,
+            indent=2,
+        )
+
+    if not passed:
+        message(
+            "warning",
+            {
+                "title": f"Skipping {', '.join(downstream)}",
+                "body": reason,
+            },
+        )
+
+    return (
+        LatchFile(
+            str(check_file),
+            f"latch:///metamage/{sample_name}/stage_checks/{check_file.name}",
+        ),
+        passed,
+    )
+
+
+@small_task
+def check_reads(
+    read_dir: LatchDir, sample_name: str, min_read_pairs: int
+) -> Tuple[LatchFile, bool]:
+    """Count the read pairs and bases left after host removal
+
+    The counts come from the read statistics sidecar written by host
+    removal, the reads are only streamed when there is none.
+    """
+
+    read_stats = load_read_stats(read_dir, sample_name)
+    if read_stats is not None:
+        pairs, bases = read_stats["read_pairs"], read_stats["bases"]
+    else:
+        read_files = [
+            Path(read_dir.local_path, f"{sample_name}_unaligned.fastq.{mate}.gz")
+            for mate in (1, 2)
+        ]
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            (pairs, bases1), (_, bases2) = executor.map(fastq_stats, read_files)
+        bases = bases1 + bases2
+
+    return _write_check(
+        sample_name,
+        "reads",
+        {"read_pairs": pairs, "bases": bases},
+        {"read_pairs": min_read_pairs},
+        ["assembly", "binning", "functional annotation"],
+    )
+
+
+@small_task
+def check_assembly(
+    assembly_report: LatchDir,
+    sample_name: str,
+    min_contigs: int,
+    min_assembly_bases: int,
+) -> Tuple[LatchFile, bool]:
+    """Read the contig count and total length from the assembly statistics"""
+
+    with open(
+        Path(assembly_report.local_path, f"{sample_name}_assembly_stats.json")
+    ) as f:
+        summary = json.load(f)
+
+    return _write_check(
+        sample_name,
+        "assembly",
+        {"contigs": summary["contigs"], "bases": summary["total_length"]},
+        {"contigs": min_contigs, "bases": min_assembly_bases},
+        ["binning", "functional annotation"],
+    )
+
+
+def _skipped_dir(sample_name: str, output_dir_name: str, reason: Dict) -> LatchDir:
+    output_dir = Path(output_dir_name).resolve()
+    output_dir.mkdir(parents=True, exist_ok=True)
+    with open(output_dir.joinpath("SKIPPED.json"), "w") as f:
+        json.dump(reason, f, indent=2)
+
+    return LatchDir(
+        str(output_dir), f"latch:///metamage/{sample_name}/{output_dir_name}"
+    )
+
+
+def _passed_cache(cache: Optional[LatchFile], sample_name: str, name: str):
+    """Return the input annotation cache unchanged, or an empty placeholder"""
+
+    if cache is not None:
+        return cache
+
+    placeholder = Path(name).resolve()
+    AnnotationCache(placeholder, namespace="").close()
+    return LatchFile(str(placeholder), cache_remote_path(sample_name, name))
+
+
+def _skipped_contig_outputs(
+    sample_name: str,
+    reason: Dict,
+    macrel_cache: Optional[LatchFile],
+    fargene_cache: Optional[LatchFile],
+) -> Tuple[
+    Optional[LatchDir],
+    LatchDir,
+    LatchFile,
+    LatchDir,
+    LatchDir,
+    LatchDir,
+    LatchDir,
+    LatchFile,
+    LatchFile,
+]:
+    filter_dir = Path("filtered_contigs").resolve()
+    filter_dir.mkdir(parents=True, exist_ok=True)
+    filter_report = filter_dir.joinpath(f"{sample_name}_filter_report.tsv")
+    with open(filter_report, "w") as f:
+        f.write(f"# Skipped: {reason['reason']}\n")
+
+    return (
+        _skipped_dir(sample_name, "MetaQuast", reason),
+        _skipped_dir(sample_name, "METABAT", reason),
+        LatchFile(
+            str(filter_report),
+            f"latch:///metamage/{sample_name}/filtered_contigs/{filter_report.name}",
+        ),
+        _skipped_dir(sample_name, "prodigal_results", reason),
+        _skipped_dir(sample_name, "macrel_results", reason),
+        _skipped_dir(sample_name, "fargene_results", reason),
+        _skipped_dir(sample_name, "gecco_results", reason),
+        _passed_cache(macrel_cache, sample_name, "macrel.sqlite"),
+        _passed_cache(fargene_cache, sample_name, "fargene.sqlite"),
+    )
+
+
+@small_task
+def skip_contig_analysis(
+    assembly_check: LatchFile,
+    sample_name: str,
+    macrel_cache: Optional[LatchFile],
+    fargene_cache: Optional[LatchFile],
+) -> Tuple[
+    Optional[LatchDir],
+    LatchDir,
+    LatchFile,
+    LatchDir,
+    LatchDir,
+    LatchDir,
+    LatchDir,
+    LatchFile,
+    LatchFile,
+]:
+    """Placeholder MetaQuast, binning and annotation outputs for a small assembly"""
+
+    with open(assembly_check.local_path) as f:
+        reason = json.load(f)
+
+    return _skipped_contig_outputs(sample_name, reason, macrel_cache, fargene_cache)
+
+
+@small_task
+def skip_assembly_analysis(
+    read_check: LatchFile,
+    sample_name: str,
+    macrel_cache: Optional[LatchFile],
+    fargene_cache: Optional[LatchFile],
+) -> Tuple[
+    LatchDir,
+    Optional[LatchDir],
+    LatchDir,
+    LatchFile,
+    LatchDir,
+    LatchDir,
+    LatchDir,
+    LatchDir,
+    LatchFile,
+    LatchFile,
+]:
+    """Placeholder assembly, binning and annotation outputs for too few reads"""
+
+    with open(read_check.local_path) as f:
+        reason = json.load(f)
+
+    return (
+        _skipped_dir(sample_name, "assembly_stats", reason),
+        *_skipped_contig_outputs(sample_name, reason, macrel_cache, fargene_cache),
+    )
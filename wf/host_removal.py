@@ -1,35 +1,50 @@
+import gzip
+import json
+import shutil
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from pathlib import Path
-from typing import Tuple
+from typing import Dict, List, Tuple
 
-from latch import large_task, message, small_task, workflow
+from latch import large_task, map_task, message, small_task, workflow
 from latch.resources.tasks import cached_large_task
 from latch.types import LatchDir, LatchFile
 
-from .types import HostData, Sample
+from .bowtie import (
+    GIB,
+    LARGE_TASK_CPUS,
+    LARGE_TASK_MEMORY_BYTES,
+    build_bowtie_index_cmd,
+    index_bytes,
+    node_memory_bytes,
+    plan_alignment_jobs,
+    warm_index,
+)
+from .disk import DiskBudget
+from .publish import ProgressivePublisher
+from .readstats import UnalignedReadPipes, merge_sidecars
+from .refcache import ReferenceCache
+from .seqio import count_fastq_records, is_gzipped, open_maybe_gzip
+from .threads import node_cpus, tool_threads
+from .types import HostData, ReadChunk, ReadChunkGroup, Sample
+from .validation import check_returncodes, validate_read_pair
 
 CACHE_VERSION = "0.1.0"
 
+# Read pairs held in memory at once while splitting
+_SPLIT_BATCH_SIZE = 100_000
 
-@small_task
-def fastp(
-    sample: Sample,
-    sample_name: str,
-) -> LatchDir:
-    """Adapter removal and read trimming with fastp"""
-
-    output_dir_name = "fastp_results"
-    output_dir = Path(output_dir_name).resolve()
-    output_dir.mkdir(parents=True, exist_ok=True)
-
-    output_prefix = f"{str(output_dir)}/{sample_name}"
 
-    _fastp_cmd = [
+def build_fastp_cmd(
+    read1: str, read2: str, output_prefix: str, threads: int = 4
+) -> List[str]:
+    return [
         "/root/fastp",
         "--in1",
-        sample.read1.local_path,
+        read1,
         "--in2",
-        sample.read2.local_path,
+        read2,
         "--out1",
         f"{output_prefix}_1.trim.fastq.gz",
         "--out2",
@@ -39,9 +54,114 @@ def fastp(
         "--html",
         f"{output_prefix}.fastp.html",
         "--thread",
-        "4",
+        str(threads),
         "--detect_adapter_for_pe",
     ]
+
+
+def build_host_mapping_cmd(
+    index_prefix: str,
+    read1: str,
+    read2: str,
+    unaligned: str,
+    threads: int = 31,
+    shared_index: bool = False,
+    compressed: bool = True,
+) -> List[str]:
+    return [
+        "bowtie2/bowtie2",
+        "-x",
+        index_prefix,
+        "-1",
+        read1,
+        "-2",
+        read2,
+        "--un-conc-gz" if compressed else "--un-conc",
+        unaligned,
+        "--threads",
+        str(threads),
+        *(["--mm"] if shared_index else []),
+    ]
+
+
+def combine_lanes(sample: Sample, sample_name: str) -> Tuple[str, str]:
+    """Combine the lanes of a sample into one pair of read files
+
+    Gzipped lanes are concatenated byte-for-byte, since a series of gzip
+    members is itself a valid gzip file, so nothing is recompressed. While
+    the files are being concatenated, the records of every lane file are
+    counted in background threads to check that both mates match.
+    """
+
+    lanes = sample.lanes()
+    if len(lanes) == 1:
+        return sample.read1.local_path, sample.read2.local_path
+
+    local_lanes = [(r1.local_path, r2.local_path) for r1, r2 in lanes]
+    combined_dir = Path(f"{sample_name}_combined_lanes").resolve()
+    combined_dir.mkdir(parents=True, exist_ok=True)
+
+    with ThreadPoolExecutor(max_workers=2 * len(local_lanes)) as executor:
+        counts = [
+            (
+                executor.submit(count_fastq_records, r1),
+                executor.submit(count_fastq_records, r2),
+            )
+            for r1, r2 in local_lanes
+        ]
+
+        combined = []
+        for mate in (0, 1):
+            paths = [lane[mate] for lane in local_lanes]
+            compressed = {is_gzipped(path) for path in paths}
+            if len(compressed) > 1:
+                raise ValueError(
+                    f"Lanes of {sample_name} mix gzipped and uncompressed files"
+                )
+            suffix = ".fastq.gz" if compressed.pop() else ".fastq"
+            combined_file = combined_dir.joinpath(f"{sample_name}_{mate + 1}{suffix}")
+            with open(combined_file, "wb") as out:
+                for path in paths:
+                    with open(path, "rb") as f:
+                        shutil.copyfileobj(f, out, 16 * 1024 * 1024)
+            combined.append(str(combined_file))
+
+        for lane, (count1, count2) in enumerate(counts):
+            if count1.result() != count2.result():
+                raise ValueError(
+                    f"Lane {lane + 1} of {sample_name} has {count1.result()} reads "
+                    f"in read1 but {count2.result()} in read2"
+                )
+
+    message(
+        "info",
+        {
+            "title": "Combined sequencing lanes",
+            "body": f"{len(lanes)} lanes, "
+            f"{sum(c.result() for c, _ in counts)} read pairs",
+        },
+    )
+
+    return combined[0], combined[1]
+
+
+@small_task
+def fastp(
+    sample: Sample,
+    sample_name: str,
+) -> LatchDir:
+    """Adapter removal and read trimming with fastp"""
+
+    output_dir_name = "fastp_results"
+    output_dir = Path(output_dir_name).resolve()
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    output_prefix = f"{str(output_dir)}/{sample_name}"
+
+    read1, read2 = combine_lanes(sample, sample_name)
+    _fastp_cmd = build_fastp_cmd(
+        read1, read2, output_prefix, threads=tool_threads("fastp", 4)
+    )
     message(
         "info",
         {
@@ -49,11 +169,16 @@ def fastp(
             "body": f"Command: {' '.join(_fastp_cmd)}",
         },
     )
-    subprocess.run(_fastp_cmd)
-
-    return LatchDir(
-        str(output_dir), f"latch:///metamage/{sample_name}/{output_dir_name}"
+    publisher = ProgressivePublisher(
+        output_dir, f"latch:///metamage/{sample_name}/{output_dir_name}"
     )
+    with publisher:
+        subprocess.run(_fastp_cmd, check=True)
+        validate_read_pair(
+            f"{output_prefix}_1.trim.fastq.gz", f"{output_prefix}_2.trim.fastq.gz"
+        )
+
+    return publisher.latch_dir()
 
 
 # @cached_large_task(CACHE_VERSION)
@@ -69,13 +194,15 @@ def build_bowtie_index(
 
     host_name_clean = host_data.host_name.replace(" ", "_").lower()
 
-    _bt_idx_cmd = [
-        "bowtie2/bowtie2-build",
-        host_data.host_genome.local_path,
+    ref_cache = ReferenceCache()
+    host_genome = ref_cache.fetch(host_data.host_genome)
+    ref_cache.report("build_bowtie_index")
+
+    _bt_idx_cmd = build_bowtie_index_cmd(
+        str(host_genome),
         f"{str(output_dir)}/{host_name_clean}",
-        "--threads",
-        "31",
-    ]
+        threads=tool_threads("bowtie2-build", 31),
+    )
     message(
         "info",
         {
@@ -83,7 +210,7 @@ def build_bowtie_index(
             "body": f"Command: {' '.join(_bt_idx_cmd)}",
         },
     )
-    subprocess.run(_bt_idx_cmd)
+    subprocess.run(_bt_idx_cmd, check=True)
 
     return LatchDir(
         str(output_dir), f"latch:///metamage/{sample_name}/{output_dir_name}"
@@ -97,6 +224,7 @@ def map_to_host(
     read_dir: LatchDir,
     sample_name: str,
     host_data: HostData,
+    disk_budget: bool,
 ) -> LatchDir:
 
     output_dir_name = f"{sample_name}_bt_unaligned"
@@ -104,31 +232,50 @@ def map_to_host(
     output_dir.mkdir(parents=True, exist_ok=True)
     host_name_clean = host_data.host_name.replace(" ", "_").lower()
 
-    _bt_cmd = [
-        "bowtie2/bowtie2",
-        "-x",
-        f"{host_idx.local_path}/{host_name_clean}",
-        "-1",
-        f"{read_dir.local_path}/{sample_name}_1.trim.fastq.gz",
-        "-2",
-        f"{read_dir.local_path}/{sample_name}_2.trim.fastq.gz",
-        "--un-conc-gz",
-        f"{output_dir}/{sample_name}_unaligned.fastq.gz",
-        "--threads",
-        "31",
-    ]
-    message(
-        "info",
-        {
-            "title": "Aligning to host genome",
-            "body": f"Command: {' '.join(_bt_cmd)}",
-        },
+    # Unaligned mates are compressed, and their statistics computed, as
+    # bowtie2 writes them
+    pipes = UnalignedReadPipes(output_dir, sample_name)
+    publisher = ProgressivePublisher(
+        output_dir, f"latch:///metamage/{sample_name}/{output_dir_name}"
     )
-    subprocess.run(_bt_cmd)
+    budget = DiskBudget("map_to_host", disk_budget, [read_dir, host_idx, output_dir])
+    with budget, publisher:
+        # In disk-budget mode the trimmed reads shrink as bowtie2 reads them
+        read1, read2 = (
+            budget.stream(
+                Path(read_dir.local_path, f"{sample_name}_{mate}.trim.fastq.gz")
+            )
+            for mate in (1, 2)
+        )
+        _bt_cmd = build_host_mapping_cmd(
+            f"{host_idx.local_path}/{host_name_clean}",
+            str(read1),
+            str(read2),
+            pipes.pattern,
+            threads=tool_threads("bowtie2", 31),
+            compressed=False,
+        )
+        message(
+            "info",
+            {
+                "title": "Aligning to host genome",
+                "body": f"Command: {' '.join(_bt_cmd)}",
+            },
+        )
+        with pipes:
+            bt_process = subprocess.Popen(_bt_cmd)
+            # bowtie2 holds the whole index in memory once it is aligning, the
+            # index files can go before most of the unaligned reads are written
+            while bt_process.poll() is None:
+                if pipes.started.wait(timeout=5):
+                    budget.release(host_idx)
+                    break
+            check_returncodes([(bt_process.wait(), _bt_cmd)])
+        budget.release(read_dir, host_idx)
+        validate_read_pair(pipes.output(1), pipes.output(2))
+        pipes.write_sidecar()
 
-    return LatchDir(
-        str(output_dir), f"latch:///metamage/{sample_name}/{output_dir_name}"
-    )
+    return publisher.latch_dir()
 
 
 @workflow
@@ -136,6 +283,7 @@ def host_removal_wf(
     sample: Sample,
     host_data: HostData,
     sample_name: str,
+    disk_budget: bool,
 ) -> LatchDir:
 
     # Preprocessing
@@ -149,6 +297,355 @@ def host_removal_wf(
         read_dir=trimmed_data,
         sample_name=sample_name,
         host_data=host_data,
+        disk_budget=disk_budget,
     )
 
     return unaligned
+
+
+@small_task
+def split_reads(sample: Sample, sample_name: str, chunk_size: int) -> List[ReadChunk]:
+    """Split paired reads into synchronised chunks of `chunk_size` pairs
+
+    Only the raw reads are read, so splitting overlaps the index build.
+    """
+
+    output_dir_name = f"{sample_name}_read_chunks"
+    output_dir = Path(output_dir_name).resolve()
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    message(
+        "info",
+        {
+            "title": "Splitting reads for scattered host removal",
+            "body": f"{chunk_size} read pairs per chunk",
+        },
+    )
+
+    chunks = []
+    remote_dir = f"latch:///metamage/{sample_name}/{output_dir_name}"
+    writers, written = None, 0
+
+    def close_chunk():
+        for writer in writers:
+            writer.close()
+        index = len(chunks)
+        chunk_files = [
+            output_dir.joinpath(f"chunk_{index}_{m}.fastq.gz") for m in (1, 2)
+        ]
+        chunks.append(
+            ReadChunk(
+                read1=LatchFile(
+                    str(chunk_files[0]), f"{remote_dir}/{chunk_files[0].name}"
+                ),
+                read2=LatchFile(
+                    str(chunk_files[1]), f"{remote_dir}/{chunk_files[1].name}"
+                ),
+                sample_name=sample_name,
+                index=index,
+            )
+        )
+
+    # Lanes are streamed one after the other, chunks may span lane boundaries
+    for lane, (read1, read2) in enumerate(sample.lanes()):
+        with open_maybe_gzip(read1.local_path) as r1, open_maybe_gzip(
+            read2.local_path
+        ) as r2:
+            while True:
+                batch = min(_SPLIT_BATCH_SIZE, chunk_size - written)
+                lines1 = list(islice(r1, 4 * batch))
+                lines2 = list(islice(r2, 4 * batch))
+                if len(lines1) != len(lines2):
+                    raise ValueError(
+                        f"Lane {lane + 1} of {sample_name} has different "
+                        "numbers of reads in each mate file"
+                    )
+                if not lines1:
+                    break
+
+                if writers is None:
+                    index = len(chunks)
+                    writers = [
+                        gzip.open(
+                            output_dir.joinpath(f"chunk_{index}_{m}.fastq.gz"),
+                            "wb",
+                            compresslevel=1,
+                        )
+                        for m in (1, 2)
+                    ]
+                writers[0].writelines(lines1)
+                writers[1].writelines(lines2)
+                written += len(lines1) // 4
+
+                if written == chunk_size:
+                    close_chunk()
+                    writers, written = None, 0
+
+    if writers is not None:
+        close_chunk()
+
+    return chunks
+
+
+def _latch_dir_bytes(latch_dir: LatchDir) -> int:
+    """Size of a directory, from remote metadata when possible"""
+
+    try:
+        from latch.ldata.path import LPath
+
+        return sum(child.size() for child in LPath(latch_dir.remote_path).iterdir())
+    except Exception:
+        return sum(
+            f.stat().st_size
+            for f in Path(latch_dir.local_path).rglob("*")
+            if f.is_file()
+        )
+
+
+@small_task
+def pack_read_chunks(
+    chunks: List[ReadChunk], host_idx: LatchDir, host_data: HostData
+) -> List[ReadChunkGroup]:
+    """Group read chunks into as many alignment jobs as fit on one node"""
+
+    if not chunks:
+        return []
+
+    index_size = _latch_dir_bytes(host_idx)
+    jobs_per_node, threads = plan_alignment_jobs(
+        index_size, LARGE_TASK_MEMORY_BYTES, LARGE_TASK_CPUS
+    )
+    message(
+        "info",
+        {
+            "title": "Packing host removal jobs",
+            "body": f"Index size: {index_size / GIB:.1f} GiB, "
+            f"{jobs_per_node} concurrent alignments per node "
+            f"with {threads} threads each",
+        },
+    )
+
+    return [
+        ReadChunkGroup(
+            chunks=chunks[start : start + jobs_per_node],
+            host_idx=host_idx,
+            host_name=host_data.host_name,
+            index=i,
+        )
+        for i, start in enumerate(range(0, len(chunks), jobs_per_node))
+    ]
+
+
+def _process_read_chunk(
+    chunk: ReadChunk, index_prefix: str, output_dir: Path, threads: int
+) -> Path:
+    """Trim a chunk of reads with fastp and remove host reads from it"""
+
+    sample_name = chunk.sample_name
+    chunk_dir = output_dir.joinpath(f"chunk_{chunk.index}")
+    chunk_dir.mkdir(parents=True, exist_ok=True)
+    output_prefix = f"{str(chunk_dir)}/{sample_name}"
+
+    # The job's share of the node's threads
+    _fastp_cmd = build_fastp_cmd(
+        chunk.read1.local_path,
+        chunk.read2.local_path,
+        output_prefix,
+        threads=tool_threads("fastp", 4, cpus=threads),
+    )
+    subprocess.run(_fastp_cmd, check=True)
+    validate_read_pair(
+        f"{output_prefix}_1.trim.fastq.gz", f"{output_prefix}_2.trim.fastq.gz"
+    )
+
+    # Each chunk writes the statistics sidecar of its unaligned reads, the
+    # gather merges them
+    pipes = UnalignedReadPipes(chunk_dir, sample_name)
+    _bt_cmd = build_host_mapping_cmd(
+        index_prefix,
+        f"{output_prefix}_1.trim.fastq.gz",
+        f"{output_prefix}_2.trim.fastq.gz",
+        pipes.pattern,
+        threads=threads,
+        shared_index=True,
+        compressed=False,
+    )
+    message(
+        "info",
+        {
+            "title": f"Removing host reads from chunk {chunk.index}",
+            "body": f"Command: {' '.join(_bt_cmd)}",
+        },
+    )
+    with pipes:
+        subprocess.run(_bt_cmd, check=True)
+    validate_read_pair(pipes.output(1), pipes.output(2))
+    pipes.write_sidecar()
+
+    # Only the unaligned reads and fastp reports are needed downstream
+    for mate in (1, 2):
+        Path(f"{output_prefix}_{mate}.trim.fastq.gz").unlink()
+
+    return chunk_dir
+
+
+@large_task
+def process_read_chunk_group(group: ReadChunkGroup) -> LatchDir:
+    """Remove host reads from a group of chunks sharing one mapped index"""
+
+    sample_name = group.chunks[0].sample_name
+    output_dir_name = f"group_{group.index}"
+    output_dir = Path(output_dir_name).resolve()
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    host_name_clean = group.host_name.replace(" ", "_").lower()
+    index_prefix = f"{group.host_idx.local_path}/{host_name_clean}"
+    warm_index(index_prefix)
+
+    # The task's allocation, not the host's CPUs and memory
+    cpus = min(node_cpus(), LARGE_TASK_CPUS)
+    memory = min(
+        node_memory_bytes() or LARGE_TASK_MEMORY_BYTES, LARGE_TASK_MEMORY_BYTES
+    )
+    jobs, threads = plan_alignment_jobs(index_bytes(index_prefix), memory, cpus)
+    jobs = min(jobs, len(group.chunks))
+    threads = max(1, cpus // jobs)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [
+            executor.submit(
+                _process_read_chunk, chunk, index_prefix, output_dir, threads
+            )
+            for chunk in group.chunks
+        ]
+        for future in futures:
+            future.result()
+
+    return LatchDir(
+        str(output_dir),
+        f"latch:///metamage/{sample_name}/{sample_name}_host_removal_chunks/{output_dir_name}",
+    )
+
+
+def _merge_read_summaries(summaries: List[Dict]) -> Dict:
+    """Combine fastp read summaries weighting rates by reads or bases"""
+
+    merged = {}
+    total_reads = sum(s["total_reads"] for s in summaries)
+    total_bases = sum(s["total_bases"] for s in summaries)
+    for key in summaries[0]:
+        values = [s[key] for s in summaries]
+        if key.endswith("_rate") or key == "gc_content":
+            weights = [s["total_bases"] for s in summaries]
+            merged[key] = (
+                sum(v * w for v, w in zip(values, weights)) / total_bases
+                if total_bases
+                else 0.0
+            )
+        elif key.endswith("_mean_length"):
+            weights = [s["total_reads"] for s in summaries]
+            merged[key] = (
+                round(sum(v * w for v, w in zip(values, weights)) / total_reads)
+                if total_reads
+                else 0
+            )
+        else:
+            merged[key] = sum(values)
+
+    return merged
+
+
+def merge_fastp_reports(reports: List[Dict]) -> Dict:
+    """Merge the JSON reports of fastp runs over chunks of one sample"""
+
+    merged = {
+        "summary": {
+            stage: _merge_read_summaries([r["summary"][stage] for r in reports])
+            for stage in ("before_filtering", "after_filtering")
+        },
+        "filtering_result": {
+            key: sum(r["filtering_result"][key] for r in reports)
+            for key in reports[0]["filtering_result"]
+        },
+        "chunks": len(reports),
+    }
+    if all("duplication" in r for r in reports):
+        reads = [r["summary"]["before_filtering"]["total_reads"] for r in reports]
+        merged["duplication"] = {
+            "rate": sum(r["duplication"]["rate"] * n for r, n in zip(reports, reads))
+            / max(sum(reads), 1)
+        }
+
+    return merged
+
+
+@small_task
+def gather_host_removal(
+    group_dirs: List[LatchDir], sample_name: str
+) -> Tuple[LatchDir, LatchDir]:
+    """Concatenate the chunks' unaligned reads, merge their stats and reports"""
+
+    fastp_dir_name = "fastp_results"
+    fastp_dir = Path(fastp_dir_name).resolve()
+    fastp_dir.mkdir(parents=True, exist_ok=True)
+
+    output_dir_name = f"{sample_name}_bt_unaligned"
+    output_dir = Path(output_dir_name).resolve()
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    chunk_paths = sorted(
+        (
+            chunk_path
+            for group_dir in group_dirs
+            for chunk_path in Path(group_dir.local_path).glob("chunk_*")
+        ),
+        key=lambda chunk_path: int(chunk_path.name.split("_")[1]),
+    )
+
+    # Concatenated gzip members are a valid gzip file, no recompression needed
+    for mate in (1, 2):
+        unaligned_name = f"{sample_name}_unaligned.fastq.{mate}.gz"
+        with open(output_dir.joinpath(unaligned_name), "wb") as out:
+            for chunk_path in chunk_paths:
+                with open(chunk_path.joinpath(unaligned_name), "rb") as f:
+                    shutil.copyfileobj(f, out, 16 * 1024 * 1024)
+    merge_sidecars(chunk_paths, output_dir, sample_name)
+
+    reports = []
+    for chunk_path in chunk_paths:
+        with open(chunk_path.joinpath(f"{sample_name}.fastp.json")) as f:
+            reports.append(json.load(f))
+    with open(fastp_dir.joinpath(f"{sample_name}.fastp.json"), "w") as f:
+        json.dump(merge_fastp_reports(reports), f, indent=2)
+
+    message(
+        "info",
+        {
+            "title": "Gathered scattered host removal",
+            "body": f"Merged {len(chunk_paths)} chunks",
+        },
+    )
+
+    return (
+        LatchDir(str(fastp_dir), f"latch:///metamage/{sample_name}/{fastp_dir_name}"),
+        LatchDir(str(output_dir), f"latch:///metamage/{sample_name}/{output_dir_name}"),
+    )
+
+
+@workflow
+def host_removal_scatter_wf(
+    sample: Sample,
+    host_data: HostData,
+    sample_name: str,
+    chunk_size: int,
+) -> LatchDir:
+
+    # Reads are split while the index is built, the index joins the groups
+    host_idx = build_bowtie_index(sample_name=sample_name, host_data=host_data)
+    chunks = split_reads(sample=sample, sample_name=sample_name, chunk_size=chunk_size)
+    groups = pack_read_chunks(chunks=chunks, host_idx=host_idx, host_data=host_data)
+    group_dirs = map_task(process_read_chunk_group)(group=groups)
+
+    _, unaligned = gather_host_removal(group_dirs=group_dirs, sample_name=sample_name)
+
+    return unaligned
@@ -4,14 +4,42 @@ Taxonomic classification of reads
 
 import subprocess
 from pathlib import Path
-from typing import Tuple
+from typing import List, Tuple
 
-from latch import large_task, message, small_task, workflow
+from latch import (
+    create_conditional_section,
+    large_task,
+    message,
+    small_task,
+    workflow,
+)
 from latch.types import LatchDir, LatchFile
 
+from .refcache import ReferenceCache
+from .threads import tool_threads
 from .types import TaxonRank
 
 
+def build_kaiju_cmd(
+    nodes: str, db: str, read1: str, read2: str, output: str, threads: int = 2
+) -> List[str]:
+    return [
+        "kaiju",
+        "-t",
+        nodes,
+        "-f",
+        db,
+        "-i",
+        read1,
+        "-j",
+        read2,
+        "-z",
+        str(threads),
+        "-o",
+        output,
+    ]
+
+
 @large_task
 def taxonomy_classification_task(
     read_dir: LatchDir,
@@ -28,21 +56,20 @@ def taxonomy_classification_task(
     output_name = f"{sample}_kaiju.out"
     kaiju_out = Path(output_name).resolve()
 
-    _kaiju_cmd = [
-        "kaiju",
-        "-t",
-        kaiju_ref_nodes.local_path,
-        "-f",
-        kaiju_ref_db.local_path,
-        "-i",
+    # The database is the largest input, start localising it first
+    ref_cache = ReferenceCache()
+    kaiju_db_future, kaiju_nodes_future = ref_cache.prefetch(
+        [kaiju_ref_db, kaiju_ref_nodes]
+    )
+
+    _kaiju_cmd = build_kaiju_cmd(
+        str(kaiju_nodes_future.result()),
+        str(kaiju_db_future.result()),
         str(read1),
-        "-j",
         str(read2),
-        "-z",
-        "2",
-        "-o",
         str(kaiju_out),
-    ]
+        threads=tool_threads("kaiju", 2),
+    )
     message(
         "info",
         {
@@ -50,7 +77,8 @@ def taxonomy_classification_task(
             "body": f"Command: {' '.join(_kaiju_cmd)}",
         },
     )
-    subprocess.run(_kaiju_cmd)
+    ref_cache.report("taxonomy_classification_task")
+    subprocess.run(_kaiju_cmd, check=True)
 
     return LatchFile(str(kaiju_out), f"latch:///metamage/{sample}/kaiju/{output_name}")
 
@@ -68,12 +96,14 @@ def kaiju2table_task(
     output_name = f"{sample}_kaiju.tsv"
     kaijutable_tsv = Path(output_name).resolve()
 
+    ref_cache = ReferenceCache()
+
     _kaiju2table_cmd = [
         "kaiju2table",
         "-t",
-        kaiju_ref_nodes.local_path,
+        str(ref_cache.fetch(kaiju_ref_nodes)),
         "-n",
-        kaiju_ref_names.local_path,
+        str(ref_cache.fetch(kaiju_ref_names)),
         "-r",
         taxon.value,
         "-p",
@@ -83,7 +113,7 @@ def kaiju2table_task(
         kaiju_out.local_path,
     ]
 
-    subprocess.run(_kaiju2table_cmd)
+    subprocess.run(_kaiju2table_cmd, check=True)
 
     return LatchFile(
         str(kaijutable_tsv), f"latch:///metamage/{sample}/kaiju/{output_name}"
@@ -102,19 +132,21 @@ def kaiju2krona_task(
     output_name = f"{sample}_kaiju2krona.out"
     krona_txt = Path(output_name).resolve()
 
+    ref_cache = ReferenceCache()
+
     _kaiju2krona_cmd = [
         "kaiju2krona",
         "-t",
-        kaiju_ref_nodes.local_path,
+        str(ref_cache.fetch(kaiju_ref_nodes)),
         "-n",
-        kaiju_ref_names.local_path,
+        str(ref_cache.fetch(kaiju_ref_names)),
         "-i",
         kaiju_out.local_path,
         "-o",
         str(krona_txt),
     ]
 
-    subprocess.run(_kaiju2krona_cmd)
+    subprocess.run(_kaiju2krona_cmd, check=True)
 
     return LatchFile(str(krona_txt), f"latch:///metamage/{sample}/kaiju/{output_name}")
 
@@ -127,27 +159,48 @@ def plot_krona_task(krona_txt: LatchFile, sample: str) -> LatchFile:
 
     _kaiju2krona_cmd = ["ktImportText", "-o", str(krona_html), krona_txt.local_path]
 
-    subprocess.run(_kaiju2krona_cmd)
+    subprocess.run(_kaiju2krona_cmd, check=True)
 
     return LatchFile(str(krona_html), f"latch:///metamage/{sample}/kaiju/{output_name}")
 
 
+@small_task
+def kaiju_reports_task(
+    kaiju_out: LatchFile,
+    kaiju_ref_nodes: LatchFile,
+    kaiju_ref_names: LatchFile,
+    sample: str,
+    taxon: TaxonRank,
+) -> Tuple[LatchFile, LatchFile]:
+    """kaiju2table, kaiju2krona and the Krona plot in a single task"""
+
+    kaiju2table_out = kaiju2table_task.task_function(
+        kaiju_out=kaiju_out,
+        kaiju_ref_nodes=kaiju_ref_nodes,
+        kaiju_ref_names=kaiju_ref_names,
+        sample=sample,
+        taxon=taxon,
+    )
+    kaiju2krona_out = kaiju2krona_task.task_function(
+        kaiju_out=kaiju_out,
+        kaiju_ref_nodes=kaiju_ref_nodes,
+        kaiju_ref_names=kaiju_ref_names,
+        sample=sample,
+    )
+    krona_plot = plot_krona_task.task_function(krona_txt=kaiju2krona_out, sample=sample)
+
+    return kaiju2table_out, krona_plot
+
+
 @workflow
-def kaiju_wf(
-    read_dir: LatchDir,
-    kaiju_ref_db: LatchFile,
+def kaiju_reports_wf(
+    kaiju_out: LatchFile,
     kaiju_ref_nodes: LatchFile,
     kaiju_ref_names: LatchFile,
     sample_name: str,
     taxon_rank: TaxonRank,
 ) -> Tuple[LatchFile, LatchFile]:
 
-    kaiju_out = taxonomy_classification_task(
-        read_dir=read_dir,
-        kaiju_ref_db=kaiju_ref_db,
-        kaiju_ref_nodes=kaiju_ref_nodes,
-        sample=sample_name,
-    )
     kaiju2table_out = kaiju2table_task(
         kaiju_out=kaiju_out,
         sample=sample_name,
@@ -164,3 +217,49 @@ def kaiju_wf(
     krona_plot = plot_krona_task(krona_txt=kaiju2krona_out, sample=sample_name)
 
     return kaiju2table_out, krona_plot
+
+
+@workflow
+def kaiju_wf(
+    read_dir: LatchDir,
+    kaiju_ref_db: LatchFile,
+    kaiju_ref_nodes: LatchFile,
+    kaiju_ref_names: LatchFile,
+    sample_name: str,
+    taxon_rank: TaxonRank,
+    fused: bool,
+) -> Tuple[LatchFile, LatchFile]:
+
+    kaiju_out = taxonomy_classification_task(
+        read_dir=read_dir,
+        kaiju_ref_db=kaiju_ref_db,
+        kaiju_ref_nodes=kaiju_ref_nodes,
+        sample=sample_name,
+    )
+
+    # Small samples build the reports in one task instead of three
+    kaiju2table_out, krona_plot = (
+        create_conditional_section("fused_kaiju_reports")
+        .if_(fused.is_true())
+        .then(
+            kaiju_reports_task(
+                kaiju_out=kaiju_out,
+                kaiju_ref_nodes=kaiju_ref_nodes,
+                kaiju_ref_names=kaiju_ref_names,
+                sample=sample_name,
+                taxon=taxon_rank,
+            )
+        )
+        .else_()
+        .then(
+            kaiju_reports_wf(
+                kaiju_out=kaiju_out,
+                kaiju_ref_nodes=kaiju_ref_nodes,
+                kaiju_ref_names=kaiju_ref_names,
+                sample_name=sample_name,
+                taxon_rank=taxon_rank,
+            )
+        )
+    )
+
+    return kaiju2table_out, krona_plot
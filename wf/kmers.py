@@ -0,0 +1,57 @@
+"""
+Vectorised hashing of canonical k-mers
+"""
+
+from typing import List
+
+import numpy as np
+
+KMER_SIZE = 21
+
+ENCODE = np.full(256, 4, dtype=np.uint8)
+for _i, _base in enumerate(b"ACGT"):
+    ENCODE[_base] = _i
+    ENCODE[ord(chr(_base).lower())] = _i
+
+
+def _mix64(x: np.ndarray) -> np.ndarray:
+    """splitmix64 finaliser, spreads k-mer codes uniformly over 64 bits"""
+
+    x = x ^ (x >> np.uint64(30))
+    x = x * np.uint64(0xBF58476D1CE4E5B9)
+    x = x ^ (x >> np.uint64(27))
+    x = x * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def kmer_hashes(sequences: List[bytes], k: int = KMER_SIZE) -> np.ndarray:
+    """Hashes of the canonical k-mers of a batch of sequences
+
+    Sequences are joined with an N separator so a single pass of vector
+    operations covers the whole batch. k-mers containing anything other
+    than ACGT, including the separators, are dropped.
+    """
+
+    return code_kmer_hashes(
+        ENCODE[np.frombuffer(b"N".join(sequences), dtype=np.uint8)], k
+    )
+
+
+def code_kmer_hashes(codes: np.ndarray, k: int = KMER_SIZE) -> np.ndarray:
+    """`kmer_hashes` of 2-bit base codes, codes above 3 break k-mers"""
+
+    n_kmers = codes.size - k + 1
+    if n_kmers <= 0:
+        return np.empty(0, dtype=np.uint64)
+
+    forward = np.zeros(n_kmers, dtype=np.uint64)
+    reverse = np.zeros(n_kmers, dtype=np.uint64)
+    for i in range(k):
+        base = (codes[i : i + n_kmers] & 3).astype(np.uint64)
+        forward = (forward << np.uint64(2)) | base
+        reverse |= (np.uint64(3) - base) << np.uint64(2 * i)
+
+    invalid = np.concatenate(([0], np.cumsum(codes > 3)))
+    valid = invalid[k:] == invalid[:n_kmers]
+
+    return _mix64(np.minimum(forward, reverse)[valid])
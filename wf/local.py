@@ -0,0 +1,937 @@
+"""
+Concurrent local execution of the metamage DAG
+
+Runs the workflow's task functions outside of Latch, scheduling
+independent stages concurrently under a global CPU and memory budget.
+Every stage runs in its own process and working directory, since tasks
+write their outputs relative to the current directory. The tool paths
+used by the tasks (/root/fastp, bowtie2/, ...) are those of the workflow
+image, so this is meant to be run inside that image.
+
+Usage:
+
+    python -m wf.local --read1 r1.fq.gz --read2 r2.fq.gz \\
+        --host-genome host.fa.gz --host-name homo_sapiens \\
+        --kaiju-db db.fmi --kaiju-nodes nodes.dmp --kaiju-names names.dmp \\
+        --sample-name sample --outdir metamage_local
+"""
+
+import argparse
+import dataclasses
+import importlib
+import json
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from dataclasses import dataclass
+from enum import Enum
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+from latch.types import LatchDir, LatchFile
+
+from .abundance import abundance_matrices
+from .binning import (
+    METABAT_DEFAULTS,
+    bowtie_assembly_align,
+    bowtie_assembly_build,
+    metabat2,
+    summarize_contig_depths,
+)
+from .functional_module.amp import chunk_macrel_contigs, macrel, merge_macrel
+from .functional_module.arg import chunk_fargene_contigs, fargene, merge_fargene
+from .functional_module.bgc import chunk_gecco_contigs, gecco, merge_gecco
+from .functional_module.contig_filter import filter_contigs
+from .functional_module.prodigal import prodigal
+from .gating import check_assembly, check_reads
+from .host_removal import build_bowtie_index, fastp, map_to_host
+from .kaiju import (
+    kaiju2krona_task,
+    kaiju2table_task,
+    plot_krona_task,
+    taxonomy_classification_task,
+)
+from .metassembly import assembly_stats, megahit, metaquast
+from .preview import preview_classification_task, subsample_reads
+from .sketch import sketch_sample
+from .types import (
+    HostData,
+    Lane,
+    MetabatSweep,
+    ProdigalOutput,
+    Sample,
+    TaxonRank,
+    fARGeneModel,
+)
+
+# (CPUs, memory in GiB) requested by the Latch task decorators
+SMALL = (2, 4)
+LARGE = (31, 120)
+
+
+@dataclass
+class Stage:
+    name: str
+    task: Callable
+    resources: Tuple[int, int]
+    depends_on: Tuple[str, ...] = ()
+    inputs: Callable[[Dict[str, Any]], Dict[str, Any]] = lambda results: {}
+    # Name of a list input the task is mapped over, like a Latch map_task
+    mapped: Optional[str] = None
+    # Evaluated once the dependencies are done, like a conditional branch: a
+    # stage that is not enabled is skipped along with everything downstream
+    enabled: Callable[[Dict[str, Any]], bool] = lambda results: True
+
+
+@dataclass
+class TimelineEntry:
+    stage: str
+    cpus: int
+    memory_gib: int
+    start: float
+    end: float = 0.0
+    status: str = "running"
+    error: str = ""
+
+    @property
+    def failed(self) -> bool:
+        """Whether the stage failed, or was skipped after an upstream failure
+
+        Stages skipped by a stage check (too little data) did not fail.
+        """
+
+        return self.status == "failed" or (
+            self.status == "skipped" and self.error == "upstream failure"
+        )
+
+
+def _remote_path(value: Union[LatchFile, LatchDir]) -> Optional[str]:
+    remote_path = getattr(value, "remote_path", None)
+    return str(remote_path) if remote_path else None
+
+
+def _to_plain(value: Any) -> Any:
+    """Convert Latch types into picklable plain values for worker processes"""
+
+    if isinstance(value, LatchDir):
+        return ("__latch_dir__", str(value.local_path), _remote_path(value))
+    if isinstance(value, LatchFile):
+        return ("__latch_file__", str(value.local_path), _remote_path(value))
+    if dataclasses.is_dataclass(value) and not isinstance(value, type):
+        fields = {
+            f.name: _to_plain(getattr(value, f.name)) for f in dataclasses.fields(value)
+        }
+        return ("__dataclass__", type(value), fields)
+    if isinstance(value, (list, tuple)):
+        return type(value)(_to_plain(v) for v in value)
+    return value
+
+
+def _from_plain(value: Any) -> Any:
+    if isinstance(value, tuple) and value and value[0] == "__latch_dir__":
+        return LatchDir(value[1], value[2]) if value[2] else LatchDir(value[1])
+    if isinstance(value, tuple) and value and value[0] == "__latch_file__":
+        return LatchFile(value[1], value[2]) if value[2] else LatchFile(value[1])
+    if isinstance(value, tuple) and value and value[0] == "__dataclass__":
+        return value[1](**{k: _from_plain(v) for k, v in value[2].items()})
+    if isinstance(value, (list, tuple)):
+        return type(value)(_from_plain(v) for v in value)
+    return value
+
+
+def _run_stage(
+    task: Tuple[str, str],
+    workdir: str,
+    tools_dir: Optional[str],
+    kwargs: Any,
+):
+    """Run one task function, or one mapped element, in its own directory"""
+
+    workdir = Path(workdir)
+    workdir.mkdir(parents=True, exist_ok=True)
+    if tools_dir is not None and not workdir.joinpath("bowtie2").exists():
+        workdir.joinpath("bowtie2").symlink_to(Path(tools_dir, "bowtie2"))
+    os.chdir(workdir)
+
+    # Outputs stay local, Latch-side progressive publishing is not used
+    os.environ["METAMAGE_PROGRESSIVE_PUBLISH"] = "0"
+    # Inputs are other stages' outputs, never deleted in disk-budget mode
+    os.environ["METAMAGE_KEEP_INPUTS"] = "1"
+
+    # Tasks are resolved by name, the Latch task objects themselves don't pickle
+    module, name = task
+    task = getattr(importlib.import_module(module), name)
+    function = getattr(task, "task_function", task)
+
+    return _to_plain(function(**_from_plain(kwargs)))
+
+
+def _task_reference(task: Callable) -> Tuple[str, str]:
+    function = getattr(task, "task_function", task)
+    return function.__module__, function.__name__
+
+
+def metamage_stages(
+    sample: Sample,
+    host_data: HostData,
+    kaiju_ref_db: LatchFile,
+    kaiju_ref_nodes: LatchFile,
+    kaiju_ref_names: LatchFile,
+    sample_name: str,
+    preview_read_pairs: int = 100_000,
+    sketch_index: Optional[LatchDir] = None,
+    taxon_rank: TaxonRank = TaxonRank.species,
+    min_read_pairs: int = 10_000,
+    min_count: int = 2,
+    k_min: int = 21,
+    k_max: int = 141,
+    k_step: int = 12,
+    min_contig_len: int = 200,
+    run_metaquast: bool = False,
+    metaquast_min_contig: int = 500,
+    min_contigs: int = 10,
+    min_assembly_bases: int = 100_000,
+    prodigal_output_format: ProdigalOutput = ProdigalOutput.gbk,
+    fargene_hmm_model: fARGeneModel = fARGeneModel.class_a,
+    prodigal_min_len: int = 200,
+    macrel_min_len: int = 200,
+    fargene_min_len: int = 500,
+    gecco_min_len: int = 1000,
+    macrel_cache: Optional[LatchFile] = None,
+    fargene_cache: Optional[LatchFile] = None,
+    annotation_chunk_bases: int = 100_000_000,
+    metabat_sweep: Optional[MetabatSweep] = None,
+    disk_budget: bool = False,
+    pack_bins: bool = False,
+) -> List[Stage]:
+    """The stages of the metamage workflow and their dependencies"""
+
+    return [
+        # Taxonomic preview from a read subsample
+        Stage(
+            "subsample_reads",
+            subsample_reads,
+            SMALL,
+            inputs=lambda r: dict(
+                sample=sample,
+                sample_name=sample_name,
+                read_pairs_n=preview_read_pairs,
+            ),
+        ),
+        Stage(
+            "preview_classification_task",
+            preview_classification_task,
+            LARGE,
+            ("subsample_reads",),
+            lambda r: dict(
+                subsample_dir=r["subsample_reads"],
+                kaiju_ref_db=kaiju_ref_db,
+                kaiju_ref_nodes=kaiju_ref_nodes,
+                kaiju_ref_names=kaiju_ref_names,
+                sample_name=sample_name,
+                taxon=taxon_rank,
+            ),
+        ),
+        # Host read removal and trimming
+        Stage(
+            "fastp",
+            fastp,
+            SMALL,
+            inputs=lambda r: dict(sample=sample, sample_name=sample_name),
+        ),
+        Stage(
+            "build_bowtie_index",
+            build_bowtie_index,
+            LARGE,
+            inputs=lambda r: dict(host_data=host_data, sample_name=sample_name),
+        ),
+        Stage(
+            "map_to_host",
+            map_to_host,
+            LARGE,
+            ("fastp", "build_bowtie_index"),
+            lambda r: dict(
+                host_idx=r["build_bowtie_index"],
+                read_dir=r["fastp"],
+                sample_name=sample_name,
+                host_data=host_data,
+                disk_budget=disk_budget,
+            ),
+        ),
+        # Read sketch and cohort similarity, duplicates are not short-circuited
+        # locally since the previous results live on Latch
+        Stage(
+            "sketch_sample",
+            sketch_sample,
+            SMALL,
+            ("map_to_host",),
+            lambda r: dict(
+                read_dir=r["map_to_host"],
+                sample_name=sample_name,
+                sketch_index=sketch_index,
+                duplicate_jaccard=0.95,
+                # The local DAG has no branch reusing a duplicate's results
+                skip_duplicates=False,
+            ),
+        ),
+        # Kaiju taxonomic classification
+        Stage(
+            "taxonomy_classification_task",
+            taxonomy_classification_task,
+            LARGE,
+            ("map_to_host",),
+            lambda r: dict(
+                read_dir=r["map_to_host"],
+                kaiju_ref_db=kaiju_ref_db,
+                kaiju_ref_nodes=kaiju_ref_nodes,
+                sample=sample_name,
+            ),
+        ),
+        Stage(
+            "kaiju2table_task",
+            kaiju2table_task,
+            SMALL,
+            ("taxonomy_classification_task",),
+            lambda r: dict(
+                kaiju_out=r["taxonomy_classification_task"],
+                sample=sample_name,
+                kaiju_ref_nodes=kaiju_ref_nodes,
+                kaiju_ref_names=kaiju_ref_names,
+                taxon=taxon_rank,
+            ),
+        ),
+        Stage(
+            "abundance_matrices",
+            abundance_matrices,
+            SMALL,
+            ("kaiju2table_task",),
+            lambda r: dict(
+                kaiju_table=r["kaiju2table_task"],
+                sample_name=sample_name,
+            ),
+        ),
+        Stage(
+            "kaiju2krona_task",
+            kaiju2krona_task,
+            SMALL,
+            ("taxonomy_classification_task",),
+            lambda r: dict(
+                kaiju_out=r["taxonomy_classification_task"],
+                sample=sample_name,
+                kaiju_ref_nodes=kaiju_ref_nodes,
+                kaiju_ref_names=kaiju_ref_names,
+            ),
+        ),
+        Stage(
+            "plot_krona_task",
+            plot_krona_task,
+            SMALL,
+            ("kaiju2krona_task",),
+            lambda r: dict(krona_txt=r["kaiju2krona_task"], sample=sample_name),
+        ),
+        # Assembly
+        Stage(
+            "check_reads",
+            check_reads,
+            SMALL,
+            ("map_to_host",),
+            lambda r: dict(
+                read_dir=r["map_to_host"],
+                sample_name=sample_name,
+                min_read_pairs=min_read_pairs,
+            ),
+        ),
+        Stage(
+            "megahit",
+            megahit,
+            LARGE,
+            ("map_to_host", "check_reads"),
+            lambda r: dict(
+                read_dir=r["map_to_host"],
+                sample_name=sample_name,
+                min_count=min_count,
+                k_min=k_min,
+                k_max=k_max,
+                k_step=k_step,
+                min_contig_len=min_contig_len,
+                disk_budget=disk_budget,
+            ),
+            enabled=lambda r: r["check_reads"][1],
+        ),
+        Stage(
+            "assembly_stats",
+            assembly_stats,
+            SMALL,
+            ("megahit",),
+            lambda r: dict(assembly_dir=r["megahit"], sample_name=sample_name),
+        ),
+        Stage(
+            "check_assembly",
+            check_assembly,
+            SMALL,
+            ("assembly_stats",),
+            lambda r: dict(
+                assembly_report=r["assembly_stats"],
+                sample_name=sample_name,
+                min_contigs=min_contigs,
+                min_assembly_bases=min_assembly_bases,
+            ),
+        ),
+    ] + contig_stages(
+        sample_name=sample_name,
+        run_metaquast=run_metaquast,
+        metaquast_min_contig=metaquast_min_contig,
+        prodigal_output_format=prodigal_output_format,
+        fargene_hmm_model=fargene_hmm_model,
+        prodigal_min_len=prodigal_min_len,
+        macrel_min_len=macrel_min_len,
+        fargene_min_len=fargene_min_len,
+        gecco_min_len=gecco_min_len,
+        macrel_cache=macrel_cache,
+        fargene_cache=fargene_cache,
+        annotation_chunk_bases=annotation_chunk_bases,
+        metabat_sweep=metabat_sweep,
+        disk_budget=disk_budget,
+        pack_bins=pack_bins,
+    )
+
+
+def contig_stages(
+    sample_name: str,
+    run_metaquast: bool = False,
+    metaquast_min_contig: int = 500,
+    prodigal_output_format: ProdigalOutput = ProdigalOutput.gbk,
+    fargene_hmm_model: fARGeneModel = fARGeneModel.class_a,
+    prodigal_min_len: int = 200,
+    macrel_min_len: int = 200,
+    fargene_min_len: int = 500,
+    gecco_min_len: int = 1000,
+    macrel_cache: Optional[LatchFile] = None,
+    fargene_cache: Optional[LatchFile] = None,
+    annotation_chunk_bases: int = 100_000_000,
+    metabat_sweep: Optional[MetabatSweep] = None,
+    disk_budget: bool = False,
+    pack_bins: bool = False,
+) -> List[Stage]:
+    """The stages run on a checked assembly: evaluation, binning and annotation
+
+    They depend on the "map_to_host", "megahit" and "check_assembly" results.
+    """
+
+    return [
+        # Assembly evaluation
+        Stage(
+            "metaquast",
+            metaquast,
+            SMALL,
+            ("megahit", "check_assembly"),
+            lambda r: dict(
+                assembly_dir=r["megahit"],
+                sample_name=sample_name,
+                run_metaquast=run_metaquast,
+                metaquast_min_contig=metaquast_min_contig,
+            ),
+            enabled=lambda r: r["check_assembly"][1],
+        ),
+        # Binning
+        Stage(
+            "bowtie_assembly_build",
+            bowtie_assembly_build,
+            LARGE,
+            ("megahit", "check_assembly"),
+            lambda r: dict(assembly_dir=r["megahit"], sample_name=sample_name),
+            enabled=lambda r: r["check_assembly"][1],
+        ),
+        Stage(
+            "bowtie_assembly_align",
+            bowtie_assembly_align,
+            LARGE,
+            ("bowtie_assembly_build", "map_to_host"),
+            lambda r: dict(
+                assembly_idx=r["bowtie_assembly_build"],
+                read_dir=r["map_to_host"],
+                sample_name=sample_name,
+                disk_budget=disk_budget,
+            ),
+        ),
+        Stage(
+            "summarize_contig_depths",
+            summarize_contig_depths,
+            SMALL,
+            ("bowtie_assembly_align",),
+            lambda r: dict(
+                assembly_bam=r["bowtie_assembly_align"], sample_name=sample_name
+            ),
+        ),
+        Stage(
+            "metabat2",
+            metabat2,
+            LARGE,
+            ("megahit", "summarize_contig_depths"),
+            lambda r: dict(
+                assembly_dir=r["megahit"],
+                depth_file=r["summarize_contig_depths"],
+                sample_name=sample_name,
+                sweep=metabat_sweep,
+                disk_budget=disk_budget,
+                pack_bins=pack_bins,
+            ),
+        ),
+        # Functional annotation
+        Stage(
+            "filter_contigs",
+            filter_contigs,
+            SMALL,
+            ("megahit", "check_assembly"),
+            lambda r: dict(
+                assembly_dir=r["megahit"],
+                sample_name=sample_name,
+                prodigal_min_len=prodigal_min_len,
+                macrel_min_len=macrel_min_len,
+                fargene_min_len=fargene_min_len,
+                gecco_min_len=gecco_min_len,
+            ),
+            enabled=lambda r: r["check_assembly"][1],
+        ),
+        Stage(
+            "prodigal",
+            prodigal,
+            LARGE,
+            ("filter_contigs",),
+            lambda r: dict(
+                contigs=r["filter_contigs"][0],
+                sample_name=sample_name,
+                output_format=prodigal_output_format,
+            ),
+        ),
+        Stage(
+            "chunk_macrel_contigs",
+            chunk_macrel_contigs,
+            SMALL,
+            ("filter_contigs",),
+            lambda r: dict(
+                contigs=r["filter_contigs"][1],
+                sample_name=sample_name,
+                annotation_cache=macrel_cache,
+                chunk_bases=annotation_chunk_bases,
+            ),
+        ),
+        Stage(
+            "macrel",
+            macrel,
+            SMALL,
+            ("chunk_macrel_contigs",),
+            lambda r: dict(chunk=r["chunk_macrel_contigs"]),
+            mapped="chunk",
+        ),
+        Stage(
+            "merge_macrel",
+            merge_macrel,
+            SMALL,
+            ("macrel",),
+            lambda r: dict(
+                chunk_dirs=r["macrel"],
+                sample_name=sample_name,
+                annotation_cache=macrel_cache,
+            ),
+        ),
+        Stage(
+            "chunk_fargene_contigs",
+            chunk_fargene_contigs,
+            SMALL,
+            ("filter_contigs",),
+            lambda r: dict(
+                contigs=r["filter_contigs"][2],
+                sample_name=sample_name,
+                hmm_model=fargene_hmm_model,
+                annotation_cache=fargene_cache,
+                chunk_bases=annotation_chunk_bases,
+            ),
+        ),
+        Stage(
+            "fargene",
+            fargene,
+            SMALL,
+            ("chunk_fargene_contigs",),
+            lambda r: dict(chunk=r["chunk_fargene_contigs"]),
+            mapped="chunk",
+        ),
+        Stage(
+            "merge_fargene",
+            merge_fargene,
+            SMALL,
+            ("fargene",),
+            lambda r: dict(
+                chunk_dirs=r["fargene"],
+                sample_name=sample_name,
+                hmm_model=fargene_hmm_model,
+                annotation_cache=fargene_cache,
+            ),
+        ),
+        Stage(
+            "chunk_gecco_contigs",
+            chunk_gecco_contigs,
+            SMALL,
+            ("filter_contigs",),
+            lambda r: dict(
+                contigs=r["filter_contigs"][3],
+                sample_name=sample_name,
+                chunk_bases=annotation_chunk_bases,
+            ),
+        ),
+        Stage(
+            "gecco",
+            gecco,
+            SMALL,
+            ("chunk_gecco_contigs",),
+            lambda r: dict(chunk=r["chunk_gecco_contigs"]),
+            mapped="chunk",
+        ),
+        Stage(
+            "merge_gecco",
+            merge_gecco,
+            SMALL,
+            ("gecco",),
+            lambda r: dict(chunk_dirs=r["gecco"], sample_name=sample_name),
+        ),
+    ]
+
+
+def _available_memory_gib() -> int:
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemTotal:"):
+                    return int(line.split()[1]) // (1024 * 1024)
+    except OSError:
+        pass
+    return 16
+
+
+def run_local(
+    stages: List[Stage],
+    outdir: Path,
+    cpus: Optional[int] = None,
+    memory_gib: Optional[int] = None,
+    tools_dir: Optional[str] = None,
+    initial_results: Optional[Dict[str, Any]] = None,
+) -> Tuple[Dict[str, Any], List[TimelineEntry]]:
+    """Run the stages as soon as their dependencies and resources allow
+
+    The elements of a mapped stage are scheduled like stages of their own,
+    each with the stage's resources, and the stage is done when all of
+    them are. Stages requesting more than the whole budget are clamped to
+    it, so they still run, just alone. Stages downstream of a failed or
+    skipped stage are not started. `initial_results` stands in for the results of
+    stages that ran elsewhere. Returns the stage results and the execution
+    timeline.
+    """
+
+    cpus = cpus or os.cpu_count() or 1
+    memory_gib = memory_gib or _available_memory_gib()
+    outdir = outdir.resolve()
+
+    pending = {stage.name: stage for stage in stages}
+    results: Dict[str, Any] = dict(initial_results or {})
+    failed = set()
+    skipped = set()
+    timeline: List[TimelineEntry] = []
+    # Stages, or mapped elements, whose dependencies are done: (stage,
+    # element index or None, working directory, inputs)
+    ready: List[Tuple[Stage, Optional[int], Path, Dict[str, Any]]] = []
+    # Results of the elements of the mapped stages in progress
+    mapped_results: Dict[str, List[Any]] = {}
+    running = {}
+    free_cpus, free_memory = cpus, memory_gib
+    started = time.monotonic()
+
+    with ProcessPoolExecutor(max_workers=max(1, cpus)) as executor:
+        while pending or ready or running:
+            pending_before = len(pending)
+            for name, stage in list(pending.items()):
+                now = time.monotonic() - started
+                if any(dep in failed for dep in stage.depends_on):
+                    del pending[name]
+                    failed.add(name)
+                    timeline.append(
+                        TimelineEntry(
+                            name, 0, 0, now, now, "skipped", "upstream failure"
+                        )
+                    )
+                    continue
+                if any(dep in skipped for dep in stage.depends_on):
+                    del pending[name]
+                    skipped.add(name)
+                    timeline.append(
+                        TimelineEntry(name, 0, 0, now, now, "skipped", "upstream skip")
+                    )
+                    continue
+                if not all(dep in results for dep in stage.depends_on):
+                    continue
+                if not stage.enabled(results):
+                    del pending[name]
+                    skipped.add(name)
+                    timeline.append(
+                        TimelineEntry(name, 0, 0, now, now, "skipped", "stage check")
+                    )
+                    continue
+
+                del pending[name]
+                inputs = stage.inputs(results)
+                if stage.mapped is None:
+                    ready.append((stage, None, outdir.joinpath(name), inputs))
+                    continue
+                elements = inputs[stage.mapped]
+                if not elements:
+                    results[name] = []
+                    timeline.append(TimelineEntry(name, 0, 0, now, now, "done"))
+                    continue
+                mapped_results[name] = [None] * len(elements)
+                for i, element in enumerate(elements):
+                    ready.append(
+                        (
+                            stage,
+                            i,
+                            outdir.joinpath(name, f"{stage.mapped}_{i}"),
+                            {**inputs, stage.mapped: element},
+                        )
+                    )
+
+            for job in list(ready):
+                stage, index, workdir, inputs = job
+                need_cpus = min(stage.resources[0], cpus)
+                need_memory = min(stage.resources[1], memory_gib)
+                if need_cpus > free_cpus or need_memory > free_memory:
+                    continue
+
+                free_cpus -= need_cpus
+                free_memory -= need_memory
+                ready.remove(job)
+                entry = TimelineEntry(
+                    stage.name if index is None else f"{stage.name}[{index}]",
+                    need_cpus,
+                    need_memory,
+                    time.monotonic() - started,
+                )
+                timeline.append(entry)
+                future = executor.submit(
+                    _run_stage,
+                    _task_reference(stage.task),
+                    str(workdir),
+                    tools_dir,
+                    _to_plain(inputs),
+                )
+                running[future] = (stage, index, entry)
+
+            if not running:
+                if len(pending) < pending_before:
+                    # Skipped stages may decide the stages downstream of them
+                    continue
+                # Nothing runs and every stage fits an idle budget, so the
+                # remaining stages wait for results that will never come
+                unsatisfiable = [
+                    f"{name} (needs {', '.join(set(stage.depends_on) - set(results))})"
+                    for name, stage in pending.items()
+                ]
+                raise ValueError(
+                    "Stages with unsatisfiable dependencies: "
+                    + ", ".join(unsatisfiable)
+                )
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, index, entry = running.pop(future)
+                entry.end = time.monotonic() - started
+                free_cpus += entry.cpus
+                free_memory += entry.memory_gib
+                try:
+                    result = _from_plain(future.result())
+                    entry.status = "done"
+                except Exception as e:
+                    entry.status = "failed"
+                    entry.error = repr(e)
+                    failed.add(stage.name)
+                    # The other elements of a failed mapped stage are not started
+                    ready = [job for job in ready if job[0] is not stage]
+                    mapped_results.pop(stage.name, None)
+                    continue
+
+                if index is None:
+                    results[stage.name] = result
+                elif stage.name in mapped_results:
+                    element_results = mapped_results[stage.name]
+                    element_results[index] = result
+                    if not any(job[0] is stage for job in ready) and not any(
+                        s is stage for s, _, _ in running.values()
+                    ):
+                        results[stage.name] = mapped_results.pop(stage.name)
+
+    return results, timeline
+
+
+def write_timeline(timeline: List[TimelineEntry], path: Path):
+    """Write the timeline as JSON and as a sorted, human-readable TSV"""
+
+    ordered = sorted(timeline, key=lambda entry: entry.start)
+    with open(path.with_suffix(".json"), "w") as f:
+        json.dump([dataclasses.asdict(entry) for entry in ordered], f, indent=2)
+
+    with open(path.with_suffix(".tsv"), "w") as f:
+        f.write("stage\tstatus\tcpus\tmemory_gib\tstart_s\tend_s\tduration_s\n")
+        for entry in ordered:
+            f.write(
+                f"{entry.stage}\t{entry.status}\t{entry.cpus}\t{entry.memory_gib}\t"
+                f"{entry.start:.1f}\t{entry.end:.1f}\t{entry.end - entry.start:.1f}\n"
+            )
+
+
+def _enum_arg(enum: type) -> Callable[[str], Enum]:
+    return lambda value: enum(value)
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--read1", required=True, nargs="+", help="One file per lane")
+    parser.add_argument("--read2", required=True, nargs="+", help="One file per lane")
+    parser.add_argument("--host-genome", required=True)
+    parser.add_argument("--host-name", required=True)
+    parser.add_argument("--kaiju-db", required=True)
+    parser.add_argument("--kaiju-nodes", required=True)
+    parser.add_argument("--kaiju-names", required=True)
+    parser.add_argument("--sample-name", default="metamage_sample")
+    parser.add_argument("--preview-read-pairs", type=int, default=100_000)
+    parser.add_argument("--sketch-index", help="Directory of a cohort sketch index")
+    parser.add_argument("--outdir", default="metamage_local", type=Path)
+    parser.add_argument("--cpus", type=int, help="Global CPU budget")
+    parser.add_argument("--memory-gib", type=int, help="Global memory budget")
+    parser.add_argument(
+        "--tools-dir",
+        default="/root" if Path("/root/bowtie2").exists() else None,
+        help="Directory containing the bowtie2 installation",
+    )
+    parser.add_argument(
+        "--taxon-rank", type=_enum_arg(TaxonRank), default=TaxonRank.species
+    )
+    parser.add_argument("--min-read-pairs", type=int, default=10_000)
+    parser.add_argument("--min-count", type=int, default=2)
+    parser.add_argument("--k-min", type=int, default=21)
+    parser.add_argument("--k-max", type=int, default=141)
+    parser.add_argument("--k-step", type=int, default=12)
+    parser.add_argument("--min-contig-len", type=int, default=200)
+    parser.add_argument("--run-metaquast", action="store_true")
+    parser.add_argument("--metaquast-min-contig", type=int, default=500)
+    parser.add_argument("--min-contigs", type=int, default=10)
+    parser.add_argument("--min-assembly-bases", type=int, default=100_000)
+    parser.add_argument(
+        "--prodigal-output-format",
+        type=_enum_arg(ProdigalOutput),
+        default=ProdigalOutput.gbk,
+    )
+    parser.add_argument(
+        "--fargene-hmm-model",
+        type=_enum_arg(fARGeneModel),
+        default=fARGeneModel.class_a,
+    )
+    parser.add_argument("--prodigal-min-len", type=int, default=200)
+    parser.add_argument("--macrel-min-len", type=int, default=200)
+    parser.add_argument("--fargene-min-len", type=int, default=500)
+    parser.add_argument("--gecco-min-len", type=int, default=1000)
+    parser.add_argument("--macrel-cache")
+    parser.add_argument("--fargene-cache")
+    parser.add_argument("--annotation-chunk-bases", type=int, default=100_000_000)
+    parser.add_argument(
+        "--metabat-min-contig",
+        type=int,
+        nargs="+",
+        default=METABAT_DEFAULTS.min_contig,
+        help="Several values sweep MetaBAT2 settings, like the other --metabat-*",
+    )
+    parser.add_argument(
+        "--metabat-max-edges", type=int, nargs="+", default=METABAT_DEFAULTS.max_edges
+    )
+    parser.add_argument(
+        "--metabat-seed", type=int, nargs="+", default=METABAT_DEFAULTS.seed
+    )
+    parser.add_argument(
+        "--disk-budget",
+        action="store_true",
+        help="Keep tool temporary files in a scratch area removed after each tool",
+    )
+    parser.add_argument(
+        "--pack-bins",
+        action="store_true",
+        help="Pack the MetaBAT2 bins into one indexed, bgzipped FASTA",
+    )
+    args = parser.parse_args(argv)
+    if len(args.read1) != len(args.read2):
+        parser.error("--read1 and --read2 must list the same number of lanes")
+
+    def local_file(path: Optional[str]) -> Optional[LatchFile]:
+        return LatchFile(str(Path(path).resolve())) if path else None
+
+    stages = metamage_stages(
+        sample=Sample(
+            read1=local_file(args.read1[0]),
+            read2=local_file(args.read2[0]),
+            additional_lanes=[
+                Lane(read1=local_file(r1), read2=local_file(r2))
+                for r1, r2 in zip(args.read1[1:], args.read2[1:])
+            ],
+        ),
+        host_data=HostData(
+            host_name=args.host_name, host_genome=local_file(args.host_genome)
+        ),
+        kaiju_ref_db=local_file(args.kaiju_db),
+        kaiju_ref_nodes=local_file(args.kaiju_nodes),
+        kaiju_ref_names=local_file(args.kaiju_names),
+        sample_name=args.sample_name,
+        preview_read_pairs=args.preview_read_pairs,
+        sketch_index=(
+            LatchDir(str(Path(args.sketch_index).resolve()))
+            if args.sketch_index
+            else None
+        ),
+        taxon_rank=args.taxon_rank,
+        min_read_pairs=args.min_read_pairs,
+        min_count=args.min_count,
+        k_min=args.k_min,
+        k_max=args.k_max,
+        k_step=args.k_step,
+        min_contig_len=args.min_contig_len,
+        run_metaquast=args.run_metaquast,
+        metaquast_min_contig=args.metaquast_min_contig,
+        min_contigs=args.min_contigs,
+        min_assembly_bases=args.min_assembly_bases,
+        prodigal_output_format=args.prodigal_output_format,
+        fargene_hmm_model=args.fargene_hmm_model,
+        prodigal_min_len=args.prodigal_min_len,
+        macrel_min_len=args.macrel_min_len,
+        fargene_min_len=args.fargene_min_len,
+        gecco_min_len=args.gecco_min_len,
+        macrel_cache=local_file(args.macrel_cache),
+        fargene_cache=local_file(args.fargene_cache),
+        annotation_chunk_bases=args.annotation_chunk_bases,
+        metabat_sweep=MetabatSweep(
+            min_contig=args.metabat_min_contig,
+            max_edges=args.metabat_max_edges,
+            seed=args.metabat_seed,
+        ),
+        disk_budget=args.disk_budget,
+        pack_bins=args.pack_bins,
+    )
+
+    args.outdir.mkdir(parents=True, exist_ok=True)
+    _, timeline = run_local(
+        stages, args.outdir, args.cpus, args.memory_gib, args.tools_dir
+    )
+    write_timeline(timeline, args.outdir.joinpath("timeline"))
+
+    for entry in sorted(timeline, key=lambda entry: entry.start):
+        print(f"{entry.stage:<32}{entry.status:<10}{entry.end - entry.start:>10.1f}s")
+
+    if any(entry.failed for entry in timeline):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
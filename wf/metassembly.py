@@ -2,33 +2,37 @@
 Read assembly and evaluation for metagenomics data
 """
 
+import json
 import subprocess
 from pathlib import Path
-from typing import Tuple
+from typing import List, Optional, Tuple
 
 from latch import large_task, message, small_task, workflow
 from latch.types import LatchDir
 
+from .disk import DiskBudget
+from .publish import ProgressivePublisher
+from .stats import assembly_summary, fasta_length_gc, length_histogram
+from .threads import tool_threads
+from .validation import validate_fasta
 
-@large_task
-def megahit(
-    read_dir: LatchDir,
+
+def build_megahit_cmd(
+    read1: str,
+    read2: str,
+    output_dir: str,
     sample_name: str,
     min_count: int,
     k_min: int,
     k_max: int,
     k_step: int,
     min_contig_len: int,
-) -> LatchDir:
-
-    # Read files
-    read1 = Path(read_dir.local_path, f"{sample_name}_unaligned.fastq.1.gz")
-    read2 = Path(read_dir.local_path, f"{sample_name}_unaligned.fastq.2.gz")
-
-    output_dir_name = "MEGAHIT"
-    output_dir = Path(output_dir_name).resolve()
+    tmp_dir: Optional[str] = None,
+    threads: Optional[int] = None,
+) -> List[str]:
+    """MEGAHIT uses every CPU of the node unless `threads` is given"""
 
-    _megahit_cmd = [
+    return [
         "/root/megahit",
         "--min-count",
         str(min_count),
@@ -39,16 +43,55 @@ def megahit(
         "--k-step",
         str(k_step),
         "--out-dir",
-        output_dir_name,
+        output_dir,
         "--out-prefix",
         sample_name,
         "--min-contig-len",
         str(min_contig_len),
         "-1",
-        str(read1),
+        read1,
         "-2",
-        str(read2),
+        read2,
+        *(["--tmp-dir", tmp_dir] if tmp_dir else []),
+        *(["--num-cpu-threads", str(threads)] if threads else []),
     ]
+
+
+@large_task
+def megahit(
+    read_dir: LatchDir,
+    sample_name: str,
+    min_count: int,
+    k_min: int,
+    k_max: int,
+    k_step: int,
+    min_contig_len: int,
+    disk_budget: bool,
+) -> LatchDir:
+
+    # Read files
+    read1 = Path(read_dir.local_path, f"{sample_name}_unaligned.fastq.1.gz")
+    read2 = Path(read_dir.local_path, f"{sample_name}_unaligned.fastq.2.gz")
+
+    output_dir_name = "MEGAHIT"
+    output_dir = Path(output_dir_name).resolve()
+
+    budget = DiskBudget("megahit", disk_budget, [read_dir, output_dir])
+    tmp_dir = budget.tmp_dir("megahit")
+
+    _megahit_cmd = build_megahit_cmd(
+        str(read1),
+        str(read2),
+        output_dir_name,
+        sample_name,
+        min_count,
+        k_min,
+        k_max,
+        k_step,
+        min_contig_len,
+        tmp_dir=str(tmp_dir) if tmp_dir else None,
+        threads=tool_threads("megahit", 0) or None,
+    )
     message(
         "info",
         {
@@ -56,31 +99,111 @@ def megahit(
             "body": f"Command: {' '.join(_megahit_cmd)}",
         },
     )
-    subprocess.run(_megahit_cmd)
 
-    return LatchDir(
-        str(output_dir), f"latch:///metamage/{sample_name}/{output_dir_name}"
+    # Intermediate k-mer assemblies are published as each k finishes, the
+    # temporary directory is not published
+    publisher = ProgressivePublisher(
+        output_dir,
+        f"latch:///metamage/{sample_name}/{output_dir_name}",
+        include=lambda path: "tmp" not in path.relative_to(output_dir).parts,
     )
+    with budget, publisher:
+        subprocess.run(_megahit_cmd, check=True)
+        budget.release(read_dir)
+        validate_fasta(output_dir.joinpath(f"{sample_name}.contigs.fa"))
+
+    return publisher.latch_dir()
 
 
 @small_task
-def metaquast(
+def assembly_stats(
     assembly_dir: LatchDir,
     sample_name: str,
 ) -> LatchDir:
+    """Compute N50, L50, total length, GC and length histogram of the assembly"""
 
     assembly_name = f"{sample_name}.contigs.fa"
     assembly_fasta = Path(assembly_dir.local_path, assembly_name)
 
+    output_dir_name = "assembly_stats"
+    output_dir = Path(output_dir_name).resolve()
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    message(
+        "info",
+        {
+            "title": "Computing assembly statistics",
+            "body": f"Assembly: {assembly_name}",
+        },
+    )
+    lengths, gc_counts, acgt_counts = fasta_length_gc(assembly_fasta)
+    summary = assembly_summary(lengths, gc_counts, acgt_counts)
+    histogram = length_histogram(lengths)
+
+    with open(output_dir.joinpath(f"{sample_name}_assembly_stats.json"), "w") as f:
+        json.dump({"sample": sample_name, **summary}, f, indent=2)
+
+    with open(output_dir.joinpath(f"{sample_name}_assembly_stats.tsv"), "w") as f:
+        f.write(f"Assembly\t{sample_name}\n")
+        for key, value in summary.items():
+            f.write(f"{key}\t{value}\n")
+
+    with open(output_dir.joinpath(f"{sample_name}_length_histogram.tsv"), "w") as f:
+        f.write("bin_start\tbin_end\tcontigs\tbases\n")
+        for row in zip(*histogram.values()):
+            f.write("\t".join(str(value) for value in row) + "\n")
+
+    message(
+        "info",
+        {
+            "title": "Assembly statistics",
+            "body": f"Contigs: {summary['contigs']}, "
+            f"total length: {summary['total_length']}, "
+            f"N50: {summary['N50']}, L50: {summary['L50']}, "
+            f"GC: {summary['GC (%)']}%",
+        },
+    )
+
+    return LatchDir(
+        str(output_dir), f"latch:///metamage/{sample_name}/{output_dir_name}"
+    )
+
+
+@small_task
+def metaquast(
+    assembly_dir: LatchDir,
+    sample_name: str,
+    run_metaquast: bool,
+    metaquast_min_contig: int,
+) -> LatchDir:
+
     output_dir_name = "MetaQuast"
     output_dir = Path(output_dir_name).resolve()
 
+    if not run_metaquast:
+        message(
+            "info",
+            {
+                "title": "Skipping MetaQuast",
+                "body": "Assembly statistics are available in assembly_stats",
+            },
+        )
+        output_dir.mkdir(parents=True, exist_ok=True)
+        return LatchDir(
+            str(output_dir), f"latch:///metamage/{sample_name}/{output_dir_name}"
+        )
+
+    assembly_name = f"{sample_name}.contigs.fa"
+    assembly_fasta = Path(assembly_dir.local_path, assembly_name)
+
     _metaquast_cmd = [
         "/root/metaquast.py",
         "--rna-finding",
         "--no-sv",
         "--max-ref-number",
         "0",
+        "--min-contig",
+        str(metaquast_min_contig),
         "-l",
         sample_name,
         "-o",
@@ -94,13 +217,20 @@ def metaquast(
             "body": f"Command: {' '.join(_metaquast_cmd)}",
         },
     )
-    subprocess.run(_metaquast_cmd)
+    subprocess.run(_metaquast_cmd, check=True)
 
     return LatchDir(
         str(output_dir), f"latch:///metamage/{sample_name}/{output_dir_name}"
     )
 
 
+# The branch taken when MetaQuast is off: the workflow only binds its output
+# to its (empty) input, so no task is started
+@workflow
+def skip_metaquast(metaquast_dir: Optional[LatchDir] = None) -> Optional[LatchDir]:
+    return metaquast_dir
+
+
 @workflow
 def assembly_wf(
     read_dir: LatchDir,
@@ -110,6 +240,7 @@ def assembly_wf(
     k_max: int,
     k_step: int,
     min_contig_len: int,
+    disk_budget: bool,
 ) -> Tuple[LatchDir, LatchDir]:
 
     # Assembly
@@ -121,7 +252,8 @@ def assembly_wf(
         k_max=k_max,
         k_step=k_step,
         min_contig_len=min_contig_len,
+        disk_budget=disk_budget,
     )
-    metassembly_results = metaquast(assembly_dir=assembly_dir, sample_name=sample_name)
+    assembly_report = assembly_stats(assembly_dir=assembly_dir, sample_name=sample_name)
 
-    return assembly_dir, metassembly_results
+    return assembly_dir, assembly_report
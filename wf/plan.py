@@ -0,0 +1,602 @@
+"""
+Dry-run planning of a metamage run: runtime, memory and cost per stage
+
+Nothing is run. The input sizes are read (from the Latch metadata for
+latch:// paths), read and host genome base counts are estimated by
+decompressing a few compressed blocks, and a linear scaling model per
+stage turns them into wall time, peak memory and node-hours for every
+task of the DAG. Stages whose estimated memory exceeds what their task
+decorator requests are flagged as likely OOMs.
+
+The default models are rough priors. They are calibrated by recording
+finished local runs (see wf/local.py) and passing the records back:
+
+    python -m wf.plan estimate --read1 r1.fq.gz --read2 r2.fq.gz \\
+        --host-genome host.fa.gz --kaiju-db db.fmi --calibration runs.jsonl
+
+    python -m wf.plan record --read1 r1.fq.gz --read2 r2.fq.gz \\
+        --host-genome host.fa.gz --kaiju-db db.fmi \\
+        --outdir metamage_local --records runs.jsonl --peak-memory megahit=38
+"""
+
+import argparse
+import dataclasses
+import json
+import math
+import os
+import zlib
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .local import LARGE, SMALL, contig_stages, metamage_stages
+from .seqio import is_gzipped
+from .types import HostData, Lane, Sample
+
+# Compressed bytes decompressed per sampled block
+SAMPLE_BYTES = 4 * 1024 * 1024
+SAMPLED_BLOCKS = 8
+
+# Used when a file can't be sampled (remote inputs): bases per stored byte
+DEFAULT_FASTQ_GZ_BASES_PER_BYTE = 1.7
+DEFAULT_FASTA_GZ_BASES_PER_BYTE = 3.3
+DEFAULT_READ_LENGTH = 150
+
+# Assembled bases per raw read base, until calibrated from assembly_stats
+ASSEMBLY_FRACTION = 0.05
+
+BGZF_MAGIC = b"\x1f\x8b\x08\x04"
+
+
+@dataclass
+class StageModel:
+    """Wall time and peak memory as linear functions of one input feature each"""
+
+    time_feature: str
+    seconds: float
+    seconds_per_unit: float
+    memory_feature: str
+    memory_gib: float
+    memory_gib_per_unit: float
+
+    def predict(self, features: Dict[str, float]) -> Tuple[float, float]:
+        return (
+            self.seconds + self.seconds_per_unit * features[self.time_feature],
+            self.memory_gib + self.memory_gib_per_unit * features[self.memory_feature],
+        )
+
+
+# Features: read_gbp (raw bases, both mates), host_gbp, kaiju_gib (database
+# size), assembly_gbp and chunk_gbp (bases of one annotation chunk)
+DEFAULT_MODELS: Dict[str, StageModel] = {
+    "subsample_reads": StageModel("read_gbp", 30, 60, "read_gbp", 1, 0),
+    "preview_classification_task": StageModel("kaiju_gib", 60, 20, "kaiju_gib", 2, 1.1),
+    "fastp": StageModel("read_gbp", 30, 120, "read_gbp", 1, 0),
+    "build_bowtie_index": StageModel("host_gbp", 300, 1200, "host_gbp", 1, 2),
+    "map_to_host": StageModel("read_gbp", 120, 400, "host_gbp", 2, 1.3),
+    # Reuses the k-mers sampled by map_to_host
+    "sketch_sample": StageModel("read_gbp", 20, 0, "read_gbp", 1, 0),
+    "taxonomy_classification_task": StageModel(
+        "read_gbp", 120, 300, "kaiju_gib", 2, 1.1
+    ),
+    "kaiju2table_task": StageModel("read_gbp", 30, 10, "read_gbp", 2, 0),
+    "abundance_matrices": StageModel("read_gbp", 20, 0, "read_gbp", 0.5, 0),
+    "kaiju2krona_task": StageModel("read_gbp", 30, 10, "read_gbp", 2, 0),
+    "plot_krona_task": StageModel("read_gbp", 30, 0, "read_gbp", 1, 0),
+    "check_reads": StageModel("read_gbp", 10, 40, "read_gbp", 0.5, 0),
+    "megahit": StageModel("read_gbp", 300, 1800, "read_gbp", 4, 4),
+    "assembly_stats": StageModel("assembly_gbp", 10, 60, "assembly_gbp", 0.5, 2),
+    "check_assembly": StageModel("assembly_gbp", 10, 0, "assembly_gbp", 0.5, 0),
+    "metaquast": StageModel("assembly_gbp", 60, 3000, "assembly_gbp", 1, 8),
+    "bowtie_assembly_build": StageModel("assembly_gbp", 60, 2400, "assembly_gbp", 1, 2),
+    "bowtie_assembly_align": StageModel("read_gbp", 60, 300, "assembly_gbp", 2, 1.5),
+    "summarize_contig_depths": StageModel(
+        "assembly_gbp", 30, 300, "assembly_gbp", 0.5, 1
+    ),
+    "metabat2": StageModel("assembly_gbp", 60, 1200, "assembly_gbp", 2, 6),
+    "filter_contigs": StageModel("assembly_gbp", 10, 120, "assembly_gbp", 0.5, 4),
+    "prodigal": StageModel("assembly_gbp", 60, 3600, "assembly_gbp", 0.5, 1),
+    "chunk_macrel_contigs": StageModel(
+        "assembly_gbp", 10, 60, "assembly_gbp", 0.5, 0.5
+    ),
+    "macrel": StageModel("chunk_gbp", 60, 3000, "chunk_gbp", 1, 8),
+    "merge_macrel": StageModel("assembly_gbp", 10, 60, "assembly_gbp", 0.5, 1),
+    "chunk_fargene_contigs": StageModel(
+        "assembly_gbp", 10, 60, "assembly_gbp", 0.5, 0.5
+    ),
+    "fargene": StageModel("chunk_gbp", 60, 6000, "chunk_gbp", 1, 4),
+    "merge_fargene": StageModel("assembly_gbp", 10, 60, "assembly_gbp", 0.5, 1),
+    "chunk_gecco_contigs": StageModel("assembly_gbp", 10, 60, "assembly_gbp", 0.5, 0.5),
+    "gecco": StageModel("chunk_gbp", 120, 12000, "chunk_gbp", 2, 10),
+    "merge_gecco": StageModel("assembly_gbp", 10, 60, "assembly_gbp", 0.5, 1),
+}
+
+
+@dataclass
+class StageEstimate:
+    stage: str
+    cpus: int
+    memory_limit_gib: int
+    instances: int
+    seconds: float
+    peak_memory_gib: float
+    node_hours: float
+    cost: float
+    start: float = 0.0
+    finish: float = 0.0
+    critical: bool = False
+    oom: bool = False
+
+
+def _file_size(path: str) -> int:
+    if path.startswith("latch://"):
+        from latch.ldata.path import LPath
+
+        return LPath(path).size()
+    return os.path.getsize(path)
+
+
+def _compression_ratio(path: str, size: int) -> float:
+    """Decompressed bytes per stored byte, averaged over sampled blocks
+
+    Plain gzip can only be entered at its start. Block-compressed (BGZF)
+    files are also sampled at evenly spaced offsets, from the next block
+    boundary on, since compressibility drifts along a sequencing run.
+    """
+
+    with open(path, "rb") as handle:
+        offsets = [0]
+        if handle.read(4) == BGZF_MAGIC:
+            offsets += [size * i // SAMPLED_BLOCKS for i in range(1, SAMPLED_BLOCKS)]
+
+        stored = decompressed = 0
+        for offset in offsets:
+            handle.seek(offset)
+            block = handle.read(SAMPLE_BYTES)
+            start = block.find(BGZF_MAGIC) if offset else 0
+            if start < 0:
+                continue
+            data = block[start:]
+            while data:
+                inflater = zlib.decompressobj(wbits=31)
+                try:
+                    decompressed += len(inflater.decompress(data))
+                except zlib.error:
+                    # A false block boundary, or the end of the sample
+                    break
+                consumed = len(data) - len(inflater.unused_data)
+                stored += consumed
+                data = inflater.unused_data
+
+    return decompressed / stored if stored else 1.0
+
+
+def _head(path: str, size: int = SAMPLE_BYTES) -> bytes:
+    """The first (decompressed) bytes of a file"""
+
+    with open(path, "rb") as handle:
+        block = handle.read(size)
+    if not block.startswith(b"\x1f\x8b"):
+        return block
+
+    head = []
+    while block:
+        inflater = zlib.decompressobj(wbits=31)
+        try:
+            head.append(inflater.decompress(block))
+        except zlib.error:
+            break
+        block = inflater.unused_data
+    return b"".join(head)
+
+
+def estimate_reads(path: str) -> Tuple[int, int]:
+    """Estimated (records, bases) of a FASTQ file, from sampled blocks"""
+
+    size = _file_size(path)
+    if path.startswith("latch://"):
+        bases = int(size * DEFAULT_FASTQ_GZ_BASES_PER_BYTE)
+        return bases // DEFAULT_READ_LENGTH, bases
+
+    head = _head(path)
+    lines = head.split(b"\n")[:-1]
+    lines = lines[: len(lines) // 4 * 4]
+    if not lines:
+        return 0, 0
+
+    records = len(lines) // 4
+    bases = sum(len(line) for line in lines[1::4])
+    head_bytes = sum(len(line) + 1 for line in lines)
+    ratio = _compression_ratio(path, size) if is_gzipped(path) else 1.0
+    scale = size * ratio / head_bytes
+    if scale <= 1:
+        return records, bases
+    return int(records * scale), int(bases * scale)
+
+
+def estimate_genome_bases(path: str) -> int:
+    """Estimated sequence bases of a (gzipped) FASTA file"""
+
+    size = _file_size(path)
+    if path.startswith("latch://"):
+        compressed = path.endswith(".gz")
+        return int(size * (DEFAULT_FASTA_GZ_BASES_PER_BYTE if compressed else 1))
+
+    head = _head(path)
+    lines = head.split(b"\n")
+    sequence = sum(len(line) for line in lines if not line.startswith(b">"))
+    ratio = _compression_ratio(path, size) if is_gzipped(path) else 1.0
+    return int(size * ratio * sequence / max(len(head), 1))
+
+
+def input_features(
+    sample: Sample,
+    host_data: HostData,
+    kaiju_db: str,
+    annotation_chunk_bases: int,
+    assembly_bases: Optional[int] = None,
+) -> Dict[str, float]:
+    """The size features the stage models are driven by"""
+
+    read_pairs = read_bases = read_bytes = 0
+    for lane in sample.lanes():
+        for i, read_file in enumerate(lane):
+            path = str(getattr(read_file, "remote_path", None) or read_file.local_path)
+            records, bases = estimate_reads(path)
+            read_pairs += records if i == 0 else 0
+            read_bases += bases
+            read_bytes += _file_size(path)
+
+    host = host_data.host_genome
+    host_path = str(getattr(host, "remote_path", None) or host.local_path)
+    if assembly_bases is None:
+        assembly_bases = int(read_bases * ASSEMBLY_FRACTION)
+
+    return {
+        "read_pairs": read_pairs,
+        "read_bytes": read_bytes,
+        "read_gbp": read_bases / 1e9,
+        "host_gbp": estimate_genome_bases(host_path) / 1e9,
+        "kaiju_gib": _file_size(kaiju_db) / 1024**3,
+        "assembly_gbp": assembly_bases / 1e9,
+        "chunk_gbp": min(assembly_bases, annotation_chunk_bases) / 1e9,
+        "annotation_chunks": max(1, math.ceil(assembly_bases / annotation_chunk_bases)),
+    }
+
+
+def load_records(path: Path) -> List[Dict]:
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _fit(
+    records: List[Dict], feature: str, value: str, intercept: float, slope: float
+) -> Tuple[float, float]:
+    """Least-squares (intercept, slope), or the prior rescaled to the records
+
+    With fewer than two distinct feature values a line can't be fitted, and
+    the prior is only scaled by the mean ratio of observed to predicted.
+    """
+
+    points = [
+        (r["features"][feature], r[value])
+        for r in records
+        if r.get(value) is not None and feature in r["features"]
+    ]
+    if not points:
+        return intercept, slope
+
+    x, y = np.array(points, dtype=float).T
+    if len(np.unique(x)) < 2:
+        predicted = intercept + slope * x
+        scale = float(np.mean(y / np.maximum(predicted, 1e-9)))
+        return intercept * scale, slope * scale
+
+    (a, b), *_ = np.linalg.lstsq(np.column_stack([np.ones_like(x), x]), y, rcond=None)
+    return max(float(a), 0.0), max(float(b), 0.0)
+
+
+def calibrate(
+    records: List[Dict], models: Dict[str, StageModel] = DEFAULT_MODELS
+) -> Dict[str, StageModel]:
+    """Fit every stage model to the recorded runs of that stage"""
+
+    calibrated = dict(models)
+    for stage, model in models.items():
+        stage_records = [r for r in records if r["stage"] == stage]
+        if not stage_records:
+            continue
+        seconds, seconds_per_unit = _fit(
+            stage_records,
+            model.time_feature,
+            "seconds",
+            model.seconds,
+            model.seconds_per_unit,
+        )
+        memory, memory_per_unit = _fit(
+            stage_records,
+            model.memory_feature,
+            "peak_memory_gib",
+            model.memory_gib,
+            model.memory_gib_per_unit,
+        )
+        calibrated[stage] = dataclasses.replace(
+            model,
+            seconds=seconds,
+            seconds_per_unit=seconds_per_unit,
+            memory_gib=memory,
+            memory_gib_per_unit=memory_per_unit,
+        )
+    return calibrated
+
+
+def plan(
+    stages,
+    features: Dict[str, float],
+    models: Dict[str, StageModel] = DEFAULT_MODELS,
+    fused_stages: Tuple[str, ...] = (),
+    node_prices: Dict[Tuple[int, int], float] = {},
+) -> List[StageEstimate]:
+    """Estimate every stage, and their start and finish on unlimited nodes
+
+    Mapped stages run their instances concurrently, each on its own node.
+    Fused stages share one large node, so they are checked against its
+    memory and their node-hours are those of the fused task's span.
+    """
+
+    estimates: Dict[str, StageEstimate] = {}
+    predecessor: Dict[str, Optional[str]] = {}
+    for stage in stages:
+        seconds, memory = models[stage.name].predict(features)
+        resources = LARGE if stage.name in fused_stages else stage.resources
+        instances = features["annotation_chunks"] if stage.mapped else 1
+        node_hours = seconds * instances / 3600
+        start = max(
+            (estimates[dep].finish for dep in stage.depends_on if dep in estimates),
+            default=0.0,
+        )
+        predecessor[stage.name] = max(
+            (dep for dep in stage.depends_on if dep in estimates),
+            key=lambda dep: estimates[dep].finish,
+            default=None,
+        )
+        estimates[stage.name] = StageEstimate(
+            stage=stage.name,
+            cpus=resources[0],
+            memory_limit_gib=resources[1],
+            instances=instances,
+            seconds=seconds,
+            peak_memory_gib=memory,
+            node_hours=node_hours,
+            cost=node_hours * node_prices.get(resources, 0.0),
+            start=start,
+            finish=start + seconds,
+            oom=memory > resources[1],
+        )
+
+    if fused_stages:
+        fused = [estimates[name] for name in fused_stages if name in estimates]
+        span = max(e.finish for e in fused) - min(e.start for e in fused)
+        for e in fused:
+            e.node_hours = e.cost = 0.0
+        fused[0].node_hours = span / 3600
+        fused[0].cost = fused[0].node_hours * node_prices.get(LARGE, 0.0)
+
+    name = max(estimates, key=lambda name: estimates[name].finish)
+    while name is not None:
+        estimates[name].critical = True
+        name = predecessor[name]
+
+    return list(estimates.values())
+
+
+def _sample_args(parser: argparse.ArgumentParser):
+    parser.add_argument("--read1", required=True, nargs="+", help="One file per lane")
+    parser.add_argument("--read2", required=True, nargs="+", help="One file per lane")
+    parser.add_argument("--host-genome", required=True)
+    parser.add_argument("--host-name", default="host")
+    parser.add_argument("--kaiju-db", required=True)
+    parser.add_argument("--sample-name", default="metamage_sample")
+    parser.add_argument("--annotation-chunk-bases", type=int, default=100_000_000)
+
+
+def _inputs(args) -> Tuple[Sample, HostData]:
+    from latch.types import LatchFile
+
+    def input_file(path: str) -> LatchFile:
+        if path.startswith("latch://"):
+            return LatchFile(path)
+        return LatchFile(str(Path(path).resolve()))
+
+    sample = Sample(
+        read1=input_file(args.read1[0]),
+        read2=input_file(args.read2[0]),
+        additional_lanes=[
+            Lane(read1=input_file(r1), read2=input_file(r2))
+            for r1, r2 in zip(args.read1[1:], args.read2[1:])
+        ],
+    )
+    host_data = HostData(
+        host_name=args.host_name, host_genome=input_file(args.host_genome)
+    )
+    return sample, host_data
+
+
+def _stages(args, sample: Sample, host_data: HostData):
+    kaiju_db = (
+        args.kaiju_db
+        if args.kaiju_db.startswith("latch://")
+        else str(Path(args.kaiju_db).resolve())
+    )
+    from latch.types import LatchFile
+
+    return metamage_stages(
+        sample=sample,
+        host_data=host_data,
+        kaiju_ref_db=LatchFile(kaiju_db),
+        kaiju_ref_nodes=LatchFile(kaiju_db),
+        kaiju_ref_names=LatchFile(kaiju_db),
+        sample_name=args.sample_name,
+        annotation_chunk_bases=args.annotation_chunk_bases,
+    )
+
+
+def _recorded_assembly_bases(outdir: Path, sample_name: str) -> Optional[int]:
+    for path in outdir.glob(f"assembly_stats/**/{sample_name}_assembly_stats.json"):
+        with open(path) as f:
+            return json.load(f)["total_length"]
+    return None
+
+
+def record(args):
+    """Append the stages of a finished local run to a records file"""
+
+    sample, host_data = _inputs(args)
+    features = input_features(
+        sample,
+        host_data,
+        args.kaiju_db,
+        args.annotation_chunk_bases,
+        _recorded_assembly_bases(args.outdir, args.sample_name),
+    )
+    mapped = {stage.name: stage.mapped for stage in _stages(args, sample, host_data)}
+    peak_memory = dict(value.split("=") for value in args.peak_memory)
+
+    with open(args.outdir.joinpath("timeline.json")) as f:
+        timeline = json.load(f)
+
+    with open(args.records, "a") as f:
+        for entry in timeline:
+            if entry["status"] != "done" or entry["stage"] not in mapped:
+                continue
+            instances = 1
+            if mapped[entry["stage"]]:
+                stage_dir = args.outdir.joinpath(entry["stage"])
+                instances = max(
+                    1, len(list(stage_dir.glob(f"{mapped[entry['stage']]}_*")))
+                )
+            memory = peak_memory.get(entry["stage"])
+            f.write(
+                json.dumps(
+                    {
+                        "sample": args.sample_name,
+                        "stage": entry["stage"],
+                        "cpus": entry["cpus"],
+                        "features": features,
+                        # Mapped instances run one after the other locally
+                        "seconds": (entry["end"] - entry["start"]) / instances,
+                        "peak_memory_gib": float(memory) if memory else None,
+                    }
+                )
+                + "\n"
+            )
+
+
+def estimate(args):
+    sample, host_data = _inputs(args)
+    features = input_features(
+        sample, host_data, args.kaiju_db, args.annotation_chunk_bases
+    )
+    models = (
+        calibrate(load_records(args.calibration))
+        if args.calibration
+        else DEFAULT_MODELS
+    )
+
+    fused_stages: Tuple[str, ...] = ()
+    if 0 < features["read_bytes"] < args.fuse_below_bytes:
+        fused_stages = tuple(
+            stage.name for stage in contig_stages(sample_name=args.sample_name)
+        )
+
+    estimates = plan(
+        _stages(args, sample, host_data),
+        features,
+        models,
+        fused_stages,
+        {SMALL: args.small_node_price, LARGE: args.large_node_price},
+    )
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(
+                {
+                    "features": features,
+                    "fused_stages": fused_stages,
+                    "stages": [dataclasses.asdict(e) for e in estimates],
+                },
+                f,
+                indent=2,
+            )
+
+    print(
+        f"~{features['read_pairs'] / 1e6:.1f}M read pairs, "
+        f"{features['read_gbp']:.2f} Gbp, host {features['host_gbp']:.2f} Gbp, "
+        f"Kaiju db {features['kaiju_gib']:.1f} GiB"
+        + (", post-assembly stages fused" if fused_stages else "")
+    )
+    print(
+        f"{'stage':<32}{'x':>4}{'wall':>10}{'memory':>10}{'limit':>8}"
+        f"{'node-h':>9}{'cost':>9}"
+    )
+    for e in estimates:
+        flags = ("*" if e.critical else "") + (
+            "  OOM (small_task)"
+            if e.oom and e.memory_limit_gib == SMALL[1]
+            else "  OOM" if e.oom else ""
+        )
+        print(
+            f"{e.stage:<32}{e.instances:>4}{e.seconds / 60:>9.1f}m"
+            f"{e.peak_memory_gib:>8.1f}Gi{e.memory_limit_gib:>6}Gi"
+            f"{e.node_hours:>9.2f}{e.cost:>9.2f}{flags}"
+        )
+    print(
+        f"Critical path (*): {max(e.finish for e in estimates) / 3600:.1f} h, "
+        f"{sum(e.node_hours for e in estimates):.1f} node-hours, "
+        f"cost {sum(e.cost for e in estimates):.2f}"
+    )
+
+    if any(e.oom for e in estimates):
+        raise SystemExit(2)
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    estimate_parser = commands.add_parser("estimate", help="Estimate a run")
+    _sample_args(estimate_parser)
+    estimate_parser.add_argument("--calibration", type=Path, help="Records file")
+    estimate_parser.add_argument("--fuse-below-bytes", type=int, default=2_000_000_000)
+    estimate_parser.add_argument(
+        "--small-node-price", type=float, default=0.0, help="Per node-hour"
+    )
+    estimate_parser.add_argument(
+        "--large-node-price", type=float, default=0.0, help="Per node-hour"
+    )
+    estimate_parser.add_argument("--json", type=Path, help="Also write the plan here")
+    estimate_parser.set_defaults(run=estimate)
+
+    record_parser = commands.add_parser("record", help="Record a finished local run")
+    _sample_args(record_parser)
+    record_parser.add_argument("--outdir", required=True, type=Path)
+    record_parser.add_argument("--records", required=True, type=Path)
+    record_parser.add_argument(
+        "--peak-memory",
+        nargs="*",
+        default=[],
+        metavar="STAGE=GIB",
+        help="Measured peak memory of stages, e.g. from /usr/bin/time -v",
+    )
+    record_parser.set_defaults(run=record)
+
+    args = parser.parse_args(argv)
+    if len(args.read1) != len(args.read2):
+        parser.error("--read1 and --read2 must list the same number of lanes")
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
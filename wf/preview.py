@@ -0,0 +1,290 @@
+"""
+Quick-look taxonomic profile from a read subsample
+
+A fixed number of read pairs is reservoir-sampled while streaming the raw
+reads and classified with Kaiju, so a provisional profile is published
+long before the full run reaches its own Kaiju step. Abundances come with
+Wilson score intervals, which account for the subsample size.
+"""
+
+import gzip
+import json
+import math
+import random
+import subprocess
+from itertools import islice
+from pathlib import Path
+from typing import Iterator, List, Tuple
+
+from latch import large_task, message, small_task, workflow
+from latch.types import LatchDir, LatchFile
+
+from .kaiju import build_kaiju_cmd
+from .refcache import ReferenceCache
+from .seqio import open_maybe_gzip
+from .threads import tool_threads
+from .types import Sample, TaxonRank
+
+# z for a two-sided 95% interval
+_Z_95 = 1.959964
+
+ReadPair = Tuple[List[bytes], List[bytes]]
+
+
+def read_pairs(sample: Sample, sample_name: str) -> Iterator[ReadPair]:
+    """Stream the read pairs of every lane of a sample"""
+
+    for lane, (read1, read2) in enumerate(sample.lanes()):
+        with open_maybe_gzip(read1.local_path) as r1, open_maybe_gzip(
+            read2.local_path
+        ) as r2:
+            while True:
+                record1 = list(islice(r1, 4))
+                record2 = list(islice(r2, 4))
+                if len(record1) != len(record2):
+                    raise ValueError(
+                        f"Lane {lane + 1} of {sample_name} has different "
+                        "numbers of reads in each mate file"
+                    )
+                if not record1:
+                    break
+                yield record1, record2
+
+
+def reservoir_sample(
+    items: Iterator[ReadPair], k: int, rng: random.Random
+) -> Tuple[List[ReadPair], int]:
+    """Uniformly sample `k` items from a stream of unknown length
+
+    Uses Li's Algorithm L, which draws random numbers only when an item
+    enters the reservoir instead of once per item. Returns the sample and
+    the number of items seen.
+    """
+
+    items = iter(items)
+    reservoir = list(islice(items, k))
+    seen = len(reservoir)
+    if seen < k or k == 0:
+        return reservoir, seen + sum(1 for _ in items)
+
+    w = math.exp(math.log(rng.random()) / k)
+    while True:
+        skip = math.floor(math.log(rng.random()) / math.log(1 - w))
+        skipped = sum(1 for _ in islice(items, skip))
+        seen += skipped
+        if skipped < skip:
+            return reservoir, seen
+
+        item = next(items, None)
+        if item is None:
+            return reservoir, seen
+        seen += 1
+        reservoir[rng.randrange(k)] = item
+        w *= math.exp(math.log(rng.random()) / k)
+
+
+def wilson_interval(count: int, n: int, z: float = _Z_95) -> Tuple[float, float]:
+    """Confidence interval of the proportion count / n"""
+
+    if n == 0:
+        return 0.0, 1.0
+
+    p = count / n
+    denominator = 1 + z**2 / n
+    centre = (p + z**2 / (2 * n)) / denominator
+    margin = z * math.sqrt(p * (1 - p) / n + z**2 / (4 * n**2)) / denominator
+
+    return max(0.0, centre - margin), min(1.0, centre + margin)
+
+
+def add_confidence_intervals(kaiju_table: Path, output: Path, sampled: int, total: int):
+    """Add abundance intervals and full-sample read estimates to a kaiju2table"""
+
+    with open(kaiju_table) as f, open(output, "w") as out:
+        header = f.readline().rstrip("\n").split("\t")
+        reads_col = header.index("reads")
+        out.write(
+            "\t".join(
+                header + ["percent_ci_low", "percent_ci_high", "estimated_total_reads"]
+            )
+            + "\n"
+        )
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            reads = int(fields[reads_col])
+            low, high = wilson_interval(reads, sampled)
+            estimated = round(reads / sampled * total) if sampled else 0
+            out.write(
+                "\t".join(
+                    fields + [f"{100 * low:.4f}", f"{100 * high:.4f}", str(estimated)]
+                )
+                + "\n"
+            )
+
+
+@small_task
+def subsample_reads(sample: Sample, sample_name: str, read_pairs_n: int) -> LatchDir:
+    """Reservoir-sample read pairs while streaming the raw reads"""
+
+    output_dir_name = "kaiju_preview_reads"
+    output_dir = Path(output_dir_name).resolve()
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    # A fixed seed keeps the preview reproducible for a given input
+    rng = random.Random(sample_name)
+    sampled, total = reservoir_sample(
+        read_pairs(sample, sample_name), read_pairs_n, rng
+    )
+
+    for mate in (0, 1):
+        with gzip.open(
+            output_dir.joinpath(f"{sample_name}_preview.fastq.{mate + 1}.gz"),
+            "wb",
+            compresslevel=1,
+        ) as f:
+            for pair in sampled:
+                f.writelines(pair[mate])
+
+    with open(output_dir.joinpath("subsample.json"), "w") as f:
+        json.dump({"sampled_pairs": len(sampled), "total_pairs": total}, f, indent=2)
+
+    message(
+        "info",
+        {
+            "title": "Subsampled reads for the taxonomic preview",
+            "body": f"{len(sampled)} of {total} read pairs",
+        },
+    )
+
+    return LatchDir(
+        str(output_dir), f"latch:///metamage/{sample_name}/{output_dir_name}"
+    )
+
+
+@large_task
+def preview_classification_task(
+    subsample_dir: LatchDir,
+    kaiju_ref_db: LatchFile,
+    kaiju_ref_nodes: LatchFile,
+    kaiju_ref_names: LatchFile,
+    sample_name: str,
+    taxon: TaxonRank,
+) -> LatchDir:
+    """Classify the subsample with Kaiju and build the provisional reports
+
+    The subsample is small, so Kaiju, kaiju2table, kaiju2krona and Krona run
+    in a single task instead of paying the task start-up cost four times.
+    The host genome index takes far longer to build than the preview
+    budget, so the subsample is not host-screened: host reads are left
+    unclassified by the microbial Kaiju database and only dilute the
+    classified fraction.
+    """
+
+    reads_dir = Path(subsample_dir.local_path)
+    with open(reads_dir.joinpath("subsample.json")) as f:
+        subsample = json.load(f)
+
+    output_dir_name = "kaiju_preview"
+    output_dir = Path(output_dir_name).resolve()
+    output_dir.mkdir(parents=True, exist_ok=True)
+    prefix = f"{str(output_dir)}/{sample_name}_preview"
+
+    ref_cache = ReferenceCache()
+    kaiju_db, kaiju_nodes, kaiju_names = (
+        future.result()
+        for future in ref_cache.prefetch(
+            [kaiju_ref_db, kaiju_ref_nodes, kaiju_ref_names]
+        )
+    )
+    ref_cache.report("preview_classification_task")
+
+    _kaiju_cmd = build_kaiju_cmd(
+        str(kaiju_nodes),
+        str(kaiju_db),
+        str(reads_dir.joinpath(f"{sample_name}_preview.fastq.1.gz")),
+        str(reads_dir.joinpath(f"{sample_name}_preview.fastq.2.gz")),
+        f"{prefix}_kaiju.out",
+        threads=tool_threads("kaiju", 31),
+    )
+    message(
+        "info",
+        {
+            "title": "Taxonomic preview with Kaiju",
+            "body": f"{subsample['sampled_pairs']} of {subsample['total_pairs']} "
+            f"read pairs\nCommand: {' '.join(_kaiju_cmd)}",
+        },
+    )
+    subprocess.run(_kaiju_cmd, check=True)
+
+    _kaiju2table_cmd = [
+        "kaiju2table",
+        "-t",
+        str(kaiju_nodes),
+        "-n",
+        str(kaiju_names),
+        "-r",
+        taxon.value,
+        "-p",
+        "-e",
+        "-o",
+        f"{prefix}_kaiju.tsv",
+        f"{prefix}_kaiju.out",
+    ]
+    subprocess.run(_kaiju2table_cmd, check=True)
+
+    add_confidence_intervals(
+        Path(f"{prefix}_kaiju.tsv"),
+        Path(f"{prefix}_kaiju_ci.tsv"),
+        subsample["sampled_pairs"],
+        subsample["total_pairs"],
+    )
+
+    _kaiju2krona_cmd = [
+        "kaiju2krona",
+        "-t",
+        str(kaiju_nodes),
+        "-n",
+        str(kaiju_names),
+        "-i",
+        f"{prefix}_kaiju.out",
+        "-o",
+        f"{prefix}_kaiju2krona.out",
+    ]
+    subprocess.run(_kaiju2krona_cmd, check=True)
+
+    _krona_cmd = [
+        "ktImportText",
+        "-o",
+        f"{prefix}_krona.html",
+        f"{prefix}_kaiju2krona.out",
+    ]
+    subprocess.run(_krona_cmd, check=True)
+
+    return LatchDir(
+        str(output_dir), f"latch:///metamage/{sample_name}/{output_dir_name}"
+    )
+
+
+@workflow
+def kaiju_preview_wf(
+    sample: Sample,
+    kaiju_ref_db: LatchFile,
+    kaiju_ref_nodes: LatchFile,
+    kaiju_ref_names: LatchFile,
+    sample_name: str,
+    taxon_rank: TaxonRank,
+    read_pairs_n: int,
+) -> LatchDir:
+
+    subsample_dir = subsample_reads(
+        sample=sample, sample_name=sample_name, read_pairs_n=read_pairs_n
+    )
+
+    return preview_classification_task(
+        subsample_dir=subsample_dir,
+        kaiju_ref_db=kaiju_ref_db,
+        kaiju_ref_nodes=kaiju_ref_nodes,
+        kaiju_ref_names=kaiju_ref_names,
+        sample_name=sample_name,
+        taxon=taxon_rank,
+    )
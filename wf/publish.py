@@ -0,0 +1,304 @@
+"""
+Progressive publishing of task outputs
+
+Latch uploads the outputs of a task only once it returns, so a task
+writing many gigabytes sits idle for minutes after its tool finishes.
+ProgressivePublisher watches an output directory while the tool runs and
+uploads every file that has stopped changing from a background thread
+pool. Once the tool is done the remaining and rewritten files are
+flushed, remote sizes are checked against the local files, and a
+LatchDir/LatchFile pointing at the already published data is returned,
+so nothing is uploaded twice.
+
+Every published directory gets a manifest of the content hashes of its
+files. A file whose hash matches the previous manifest, and whose remote
+object is still the version recorded there, is not uploaded again, so
+re-running a sample doesn't re-upload identical BAMs and reads.
+
+If anything can't be uploaded or verified, the usual local/remote pair
+is returned and Latch uploads the outputs itself. Progressive publishing
+is disabled with METAMAGE_PROGRESSIVE_PUBLISH=0, which the local runner
+sets since its outputs stay local.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+from latch import message
+from latch.types import LatchDir, LatchFile
+
+PUBLISH_WORKERS = 8
+POLL_SECONDS = 10.0
+# A file is considered finished once unchanged for this long
+SETTLE_SECONDS = 30.0
+
+MANIFEST_NAME = "metamage_manifest.json"
+HASH_CHUNK_SIZE = 32 * 1024 * 1024
+HASH_WORKERS = 8
+
+FileState = Tuple[int, int]
+
+
+def progressive_publishing_enabled() -> bool:
+    return os.environ.get("METAMAGE_PROGRESSIVE_PUBLISH", "1") != "0"
+
+
+def content_hash(
+    path: Path, chunk_size: int = HASH_CHUNK_SIZE, workers: int = HASH_WORKERS
+) -> str:
+    """SHA-256 hash tree of a file, hashing fixed-size chunks in parallel
+
+    Chunks are read with pread and hashed on a thread pool (hashlib releases
+    the GIL), and the digest is the SHA-256 of the concatenated chunk
+    digests. It depends only on the content and the chunk size.
+    """
+
+    size = path.stat().st_size
+    fd = os.open(path, os.O_RDONLY)
+    try:
+
+        def chunk_digest(offset: int) -> bytes:
+            return hashlib.sha256(os.pread(fd, chunk_size, offset)).digest()
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            digests = list(executor.map(chunk_digest, range(0, size, chunk_size)))
+    finally:
+        os.close(fd)
+
+    return hashlib.sha256(b"".join(digests)).hexdigest()
+
+
+def _file_state(path: Path) -> Optional[FileState]:
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+class ProgressivePublisher:
+    """Upload the finished files of a directory while it is being written
+
+    Used as a context manager around the command writing the outputs:
+
+        publisher = ProgressivePublisher(output_dir, remote_dir)
+        with publisher:
+            subprocess.run(cmd, check=True)
+        return publisher.latch_dir()
+
+    `include` selects the files to publish, by default every file under
+    the directory. The manifest is published as `manifest_name` in the
+    remote directory.
+    """
+
+    def __init__(
+        self,
+        local_dir: Path,
+        remote_dir: str,
+        include: Callable[[Path], bool] = lambda path: True,
+        workers: int = PUBLISH_WORKERS,
+        poll_seconds: float = POLL_SECONDS,
+        settle_seconds: float = SETTLE_SECONDS,
+        manifest_name: str = MANIFEST_NAME,
+    ):
+        self.local_dir = local_dir
+        self.remote_dir = remote_dir.rstrip("/")
+        self.include = include
+        self.poll_seconds = poll_seconds
+        self.settle_seconds = settle_seconds
+        self.enabled = progressive_publishing_enabled()
+        self.manifest = local_dir.joinpath(manifest_name)
+
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._stop = threading.Event()
+        self._watcher: Optional[threading.Thread] = None
+        # File -> (state, first time it was seen in that state)
+        self._seen: Dict[Path, Tuple[FileState, float]] = {}
+        # File -> (state it was uploaded in, upload returning its manifest entry)
+        self._uploads: Dict[Path, Tuple[FileState, Future]] = {}
+        self._published_during_run = set()
+        self._previous_manifest: Dict[str, Dict] = {}
+
+    def __enter__(self):
+        if self.enabled:
+            self._previous_manifest = self._load_manifest()
+            self._watcher = threading.Thread(target=self._watch, daemon=True)
+            self._watcher.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stop.set()
+        if self._watcher is not None:
+            self._watcher.join()
+        # A failed tool or output check fails the task, nothing more is published
+        if exc_type is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+        return False
+
+    def _remote(self, path: Path) -> str:
+        return f"{self.remote_dir}/{path.relative_to(self.local_dir).as_posix()}"
+
+    def _key(self, path: Path) -> str:
+        return path.relative_to(self.local_dir).as_posix()
+
+    def _files(self) -> List[Path]:
+        if not self.local_dir.exists():
+            return []
+        return [
+            p
+            for p in self.local_dir.rglob("*")
+            if p.is_file() and p != self.manifest and self.include(p)
+        ]
+
+    def _load_manifest(self) -> Dict[str, Dict]:
+        """The manifest of the previous run, empty if there is none"""
+
+        from latch.ldata.path import LPath
+
+        try:
+            remote = LPath(self._remote(self.manifest))
+            if not remote.exists():
+                return {}
+            with open(remote.download()) as f:
+                return json.load(f)["files"]
+        except Exception:
+            return {}
+
+    def _upload(self, path: Path, previous: Optional[Future]) -> Dict:
+        from latch.ldata.path import LPath
+
+        # A rewritten file is uploaded again only after its first upload
+        if previous is not None:
+            wait([previous])
+
+        entry = {
+            "size": path.stat().st_size,
+            "sha256": content_hash(path),
+            "chunk_size": HASH_CHUNK_SIZE,
+        }
+        remote = LPath(self._remote(path))
+        published = self._previous_manifest.get(self._key(path))
+        if (
+            published is not None
+            and all(published.get(k) == v for k, v in entry.items())
+            and remote.version_id() == published.get("version_id")
+        ):
+            return {**entry, "version_id": published["version_id"], "uploaded": False}
+
+        remote.upload_from(path)
+        return {
+            **entry,
+            "version_id": LPath(self._remote(path)).version_id(),
+            "uploaded": True,
+        }
+
+    def _submit(self, path: Path, state: FileState):
+        upload = self._uploads.get(path)
+        if upload is not None and upload[0] == state:
+            return
+        previous = upload[1] if upload is not None else None
+        self._uploads[path] = (
+            state,
+            self._executor.submit(self._upload, path, previous),
+        )
+
+    def _watch(self):
+        while not self._stop.wait(self.poll_seconds):
+            now = time.monotonic()
+            for path in self._files():
+                state = _file_state(path)
+                if state is None:
+                    continue
+                previous = self._seen.get(path)
+                if previous is None or previous[0] != state:
+                    self._seen[path] = (state, now)
+                elif now - previous[1] >= self.settle_seconds:
+                    self._published_during_run.add(path)
+                    self._submit(path, state)
+
+    def _flush(self) -> bool:
+        """Upload what is left, then check every remote object"""
+
+        from latch.ldata.path import LPath
+
+        files = self._files()
+        for path in files:
+            self._submit(path, _file_state(path))
+        wait([upload for _, upload in self._uploads.values()])
+
+        # Files removed by the tool after they were uploaded (temporary files)
+        for path in set(self._uploads) - set(files):
+            try:
+                LPath(self._remote(path)).rmr()
+            except Exception:
+                pass
+
+        entries = {}
+        for path in files:
+            state, upload = self._uploads[path]
+            if upload.exception() is not None or _file_state(path) != state:
+                return False
+            if LPath(self._remote(path)).size() != state[0]:
+                return False
+            entries[self._key(path)] = upload.result()
+
+        with open(self.manifest, "w") as f:
+            json.dump(
+                {
+                    "remote_dir": self.remote_dir,
+                    "files": {
+                        key: {k: v for k, v in entry.items() if k != "uploaded"}
+                        for key, entry in sorted(entries.items())
+                    },
+                },
+                f,
+                indent=2,
+            )
+        LPath(self._remote(self.manifest)).upload_from(self.manifest)
+
+        reused = [entry for entry in entries.values() if not entry["uploaded"]]
+        message(
+            "info",
+            {
+                "title": "Published outputs",
+                "body": f"{len(files)} files to {self.remote_dir}, "
+                f"{len(self._published_during_run.intersection(files))} of them "
+                f"while the tool was running. {len(reused)} unchanged files "
+                f"({sum(entry['size'] for entry in reused) / 1024**3:.1f} GiB) "
+                "were already published",
+            },
+        )
+        return True
+
+    def _published(self) -> bool:
+        try:
+            return self.enabled and self._flush()
+        except Exception as e:
+            message(
+                "warning",
+                {
+                    "title": "Progressive publishing failed",
+                    "body": f"Outputs are uploaded when the task returns ({e!r})",
+                },
+            )
+            return False
+        finally:
+            self._executor.shutdown(wait=True)
+
+    def latch_dir(self) -> LatchDir:
+        if self._published():
+            return LatchDir(self.remote_dir)
+        return LatchDir(str(self.local_dir), self.remote_dir)
+
+    def latch_file(self, path: Path) -> LatchFile:
+        """The published file, for a publisher whose `include` selects only it"""
+
+        if self._published():
+            return LatchFile(self._remote(path))
+        return LatchFile(str(path), self._remote(path))
@@ -0,0 +1,442 @@
+"""
+Read statistics sidecar of the host-depleted reads
+
+Assembly parameters, Kaiju chunking and resource sizing all depend on
+basic facts about the reads left after host removal. Rather than having
+every stage rescan gigabytes of FASTQ, map_to_host has bowtie2 write its
+unaligned mates into named pipes, and a thread per mate compresses them to
+{sample}_unaligned.fastq.{1,2}.gz while computing, on the same blocks:
+
+- read and base counts, and the read length distribution
+- GC content, overall and as a distribution of per-read GC percentages
+- a k-mer spectrum sample: in one first mate out of KMER_READ_STRIDE,
+  canonical 21-mers whose hash falls below 1/KMER_SCALE of the hash space
+  are counted, and the spectrum is the number of sampled k-mers seen once,
+  twice... (the scaled sample keeps the shape of the spectrum of the
+  sampled reads)
+
+Hashing k-mers is the costly part, so it only covers a subset of the
+reads and runs in its own thread, off the compression path bowtie2 waits
+on. Reads are picked by a hash of their first bases, so the same reads
+are sampled whatever their order, which bowtie2's threads don't keep. The scalars are written to {sample}_unaligned.read_stats.json
+and the distributions, with the raw counts needed to merge the
+statistics of chunks of a sample, to {sample}_unaligned.read_stats.npz,
+next to the reads.
+"""
+
+import gzip
+import json
+import os
+import queue
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+from latch.types import LatchDir
+
+from .kmers import ENCODE, KMER_SIZE, code_kmer_hashes
+
+# Sampled k-mers are those with hashes below 2^64 / KMER_SCALE, in one
+# read out of KMER_READ_STRIDE
+KMER_SCALE = 1000
+KMER_READ_STRIDE = 8
+# Leading bases of a read that decide whether it is sampled
+_READ_KEY_BASES = 16
+# Multiplicities above this are counted in the last spectrum bin
+MAX_MULTIPLICITY = 10_000
+
+# gzip's default level, as the files bowtie2 --un-conc-gz wrote
+GZIP_LEVEL = 6
+PIPE_BLOCK_SIZE = 4 << 20
+
+_NEWLINE = ord("\n")
+_GC = np.zeros(256, dtype=bool)
+_GC[[ord(c) for c in "GCgc"]] = True
+_ACGT = np.zeros(256, dtype=bool)
+_ACGT[[ord(c) for c in "ACGTacgt"]] = True
+_KMER_THRESHOLD = np.uint64(np.iinfo(np.uint64).max // KMER_SCALE)
+
+
+def sidecar_paths(read_dir: Union[str, Path], sample_name: str) -> List[Path]:
+    """The JSON and NumPy files of a sample's read statistics"""
+
+    return [
+        Path(read_dir, f"{sample_name}_unaligned.read_stats.{extension}")
+        for extension in ("json", "npz")
+    ]
+
+
+class MateStats:
+    """Statistics of one mate file, updated with each block of FASTQ text"""
+
+    def __init__(self, sample_kmers: bool, kmer_read_stride: int = KMER_READ_STRIDE):
+        self.sample_kmers = sample_kmers
+        self.kmer_read_stride = kmer_read_stride
+        self.reads = 0
+        self.bases = 0
+        self.gc_bases = 0
+        self.acgt_bases = 0
+        self.lengths = np.zeros(0, dtype=np.int64)
+        self.gc_percent = np.zeros(101, dtype=np.int64)
+        # Sampled hashes, with their counts (None when each was seen once)
+        self._kmers: List[Tuple[np.ndarray, Optional[np.ndarray]]] = []
+        self._lines = 0
+        self._rest = b""
+        self._kmer_queue: "queue.Queue[Optional[np.ndarray]]" = queue.Queue(maxsize=4)
+        self._kmer_thread: Optional[threading.Thread] = None
+        self._kmer_errors: List[BaseException] = []
+
+    def update(self, data: bytes):
+        data = self._rest + data
+        cut = data.rfind(b"\n") + 1
+        self._rest = data[cut:]
+        if cut:
+            self._update_lines(np.frombuffer(data, dtype=np.uint8, count=cut))
+
+    def _update_lines(self, block: np.ndarray):
+        newlines = block == _NEWLINE
+        # Line of every byte, a line's newline belongs to it
+        line = np.empty(block.size, dtype=np.int64)
+        line[0] = 0
+        np.cumsum(newlines[:-1], out=line[1:])
+        n_lines = int(line[-1]) + 1
+
+        # Sequence lines are the second of every four
+        is_sequence_line = (self._lines + np.arange(n_lines)) % 4 == 1
+        self._lines += n_lines
+        sequence_lines = np.flatnonzero(is_sequence_line)
+        sequence = is_sequence_line[line]
+
+        bases = block[sequence]
+        base_line = line[sequence]
+        lengths = np.bincount(base_line, minlength=n_lines)[sequence_lines] - 1
+        gc = np.bincount(base_line[_GC[bases]], minlength=n_lines)[sequence_lines]
+        acgt = np.bincount(base_line[_ACGT[bases]], minlength=n_lines)[sequence_lines]
+
+        self.reads += lengths.size
+        self.bases += int(lengths.sum())
+        self.gc_bases += int(gc.sum())
+        self.acgt_bases += int(acgt.sum())
+        if lengths.size:
+            counts = np.bincount(lengths)
+            if counts.size > self.lengths.size:
+                self.lengths = np.pad(
+                    self.lengths, (0, counts.size - self.lengths.size)
+                )
+            self.lengths[: counts.size] += counts
+        called = acgt > 0
+        self.gc_percent += np.bincount(
+            np.rint(100 * gc[called] / acgt[called]).astype(np.int64), minlength=101
+        )
+
+        if self.sample_kmers and sequence_lines.size:
+            if self._kmer_thread is None:
+                self._kmer_thread = threading.Thread(target=self._hash_kmers)
+                self._kmer_thread.start()
+            sampled = np.zeros(n_lines, dtype=bool)
+            sampled[
+                sequence_lines[self._sampled_reads(block, line, sequence_lines)]
+            ] = True
+            self._kmer_queue.put(bases[sampled[base_line]])
+
+    def _sampled_reads(
+        self, block: np.ndarray, line: np.ndarray, sequence_lines: np.ndarray
+    ) -> np.ndarray:
+        """Which sequence lines have k-mers sampled, from their first bases"""
+
+        starts = np.searchsorted(line, sequence_lines)
+        positions = np.minimum(
+            starts[:, None] + np.arange(_READ_KEY_BASES), block.size - 1
+        )
+        key = np.zeros(starts.size, dtype=np.uint64)
+        for codes in ENCODE[block[positions]].T.astype(np.uint64):
+            key = (key << np.uint64(3)) | codes
+        key *= np.uint64(0x9E3779B97F4A7C15)
+        return (key >> np.uint64(32)) % np.uint64(self.kmer_read_stride) == 0
+
+    def _hash_kmers(self):
+        while True:
+            bases = self._kmer_queue.get()
+            if bases is None:
+                return
+            if self._kmer_errors:
+                continue
+            try:
+                # Newlines encode as separators between the reads
+                hashes = code_kmer_hashes(ENCODE[bases], KMER_SIZE)
+                self._kmers.append((hashes[hashes < _KMER_THRESHOLD], None))
+            except BaseException as e:
+                self._kmer_errors.append(e)
+
+    def finish(self):
+        if self._rest:
+            self.update(b"\n")
+        if self._kmer_thread is not None:
+            self._kmer_queue.put(None)
+            self._kmer_thread.join()
+            self._kmer_thread = None
+        if self._kmer_errors:
+            raise self._kmer_errors[0]
+
+    def merge(self, other: "MateStats"):
+        """Add the statistics of another part of the same mate file"""
+
+        self.reads += other.reads
+        self.bases += other.bases
+        self.gc_bases += other.gc_bases
+        self.acgt_bases += other.acgt_bases
+        if other.lengths.size > self.lengths.size:
+            self.lengths = np.pad(
+                self.lengths, (0, other.lengths.size - self.lengths.size)
+            )
+        self.lengths[: other.lengths.size] += other.lengths
+        self.gc_percent += other.gc_percent
+        self._kmers.append(other.kmer_counts())
+
+    def kmer_counts(self) -> Tuple[np.ndarray, np.ndarray]:
+        """The distinct sampled k-mer hashes and the number of times each was seen"""
+
+        if not self._kmers:
+            return np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.int64)
+        hashes, inverse = np.unique(
+            np.concatenate([part for part, _ in self._kmers]), return_inverse=True
+        )
+        counts = np.concatenate(
+            [
+                (
+                    np.ones(part.size, dtype=np.int64)
+                    if part_counts is None
+                    else part_counts
+                )
+                for part, part_counts in self._kmers
+            ]
+        )
+        return hashes, np.bincount(
+            inverse.ravel(), weights=counts, minlength=hashes.size
+        ).astype(np.int64)
+
+    def kmer_spectrum(self) -> np.ndarray:
+        """Number of sampled k-mers seen 0, 1, 2... times"""
+
+        _, counts = self.kmer_counts()
+        if not counts.size:
+            return np.zeros(1, dtype=np.int64)
+        return np.bincount(np.minimum(counts, MAX_MULTIPLICITY))
+
+
+def _length_quantile(histogram: np.ndarray, q: float) -> int:
+    if not histogram.sum():
+        return 0
+    cumulative = np.cumsum(histogram)
+    return int(np.searchsorted(cumulative, q * cumulative[-1]))
+
+
+def write_sidecar(
+    read_dir: Path, sample_name: str, mate1: MateStats, mate2: MateStats
+) -> List[Path]:
+    """Write the JSON summary and the NumPy distributions of the reads"""
+
+    json_path, npz_path = sidecar_paths(read_dir, sample_name)
+    length_histogram = np.zeros(max(mate1.lengths.size, mate2.lengths.size), np.int64)
+    length_histogram[: mate1.lengths.size] += mate1.lengths
+    length_histogram[: mate2.lengths.size] += mate2.lengths
+    spectrum = mate1.kmer_spectrum()
+    acgt_bases = mate1.acgt_bases + mate2.acgt_bases
+
+    summary = {
+        "sample": sample_name,
+        "read_pairs": mate1.reads,
+        "bases": mate1.bases + mate2.bases,
+        "bases_per_mate": [mate1.bases, mate2.bases],
+        "mean_length": (mate1.bases + mate2.bases) / max(mate1.reads + mate2.reads, 1),
+        "min_length": (
+            int(np.flatnonzero(length_histogram)[0]) if length_histogram.any() else 0
+        ),
+        "median_length": _length_quantile(length_histogram, 0.5),
+        "max_length": max(length_histogram.size - 1, 0),
+        "gc": (mate1.gc_bases + mate2.gc_bases) / max(acgt_bases, 1),
+        "n_bases": mate1.bases + mate2.bases - acgt_bases,
+        "kmer_sample": {
+            "k": KMER_SIZE,
+            "scale": KMER_SCALE,
+            "read_stride": mate1.kmer_read_stride,
+            "mate": 1,
+            "distinct": int(spectrum[1:].sum()),
+            "total": int((np.arange(spectrum.size) * spectrum).sum()),
+            "singletons": int(spectrum[1]) if spectrum.size > 1 else 0,
+        },
+    }
+    with open(json_path, "w") as f:
+        json.dump(summary, f, indent=2)
+    kmer_hashes, kmer_counts = mate1.kmer_counts()
+    np.savez(
+        npz_path,
+        length_histogram=length_histogram,
+        length_histogram_1=mate1.lengths,
+        length_histogram_2=mate2.lengths,
+        gc_percent_histogram=mate1.gc_percent + mate2.gc_percent,
+        kmer_spectrum=spectrum,
+        # Raw counts, to merge the statistics of parts of a sample
+        gc_percent_histogram_1=mate1.gc_percent,
+        gc_percent_histogram_2=mate2.gc_percent,
+        base_counts_1=_base_counts(mate1),
+        base_counts_2=_base_counts(mate2),
+        kmer_hashes=kmer_hashes,
+        kmer_counts=kmer_counts,
+    )
+
+    return [json_path, npz_path]
+
+
+def _base_counts(mate: MateStats) -> np.ndarray:
+    return np.array([mate.reads, mate.bases, mate.gc_bases, mate.acgt_bases])
+
+
+def load_mate_stats(
+    read_dir: Union[str, Path], sample_name: str
+) -> Tuple[MateStats, MateStats]:
+    """The statistics of both mates, as written to a sidecar"""
+
+    _, npz_path = sidecar_paths(read_dir, sample_name)
+    with np.load(npz_path) as arrays:
+        mates = []
+        for mate in (1, 2):
+            stats = MateStats(sample_kmers=False)
+            (
+                stats.reads,
+                stats.bases,
+                stats.gc_bases,
+                stats.acgt_bases,
+            ) = (int(n) for n in arrays[f"base_counts_{mate}"])
+            stats.lengths = arrays[f"length_histogram_{mate}"].astype(np.int64)
+            stats.gc_percent = arrays[f"gc_percent_histogram_{mate}"].astype(np.int64)
+            mates.append(stats)
+        mates[0]._kmers.append((arrays["kmer_hashes"], arrays["kmer_counts"]))
+
+    return mates[0], mates[1]
+
+
+def merge_sidecars(
+    read_dirs: List[Path], output_dir: Path, sample_name: str
+) -> List[Path]:
+    """Write the sidecar of reads concatenated from parts of a sample"""
+
+    mate1, mate2 = MateStats(sample_kmers=False), MateStats(sample_kmers=False)
+    for read_dir in read_dirs:
+        part1, part2 = load_mate_stats(read_dir, sample_name)
+        mate1.merge(part1)
+        mate2.merge(part2)
+
+    return write_sidecar(output_dir, sample_name, mate1, mate2)
+
+
+def load_read_stats(read_dir: LatchDir, sample_name: str) -> Optional[Dict]:
+    """The read statistics summary, None for reads without a sidecar
+
+    Older runs don't write the sidecar.
+    """
+
+    json_path, _ = sidecar_paths(read_dir.local_path, sample_name)
+    if not json_path.exists():
+        return None
+    with open(json_path) as f:
+        return json.load(f)
+
+
+def load_read_distributions(
+    read_dir: LatchDir, sample_name: str
+) -> Optional[Dict[str, np.ndarray]]:
+    _, npz_path = sidecar_paths(read_dir.local_path, sample_name)
+    if not npz_path.exists():
+        return None
+    with np.load(npz_path) as arrays:
+        return dict(arrays)
+
+
+class UnalignedReadPipes:
+    """Compress bowtie2's unaligned mates while computing their statistics
+
+    bowtie2 writes uncompressed mates to named pipes (`pattern`, for
+    --un-conc), and a thread per mate compresses each block to
+    `{output_prefix}.{mate}.gz` after adding it to the mate's statistics:
+
+        pipes = UnalignedReadPipes(output_dir, sample_name)
+        with pipes:
+            subprocess.run([..., "--un-conc", pipes.pattern], check=True)
+        pipes.write_sidecar()
+
+    `started` is set once bowtie2 has written its first unaligned block,
+    when it has loaded its index and is aligning.
+    """
+
+    def __init__(self, output_dir: Path, sample_name: str):
+        self.output_dir = output_dir
+        self.sample_name = sample_name
+        # Outside the output directory, which is being published, and unique
+        # to the run, as chunks of a sample run side by side
+        self.pipe_dir = Path(tempfile.mkdtemp(prefix=f"{sample_name}_unaligned_pipes_"))
+        self.pattern = str(self.pipe_dir.joinpath("unaligned.%.fastq"))
+        self.stats = [MateStats(sample_kmers=True), MateStats(sample_kmers=False)]
+        self.started = threading.Event()
+        self._threads: List[threading.Thread] = []
+        self._errors: List[BaseException] = []
+
+    def _pipe(self, mate: int) -> Path:
+        return Path(self.pattern.replace("%", str(mate)))
+
+    def output(self, mate: int) -> Path:
+        return self.output_dir.joinpath(f"{self.sample_name}_unaligned.fastq.{mate}.gz")
+
+    def _compress(self, mate: int, stats: MateStats):
+        try:
+            with open(self._pipe(mate), "rb") as pipe, gzip.open(
+                self.output(mate), "wb", compresslevel=GZIP_LEVEL
+            ) as out:
+                while True:
+                    block = pipe.read(PIPE_BLOCK_SIZE)
+                    if not block:
+                        break
+                    self.started.set()
+                    stats.update(block)
+                    out.write(block)
+            stats.finish()
+        except BaseException as e:
+            # Closing the pipe stops bowtie2 with a broken pipe
+            self._errors.append(e)
+
+    def __enter__(self):
+        for mate, stats in enumerate(self.stats, start=1):
+            os.mkfifo(self._pipe(mate))
+            thread = threading.Thread(target=self._compress, args=(mate, stats))
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Readers still waiting for bowtie2 to open their pipe (bowtie2
+        # failed, or never opened it) get an empty input instead
+        for mate in (1, 2):
+            try:
+                os.close(os.open(self._pipe(mate), os.O_WRONLY | os.O_NONBLOCK))
+            except OSError:
+                # No reader left on this pipe
+                pass
+        for thread in self._threads:
+            thread.join()
+        shutil.rmtree(self.pipe_dir, ignore_errors=True)
+        if exc_type is None and self._errors:
+            raise RuntimeError(
+                f"Compressing the unaligned reads failed: {self._errors[0]!r}"
+            ) from self._errors[0]
+        return False
+
+    def write_sidecar(self) -> List[Path]:
+        mate1, mate2 = self.stats
+        if mate1.reads != mate2.reads:
+            raise RuntimeError(
+                f"bowtie2 wrote {mate1.reads} first and {mate2.reads} second mates"
+            )
+        return write_sidecar(self.output_dir, self.sample_name, mate1, mate2)
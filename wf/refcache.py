@@ -0,0 +1,201 @@
+"""
+LRU cache for large reference inputs
+
+Reference files (Kaiju databases, host genomes) are the same across runs,
+so instead of localising them from scratch in every task they are kept in
+a cache directory, keyed by remote path, version and size. Each task
+fetches the references it consumes through the cache. Entries are
+populated atomically under a file lock, so concurrent tasks sharing the
+directory download each reference only once, and the least recently used
+entries are evicted when the cache grows over its disk budget.
+
+The cache is only used when METAMAGE_REF_CACHE_DIR points to a directory
+that outlives the tasks, such as a persistent volume of the local runner or
+of an on-prem node; its budget is set with METAMAGE_REF_CACHE_GB. Without
+it, references are used where they were localised, as every Latch task
+runs in a fresh pod whose disk is discarded with it.
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from latch import message
+from latch.types import LatchFile
+
+REF_CACHE_DIR = (
+    Path(os.environ["METAMAGE_REF_CACHE_DIR"])
+    if os.environ.get("METAMAGE_REF_CACHE_DIR")
+    else None
+)
+REF_CACHE_GB = float(os.environ.get("METAMAGE_REF_CACHE_GB", "200"))
+
+_LAST_USED = ".last_used"
+
+
+def _remote_fingerprint(latch_file: LatchFile) -> Optional[str]:
+    """Identify the remote object by path, version and size
+
+    Returns None when the object can't be inspected without downloading
+    it, in which case the file is not cached.
+    """
+
+    remote_path = getattr(latch_file, "remote_path", None)
+    if not remote_path or not str(remote_path).startswith("latch://"):
+        return None
+
+    try:
+        from latch.ldata.path import LPath
+
+        remote = LPath(str(remote_path))
+        version, size = remote.version_id(), remote.size()
+    except Exception:
+        return None
+
+    return f"{remote_path}|{version}|{size}"
+
+
+def _entry_size(entry: Path) -> int:
+    return sum(f.stat().st_size for f in entry.iterdir() if f.is_file())
+
+
+class ReferenceCache:
+    def __init__(
+        self, root: Optional[Path] = REF_CACHE_DIR, budget_gb: float = REF_CACHE_GB
+    ):
+        self.root = root
+        self.budget = int(budget_gb * 1024**3)
+        self.hits = 0
+        self.misses = 0
+        self.bytes_downloaded = 0
+        self._lock = threading.Lock()
+        self._prefetcher = ThreadPoolExecutor(max_workers=4)
+        if self.root is not None:
+            self.root.mkdir(parents=True, exist_ok=True)
+
+    def _locked(self, key: str):
+        handle = open(self.root.joinpath(f"{key}.lock"), "w")
+        fcntl.flock(handle, fcntl.LOCK_EX)
+        return handle
+
+    def fetch(self, latch_file: LatchFile) -> Path:
+        """Return a local path for the file, downloading it only on a miss"""
+
+        if self.root is None:
+            return Path(latch_file.local_path)
+
+        fingerprint = _remote_fingerprint(latch_file)
+        if fingerprint is None:
+            return Path(latch_file.local_path)
+
+        key = hashlib.sha256(fingerprint.encode()).hexdigest()[:32]
+        entry = self.root.joinpath(key)
+        name = Path(str(latch_file.remote_path)).name
+
+        lock = self._locked(key)
+        try:
+            cached = entry.joinpath(name)
+            if cached.exists():
+                entry.joinpath(_LAST_USED).touch()
+                with self._lock:
+                    self.hits += 1
+                return cached
+
+            local_path = Path(latch_file.local_path)
+            size = local_path.stat().st_size
+            self._evict(size, keep=key)
+
+            # Populate a temporary entry and rename it, so a partially copied
+            # reference is never visible under the final key
+            staging = self.root.joinpath(f".{key}.{os.getpid()}.tmp")
+            shutil.rmtree(staging, ignore_errors=True)
+            staging.mkdir()
+            # The localised file still belongs to flytekit, link or copy it
+            try:
+                os.link(local_path, staging.joinpath(name))
+            except OSError:
+                shutil.copyfile(local_path, staging.joinpath(name))
+            staging.joinpath(_LAST_USED).touch()
+            shutil.rmtree(entry, ignore_errors=True)
+            os.replace(staging, entry)
+
+            with self._lock:
+                self.misses += 1
+                self.bytes_downloaded += size
+            return cached
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
+
+    def prefetch(self, latch_files: List[LatchFile]) -> List[Future]:
+        """Start fetching files in background threads"""
+
+        return [self._prefetcher.submit(self.fetch, f) for f in latch_files]
+
+    def _evict(self, incoming: int, keep: str):
+        """Remove least recently used entries until `incoming` bytes fit"""
+
+        entries = []
+        for entry in self.root.iterdir():
+            if entry.is_dir() and not entry.name.startswith(".") and entry.name != keep:
+                last_used = entry.joinpath(_LAST_USED)
+                mtime = last_used.stat().st_mtime if last_used.exists() else 0
+                entries.append((mtime, entry, _entry_size(entry)))
+
+        total = sum(size for _, _, size in entries)
+        for _, entry, size in sorted(entries, key=lambda e: e[0]):
+            if total + incoming <= self.budget:
+                break
+
+            # Entries in use by another task hold their lock, leave them alone
+            handle = open(self.root.joinpath(f"{entry.name}.lock"), "w")
+            try:
+                fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                handle.close()
+                continue
+            try:
+                shutil.rmtree(entry, ignore_errors=True)
+                total -= size
+            finally:
+                fcntl.flock(handle, fcntl.LOCK_UN)
+                handle.close()
+
+    def metrics(self) -> Dict[str, float]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "bytes_downloaded": self.bytes_downloaded,
+            "cache_bytes": sum(
+                _entry_size(e)
+                for e in self.root.iterdir()
+                if e.is_dir() and not e.name.startswith(".")
+            ),
+            "budget_bytes": self.budget,
+        }
+
+    def report(self, task_name: str):
+        """Log the cache metrics of a task and append them to the cache log"""
+
+        if self.root is None:
+            return
+
+        metrics = {"task": task_name, "time": time.time(), **self.metrics()}
+        with open(self.root.joinpath("metrics.jsonl"), "a") as f:
+            f.write(json.dumps(metrics) + "\n")
+
+        message(
+            "info",
+            {
+                "title": "Reference cache",
+                "body": f"Hits: {metrics['hits']}, misses: {metrics['misses']}, "
+                f"downloaded: {metrics['bytes_downloaded'] / 1024**3:.1f} GiB",
+            },
+        )
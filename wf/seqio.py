@@ -0,0 +1,110 @@
+"""
+Streaming readers and writers for sequence files
+"""
+
+import gzip
+import hashlib
+from pathlib import Path
+from typing import IO, Iterator, Tuple, Union
+
+_COMPLEMENT = bytes.maketrans(b"ACGTNacgtn", b"TGCANtgcan")
+
+
+def is_gzipped(path: Union[str, Path]) -> bool:
+    with open(path, "rb") as handle:
+        return handle.read(2) == b"\x1f\x8b"
+
+
+def open_maybe_gzip(path: Union[str, Path]) -> IO[bytes]:
+    """Open a file in binary mode, transparently decompressing gzip"""
+
+    if is_gzipped(path):
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+
+def count_fastq_records(path: Union[str, Path], block_size: int = 16 << 20) -> int:
+    """Count FASTQ records by streaming the (possibly gzipped) file"""
+
+    lines = 0
+    with open_maybe_gzip(path) as handle:
+        while True:
+            block = handle.read(block_size)
+            if not block:
+                break
+            lines += block.count(b"\n")
+            last = block[-1:]
+
+    if lines and last != b"\n":
+        lines += 1
+
+    return lines // 4
+
+
+def fastq_stats(path: Union[str, Path], block_size: int = 16 << 20) -> Tuple[int, int]:
+    """Count FASTQ records and sequenced bases by streaming the file"""
+
+    lines = bases = 0
+    rest = b""
+    with open_maybe_gzip(path) as handle:
+        while True:
+            block = handle.read(block_size)
+            if not block:
+                break
+            block_lines = (rest + block).split(b"\n")
+            rest = block_lines.pop()
+            # Sequence lines are the second of every four
+            bases += sum(map(len, block_lines[(1 - lines) % 4 :: 4]))
+            lines += len(block_lines)
+
+    if rest:
+        if lines % 4 == 1:
+            bases += len(rest)
+        lines += 1
+
+    return lines // 4, bases
+
+
+def read_fasta(path: Union[str, Path]) -> Iterator[Tuple[bytes, bytes]]:
+    """Yield (header, sequence) pairs from a FASTA file"""
+
+    header = None
+    chunks = []
+    with open_maybe_gzip(path) as handle:
+        for line in handle:
+            line = line.rstrip()
+            if line.startswith(b">"):
+                if header is not None:
+                    yield header, b"".join(chunks)
+                header = line[1:]
+                chunks = []
+            elif line:
+                chunks.append(line)
+
+    if header is not None:
+        yield header, b"".join(chunks)
+
+
+def write_fasta(handle: IO[bytes], header: bytes, sequence: bytes, width: int = 60):
+    """Write a single FASTA record with wrapped sequence lines"""
+
+    handle.write(b">" + header + b"\n")
+    for start in range(0, len(sequence), width):
+        handle.write(sequence[start : start + width] + b"\n")
+
+
+def reverse_complement(sequence: bytes) -> bytes:
+    return sequence.translate(_COMPLEMENT)[::-1]
+
+
+def canonical_hash(sequence: bytes) -> bytes:
+    """Strand-independent digest of a nucleotide sequence
+
+    A sequence and its reverse complement hash to the same value, so the
+    digest can be used to detect both exact and reverse-complement
+    duplicates.
+    """
+
+    forward = sequence.upper()
+    canonical = min(forward, reverse_complement(forward))
+    return hashlib.blake2b(canonical, digest_size=16).digest()
@@ -0,0 +1,249 @@
+"""
+FracMinHash sketches of read sets for duplicate detection and cohort similarity
+
+Every sample is reduced to the hashes of its canonical k-mers that fall
+below 1/KMER_SCALE of the hash space. These are the k-mers host removal
+already samples for the read statistics sidecar (see readstats.py), so
+the reads are not hashed again; reads without a sidecar are streamed to
+sample the same k-mers. A resubmitted sequencing run is recognised
+against a cohort sketch index before it is reassembled, and every sample
+gets a row of the cohort Jaccard/ANI matrices.
+
+The samples of a cohort run in parallel, so each publishes its sketch
+under its own directory, latch:///metamage/{sample}/sketch/, and the
+index is only read. The sketches of a cohort are merged into the index
+passed to the next runs:
+
+    python -m wf.sketch --output sketch_index sample_a/sketch sample_b/sketch
+"""
+
+import argparse
+import json
+import math
+import shutil
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from latch import message
+from latch.resources.tasks import custom_task
+from latch.types import LatchDir
+
+from .analysis import results_available
+from .kmers import KMER_SIZE
+from .readstats import (
+    KMER_READ_STRIDE,
+    KMER_SCALE,
+    MateStats,
+    load_read_distributions,
+)
+from .seqio import open_maybe_gzip
+
+# Bytes of FASTQ added to the statistics at once
+_BLOCK_SIZE = 4 << 20
+
+
+def sketch_reads(read_file: Path) -> np.ndarray:
+    """FracMinHash sketch of first mates, as the read statistics sample it"""
+
+    stats = MateStats(sample_kmers=True)
+    with open_maybe_gzip(read_file) as handle:
+        while True:
+            block = handle.read(_BLOCK_SIZE)
+            if not block:
+                break
+            stats.update(block)
+    stats.finish()
+
+    return stats.kmer_counts()[0]
+
+
+def jaccard(a: np.ndarray, b: np.ndarray) -> float:
+    """Estimate the Jaccard index of two sets from their FracMinHash sketches"""
+
+    union = np.union1d(a, b).size
+    if union == 0:
+        return 0.0
+
+    return np.intersect1d(a, b, assume_unique=True).size / union
+
+
+def ani_estimate(jaccard_index: float, k: int = KMER_SIZE) -> float:
+    """Average nucleotide identity from the Mash distance of a Jaccard index"""
+
+    if jaccard_index <= 0:
+        return 0.0
+    distance = -math.log(2 * jaccard_index / (1 + jaccard_index)) / k
+
+    return max(0.0, 1 - distance)
+
+
+class SketchIndex:
+    """Directory of per-sample sketches with a JSON index of their metadata"""
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.root.mkdir(parents=True, exist_ok=True)
+        index_file = self.root.joinpath("index.json")
+        self.entries: Dict[str, Dict] = {}
+        if index_file.exists():
+            with open(index_file) as f:
+                self.entries = json.load(f)
+
+    @classmethod
+    def from_latch(cls, index_dir: Optional[LatchDir], local_name: str):
+        local_path = Path(local_name).resolve()
+        if index_dir is not None:
+            shutil.copytree(index_dir.local_path, local_path, dirs_exist_ok=True)
+        return cls(local_path)
+
+    def compatible(self) -> List[str]:
+        """Samples sketched with the current k-mer size, scale and read stride"""
+
+        return [
+            name
+            for name, entry in self.entries.items()
+            if entry["k"] == KMER_SIZE
+            and entry.get("scale") == KMER_SCALE
+            and entry.get("read_stride") == KMER_READ_STRIDE
+        ]
+
+    def load(self, sample_name: str) -> np.ndarray:
+        return np.load(self.root.joinpath(f"{sample_name}.sketch.npy"))
+
+    def add(self, sample_name: str, sketch_file: Path, entry: Dict):
+        if sketch_file != self.root.joinpath(sketch_file.name):
+            shutil.copyfile(sketch_file, self.root.joinpath(sketch_file.name))
+        self.entries[sample_name] = entry
+
+    def save(self):
+        with open(self.root.joinpath("index.json"), "w") as f:
+            json.dump(self.entries, f, indent=2, sort_keys=True)
+
+
+def _write_matrix(path: Path, names: List[str], values: np.ndarray):
+    with open(path, "w") as f:
+        f.write("\t".join(["sample", *names]) + "\n")
+        for name, row in zip(names, values):
+            f.write("\t".join([name, *(f"{v:.6f}" for v in row)]) + "\n")
+
+
+@custom_task(cpu=2, memory=8, storage_gib=500)
+def sketch_sample(
+    read_dir: LatchDir,
+    sample_name: str,
+    sketch_index: Optional[LatchDir],
+    duplicate_jaccard: float,
+    skip_duplicates: bool,
+) -> Tuple[LatchDir, str, bool]:
+    """Sketch the reads, compare them to the cohort and look for a duplicate
+
+    A previous sample is reported as a duplicate when its Jaccard index
+    with this sample reaches `duplicate_jaccard` and all of its results
+    are still available. Its results are only reused, instead of running
+    the analysis, with `skip_duplicates`.
+    """
+
+    output_dir_name = "sketch"
+    output_dir = Path(output_dir_name).resolve()
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    distributions = load_read_distributions(read_dir, sample_name)
+    if distributions is not None and "kmer_hashes" in distributions:
+        sketch = distributions["kmer_hashes"]
+    else:
+        sketch = sketch_reads(
+            Path(read_dir.local_path, f"{sample_name}_unaligned.fastq.1.gz")
+        )
+    sketch_file = output_dir.joinpath(f"{sample_name}.sketch.npy")
+    np.save(sketch_file, sketch)
+
+    index = SketchIndex.from_latch(sketch_index, "sketch_index")
+    cohort = sorted(name for name in index.compatible() if name != sample_name)
+    sketches = {name: index.load(name) for name in cohort}
+    similarities = {name: jaccard(sketch, sketches[name]) for name in cohort}
+
+    duplicate_of = ""
+    for name, similarity in sorted(similarities.items(), key=lambda s: -s[1]):
+        if similarity < duplicate_jaccard:
+            break
+        if results_available(name):
+            duplicate_of = name
+            break
+
+    # This sample's row and column are added to the cohort matrices
+    names = sorted([*cohort, sample_name])
+    sketches[sample_name] = sketch
+    jaccard_matrix = np.eye(len(names))
+    for i in range(len(names)):
+        for j in range(i + 1, len(names)):
+            jaccard_matrix[i, j] = jaccard_matrix[j, i] = jaccard(
+                sketches[names[i]], sketches[names[j]]
+            )
+    ani_matrix = np.vectorize(ani_estimate)(jaccard_matrix)
+    _write_matrix(output_dir.joinpath("cohort_jaccard.tsv"), names, jaccard_matrix)
+    _write_matrix(output_dir.joinpath("cohort_ani.tsv"), names, ani_matrix)
+
+    with open(output_dir.joinpath(f"{sample_name}_sketch.json"), "w") as f:
+        json.dump(
+            {
+                "sample": sample_name,
+                "k": KMER_SIZE,
+                "scale": KMER_SCALE,
+                "read_stride": KMER_READ_STRIDE,
+                "hashes": int(sketch.size),
+                "duplicate_of": duplicate_of or None,
+                "nearest": sorted(similarities.items(), key=lambda s: -s[1])[:10],
+            },
+            f,
+            indent=2,
+        )
+
+    if duplicate_of:
+        message(
+            "warning",
+            {
+                "title": "Duplicate sample",
+                "body": f"{sample_name} matches {duplicate_of} "
+                f"(Jaccard {similarities[duplicate_of]:.4f}), "
+                + ("reusing its results" if skip_duplicates else "analysing it anyway"),
+            },
+        )
+
+    return (
+        LatchDir(str(output_dir), f"latch:///metamage/{sample_name}/{output_dir_name}"),
+        duplicate_of,
+        bool(duplicate_of) and skip_duplicates,
+    )
+
+
+def merge_sketches(output: Path, sketch_dirs: List[Path]):
+    """Add the sketches published by samples to the index in `output`"""
+
+    index = SketchIndex(output)
+    for sketch_dir in sketch_dirs:
+        for summary_file in sorted(sketch_dir.glob("*_sketch.json")):
+            with open(summary_file) as f:
+                summary = json.load(f)
+            sample_name = summary["sample"]
+            index.add(
+                sample_name,
+                sketch_dir.joinpath(f"{sample_name}.sketch.npy"),
+                {key: summary[key] for key in ("k", "scale", "read_stride", "hashes")},
+            )
+    index.save()
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--output", required=True, type=Path, help="Index directory")
+    parser.add_argument(
+        "sketch_dirs", nargs="+", type=Path, help="Sketch directories of samples"
+    )
+    args = parser.parse_args(argv)
+
+    merge_sketches(args.output, args.sketch_dirs)
+
+
+if __name__ == "__main__":
+    main()
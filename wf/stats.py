@@ -0,0 +1,203 @@
+"""
+Fast streaming statistics for assemblies
+"""
+
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, Tuple, Union
+
+import numpy as np
+
+from .seqio import open_maybe_gzip
+
+BLOCK_SIZE = 16 * 1024 * 1024
+LENGTH_THRESHOLDS = (0, 1000, 5000, 10000, 25000, 50000)
+
+_NEWLINE = ord("\n")
+_HEADER = ord(">")
+_GC = np.zeros(256, dtype=bool)
+_GC[[ord(c) for c in "GCgc"]] = True
+_ACGT = np.zeros(256, dtype=bool)
+_ACGT[[ord(c) for c in "ACGTacgt"]] = True
+_WHITESPACE = np.zeros(256, dtype=bool)
+_WHITESPACE[[ord(c) for c in "\n\r \t"]] = True
+
+
+def line_blocks(path: Union[str, Path], block_size: int) -> Iterator[np.ndarray]:
+    """Yield blocks of a file that always end on a line boundary"""
+
+    remainder = b""
+    with open_maybe_gzip(path) as handle:
+        while True:
+            chunk = handle.read(block_size)
+            if not chunk:
+                break
+            chunk = remainder + chunk
+            cut = chunk.rfind(b"\n") + 1
+            if cut == 0:
+                remainder = chunk
+                continue
+            remainder = chunk[cut:]
+            yield np.frombuffer(chunk[:cut], dtype=np.uint8)
+
+    if remainder:
+        yield np.frombuffer(remainder + b"\n", dtype=np.uint8)
+
+
+def fasta_length_gc(
+    path: Union[str, Path], block_size: int = BLOCK_SIZE
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Compute per-record length, GC and ACGT counts of a FASTA file
+
+    The file is streamed in line-aligned blocks and every block is
+    processed with vectorised NumPy operations, so the cost is a
+    handful of passes over each block in C rather than a Python loop
+    over every line.
+    """
+
+    return blocks_length_gc(line_blocks(path, block_size))
+
+
+def blocks_length_gc(
+    blocks: Iterable[np.ndarray],
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """`fasta_length_gc` over line-aligned blocks of FASTA text"""
+
+    lengths, gc_counts, acgt_counts = [], [], []
+    n_records = 0
+
+    for block in blocks:
+        newlines = block == _NEWLINE
+        line_starts = np.empty(block.size, dtype=bool)
+        line_starts[0] = True
+        line_starts[1:] = newlines[:-1]
+
+        header_starts = line_starts & (block == _HEADER)
+        line_id = np.cumsum(line_starts) - 1
+        header_lines = header_starts[line_starts]
+        in_header = header_lines[line_id]
+
+        # Record index of every byte, offset by one so that bytes before the
+        # first header of the block (continuation of the previous record) are 0
+        record_id = np.cumsum(header_starts)
+        new_records = int(record_id[-1])
+
+        sequence = ~in_header & ~_WHITESPACE[block]
+        size = new_records + 1
+        block_lengths = np.bincount(record_id[sequence], minlength=size)
+        block_gc = np.bincount(record_id[sequence & _GC[block]], minlength=size)
+        block_acgt = np.bincount(record_id[sequence & _ACGT[block]], minlength=size)
+
+        if n_records:
+            lengths[-1][-1] += block_lengths[0]
+            gc_counts[-1][-1] += block_gc[0]
+            acgt_counts[-1][-1] += block_acgt[0]
+
+        if new_records:
+            lengths.append(block_lengths[1:])
+            gc_counts.append(block_gc[1:])
+            acgt_counts.append(block_acgt[1:])
+            n_records += new_records
+
+    if not n_records:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty
+
+    return (
+        np.concatenate(lengths).astype(np.int64),
+        np.concatenate(gc_counts).astype(np.int64),
+        np.concatenate(acgt_counts).astype(np.int64),
+    )
+
+
+def nx_statistic(lengths: np.ndarray, fraction: float) -> Tuple[int, int]:
+    """Return the Nx and Lx values of a set of contig lengths"""
+
+    if lengths.size == 0:
+        return 0, 0
+
+    ordered = np.sort(lengths)[::-1]
+    cumulative = np.cumsum(ordered)
+    idx = int(np.searchsorted(cumulative, cumulative[-1] * fraction))
+
+    return int(ordered[idx]), idx + 1
+
+
+def length_histogram(lengths: np.ndarray, n_bins: int = 30) -> Dict[str, list]:
+    """Histogram of contig lengths over logarithmically spaced bins"""
+
+    if lengths.size == 0:
+        return {"bin_start": [], "bin_end": [], "contigs": [], "bases": []}
+
+    upper = max(int(lengths.max()), 2)
+    edges = np.geomspace(max(int(lengths.min()), 1), upper + 1, n_bins + 1)
+    edges = np.unique(edges.astype(np.int64))
+    counts, _ = np.histogram(lengths, bins=edges)
+    bases, _ = np.histogram(lengths, bins=edges, weights=lengths)
+
+    return {
+        "bin_start": edges[:-1].tolist(),
+        "bin_end": edges[1:].tolist(),
+        "contigs": counts.tolist(),
+        "bases": bases.astype(np.int64).tolist(),
+    }
+
+
+def assembly_summary(
+    lengths: np.ndarray,
+    gc_counts: np.ndarray,
+    acgt_counts: np.ndarray,
+) -> Dict[str, Union[int, float]]:
+    """Summarise an assembly in the spirit of the QUAST report"""
+
+    total = int(lengths.sum())
+    acgt = int(acgt_counts.sum())
+    n50, l50 = nx_statistic(lengths, 0.5)
+    n90, l90 = nx_statistic(lengths, 0.9)
+
+    summary = {
+        "contigs": int(lengths.size),
+        "total_length": total,
+        "largest_contig": int(lengths.max()) if lengths.size else 0,
+        "N50": n50,
+        "N90": n90,
+        "L50": l50,
+        "L90": l90,
+        "GC (%)": round(100 * int(gc_counts.sum()) / acgt, 2) if acgt else 0.0,
+        "N's per 100 kbp": round(100_000 * (total - acgt) / total, 2) if total else 0.0,
+    }
+    for threshold in LENGTH_THRESHOLDS:
+        selected = lengths[lengths >= threshold]
+        summary[f"contigs (>= {threshold} bp)"] = int(selected.size)
+        summary[f"total_length (>= {threshold} bp)"] = int(selected.sum())
+
+    return summary
+
+
+def bin_summary(
+    lengths: np.ndarray,
+    gc_counts: np.ndarray,
+    acgt_counts: np.ndarray,
+) -> Dict[str, Union[int, float]]:
+    """Size, contiguity and GC coherence of the contigs of one bin
+
+    The GC spread is the length-weighted standard deviation of the contig
+    GC contents, contigs of a single genome have similar GC contents.
+    """
+
+    acgt = int(acgt_counts.sum())
+    covered = acgt_counts > 0
+    contig_gc = 100 * gc_counts[covered] / acgt_counts[covered]
+    weights = lengths[covered]
+    if weights.sum():
+        mean_gc = float(np.average(contig_gc, weights=weights))
+        spread = float(np.sqrt(np.average((contig_gc - mean_gc) ** 2, weights=weights)))
+    else:
+        mean_gc, spread = 0.0, 0.0
+
+    return {
+        "contigs": int(lengths.size),
+        "bases": int(lengths.sum()),
+        "N50": nx_statistic(lengths, 0.5)[0],
+        "GC (%)": round(100 * int(gc_counts.sum()) / acgt, 2) if acgt else 0.0,
+        "GC spread (%)": round(spread, 2),
+    }
@@ -0,0 +1,78 @@
+"""
+Measured thread counts of the wrapped tools
+
+The tools' thread flags used to be fixed in each command. A thread-scaling
+benchmark (python -m wf.benchmark) runs every command builder across a
+sweep of thread counts and writes the recommended thread count of each
+tool per node size to a profile, wf/thread_profile.json, which ships with
+the workflow. Tasks ask for their tool's thread count here and get the
+recommendation for the node they run on, or the command's previous fixed
+value for tools the profile doesn't cover.
+
+Another profile can be used with METAMAGE_THREAD_PROFILE.
+"""
+
+import json
+import os
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, Optional
+
+PROFILE_PATH = Path(__file__).with_name("thread_profile.json")
+PROFILE_VERSION = 1
+
+
+def profile_path() -> Path:
+    return Path(os.environ.get("METAMAGE_THREAD_PROFILE", PROFILE_PATH))
+
+
+@lru_cache(maxsize=None)
+def load_profile(path: Optional[Path] = None) -> Dict:
+    """The tools of a thread profile, empty if there is none"""
+
+    path = path or profile_path()
+    try:
+        with open(path) as f:
+            profile = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+    if profile.get("version") != PROFILE_VERSION:
+        return {}
+    return profile.get("tools", {})
+
+
+def node_cpus() -> int:
+    """CPUs available to this task, honouring the container's CPU quota"""
+
+    cpus = (
+        len(os.sched_getaffinity(0))
+        if hasattr(os, "sched_getaffinity")
+        else os.cpu_count() or 1
+    )
+    try:
+        # cgroup v2: "max 100000" or "<quota> <period>"
+        quota, period = Path("/sys/fs/cgroup/cpu.max").read_text().split()
+        if quota != "max":
+            cpus = min(cpus, max(1, int(quota) // int(period)))
+    except (OSError, ValueError):
+        pass
+    return cpus
+
+
+def recommended_threads(recommendations: Dict[str, int], cpus: int) -> Optional[int]:
+    """The recommendation of the largest profiled node size not above `cpus`"""
+
+    sizes = sorted(int(size) for size in recommendations)
+    if not sizes:
+        return None
+    fitting = [size for size in sizes if size <= cpus]
+    size = fitting[-1] if fitting else sizes[0]
+    return max(1, min(recommendations[str(size)], cpus))
+
+
+def tool_threads(tool: str, default: int, cpus: Optional[int] = None) -> int:
+    """Thread count of `tool` on this node, `default` if it isn't profiled"""
+
+    recommendations = load_profile().get(tool, {}).get("recommended", {})
+    threads = recommended_threads(recommendations, cpus or node_cpus())
+    return default if threads is None else threads
@@ -1,8 +1,17 @@
 from dataclasses import dataclass
 from enum import Enum
+from itertools import product
+from typing import List, Optional, Tuple
 
 from dataclasses_json import dataclass_json
-from latch.types import LatchFile
+from latch.types import LatchDir, LatchFile
+
+
+@dataclass_json
+@dataclass
+class Lane:
+    read1: LatchFile
+    read2: LatchFile
 
 
 @dataclass_json
@@ -10,6 +19,13 @@ from latch.types import LatchFile
 class Sample:
     read1: LatchFile
     read2: LatchFile
+    additional_lanes: Optional[List[Lane]] = None
+
+    def lanes(self) -> List[Tuple[LatchFile, LatchFile]]:
+        """Read pairs of every lane/run of the sample, in order"""
+
+        extra = self.additional_lanes or []
+        return [(self.read1, self.read2)] + [(lane.read1, lane.read2) for lane in extra]
 
 
 @dataclass_json
@@ -19,6 +35,24 @@ class HostData:
     host_genome: LatchFile
 
 
+@dataclass_json
+@dataclass
+class ReadChunk:
+    read1: LatchFile
+    read2: LatchFile
+    sample_name: str
+    index: int
+
+
+@dataclass_json
+@dataclass
+class ReadChunkGroup:
+    chunks: List[ReadChunk]
+    host_idx: LatchDir
+    host_name: str
+    index: int
+
+
 class TaxonRank(Enum):
     superkingdom = "superkingdom"
     phylum = "phylum"
@@ -58,3 +92,43 @@ class fARGeneModel(Enum):
     aminoglycoside_model_g = "aminoglycoside_model_g"
     aminoglycoside_model_h = "aminoglycoside_model_h"
     aminoglycoside_model_i = "aminoglycoside_model_i"
+
+
+@dataclass_json
+@dataclass
+class MacrelChunk:
+    contigs: LatchFile
+    sample_name: str
+    index: int
+    annotation_cache: Optional[LatchFile] = None
+
+
+@dataclass_json
+@dataclass
+class FargeneChunk:
+    contigs: LatchFile
+    sample_name: str
+    index: int
+    hmm_model: fARGeneModel
+    annotation_cache: Optional[LatchFile] = None
+
+
+@dataclass_json
+@dataclass
+class GeccoChunk:
+    contigs: LatchFile
+    sample_name: str
+    index: int
+
+
+@dataclass_json
+@dataclass
+class MetabatSweep:
+    min_contig: List[int]
+    max_edges: List[int]
+    seed: List[int]
+
+    def configurations(self) -> List[Tuple[int, int, int]]:
+        """Every (minContig, maxEdges, seed) combination of the grid"""
+
+        return list(product(self.min_contig, self.max_edges, self.seed))
@@ -0,0 +1,117 @@
+"""
+Cheap checks of tool outputs before a task returns
+
+A tool that crashes half way often leaves a truncated output behind, and
+the tasks downstream then run for hours on it. These checks stream the
+outputs once, or only read their ends, and raise as soon as something is
+wrong so the workflow stops before the next stage is scheduled.
+"""
+
+import gzip
+import subprocess
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Sequence, Tuple, Union
+
+from .seqio import open_maybe_gzip
+
+# Empty BGZF block that terminates every complete BAM file
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+_BLOCK_SIZE = 16 << 20
+
+
+def check_returncodes(steps: Sequence[Tuple[int, List[str]]]):
+    """Raise for the first failed command of a pipeline, in pipeline order"""
+
+    for returncode, cmd in steps:
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, cmd)
+
+
+def _fastq_records(path: Union[str, Path]) -> int:
+    """Stream a (gzipped) FASTQ file, checking its framing and gzip CRCs"""
+
+    lines = 0
+    first = last = b""
+    try:
+        with open_maybe_gzip(path) as handle:
+            while True:
+                block = handle.read(_BLOCK_SIZE)
+                if not block:
+                    break
+                first = first or block[:1]
+                lines += block.count(b"\n")
+                last = block[-1:]
+    except (EOFError, OSError, zlib.error, gzip.BadGzipFile) as e:
+        raise RuntimeError(f"{path} is truncated or corrupt: {e}") from e
+
+    if lines and first != b"@":
+        raise RuntimeError(f"{path} is not a FASTQ file")
+    if last not in (b"", b"\n") or lines % 4:
+        raise RuntimeError(f"{path} ends in the middle of a FASTQ record")
+
+    return lines // 4
+
+
+def validate_read_pair(read1: Union[str, Path], read2: Union[str, Path]) -> int:
+    """Check both mate files and that they hold the same number of reads"""
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        records1, records2 = executor.map(_fastq_records, (read1, read2))
+
+    if records1 != records2:
+        raise RuntimeError(
+            f"Mate files have different numbers of reads: {read1} has "
+            f"{records1}, {read2} has {records2}"
+        )
+
+    return records1
+
+
+def validate_fasta(path: Union[str, Path]) -> int:
+    """Check that every FASTA record has a header and a sequence
+
+    An empty file is valid, an assembly may have no contigs.
+    """
+
+    records = 0
+    in_header = False
+    last = b"\n"
+    with open(path, "rb") as handle:
+        for line in handle:
+            last = line[-1:]
+            if line.startswith(b">"):
+                if in_header:
+                    raise RuntimeError(f"{path} has a record without a sequence")
+                in_header = True
+                records += 1
+            elif not records and line.strip():
+                raise RuntimeError(f"{path} does not start with a FASTA header")
+            else:
+                in_header = in_header and not line.strip()
+
+    if in_header or last != b"\n":
+        raise RuntimeError(f"{path} is truncated")
+
+    return records
+
+
+def validate_bam(path: Union[str, Path]):
+    """Check the BGZF magic and the end-of-file marker of a BAM file"""
+
+    path = Path(path)
+    size = path.stat().st_size if path.exists() else 0
+    if size < len(BGZF_EOF):
+        raise RuntimeError(f"{path} is missing or empty")
+
+    with open(path, "rb") as handle:
+        magic = handle.read(4)
+        handle.seek(-len(BGZF_EOF), 2)
+        eof = handle.read()
+
+    if magic != BGZF_EOF[:4]:
+        raise RuntimeError(f"{path} is not a BGZF-compressed BAM file")
+    if eof != BGZF_EOF:
+        raise RuntimeError(f"{path} is truncated, the BGZF EOF marker is missing")